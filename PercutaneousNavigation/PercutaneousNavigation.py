@@ -1,9 +1,22 @@
 import os
+import json
+import hashlib
+import threading
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import math
+import time
+import numpy as np
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+try:
+  from scipy.spatial import cKDTree
+except ImportError:
+  cKDTree = None # surface registration falls back to the cell locator
 
 #
 # PercutaneousNavigation
@@ -42,6 +55,7 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
     ScriptedLoadableModuleWidget.setup(self)
 
     self.PercutaneousNavigationLogic = PercutaneousNavigationLogic() 
+    self.nodeRegistry = self.PercutaneousNavigationLogic.nodeRegistry
 
     self.defaultStyleSheet = "QLabel { color : #000000; \
                                        font: bold 14px}"
@@ -53,22 +67,22 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
     parametersFormLayout = qt.QFormLayout(transformsCollapsibleButton)
     
     # ReferenceToTracker transform selector
-    self.referenceToTrackerTransform = slicer.util.getNode('ReferenceToTracker')
+    self.referenceToTrackerTransform = self.nodeRegistry.getNode('ReferenceToTracker')
     if not self.referenceToTrackerTransform:
         print('ERROR: ReferenceToTracker transform node was not found')
     
     # TrackerToReference transform selector
-    self.trackerToReferenceTransform = slicer.util.getNode('TrackerToReference')
+    self.trackerToReferenceTransform = self.nodeRegistry.getNode('TrackerToReference')
     if not self.trackerToReferenceTransform:
         print('ERROR: TrackerToReference transform node was not found')
 
     # PointerToTracker transform selector
-    self.pointerToTrackerTransform = slicer.util.getNode('PointerToTracker')
+    self.pointerToTrackerTransform = self.nodeRegistry.getNode('PointerToTracker')
     if not self.pointerToTrackerTransform:
         print('ERROR: PointerToTracker transform node was not found')
 
     # NeedleToTracker transform selector
-    self.needleToTrackerTransform = slicer.util.getNode('NeedleToTracker')
+    self.needleToTrackerTransform = self.nodeRegistry.getNode('NeedleToTracker')
     if not self.needleToTrackerTransform:
         print('ERROR: NeedleToTracker transform node was not found')
 
@@ -162,6 +176,39 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
     self.QFormLayoutLabel.setStyleSheet(self.defaultStyleSheet)
     parametersFormLayout.addRow(self.QFormLayoutLabel, self.calculateDistanceLabel) 
 
+    # Nearest Target Label
+    self.nearestTargetLabel = qt.QLabel('-')
+    self.nearestTargetLabel.setStyleSheet(self.defaultStyleSheet)
+    self.nearestTargetFormLayoutLabel = qt.QLabel('Nearest target: ')
+    self.nearestTargetFormLayoutLabel.setStyleSheet(self.defaultStyleSheet)
+    parametersFormLayout.addRow(self.nearestTargetFormLayoutLabel, self.nearestTargetLabel) 
+
+    # Bone Surface Distance Checkbox
+    self.boneSurfaceDistanceCheckBox = qt.QCheckBox("Calculate distance to bone surface")
+    self.boneSurfaceDistanceCheckBox.toolTip = "Also report the distance from the needle tip to the closest point of the bone model."
+    self.boneSurfaceDistanceCheckBox.checked = False
+    parametersFormLayout.addRow(self.boneSurfaceDistanceCheckBox)
+
+    # Bone Surface Distance Label
+    self.boneSurfaceDistanceLabel = qt.QLabel('-')
+    self.boneSurfaceDistanceLabel.setStyleSheet(self.defaultStyleSheet)
+    self.boneSurfaceDistanceFormLayoutLabel = qt.QLabel('Distance to bone (mm): ')
+    self.boneSurfaceDistanceFormLayoutLabel.setStyleSheet(self.defaultStyleSheet)
+    parametersFormLayout.addRow(self.boneSurfaceDistanceFormLayoutLabel, self.boneSurfaceDistanceLabel) 
+
+    # Trajectory Forecast Checkbox
+    self.trajectoryForecastCheckBox = qt.QCheckBox("Forecast needle trajectory collision")
+    self.trajectoryForecastCheckBox.toolTip = "Report where the needle would enter the bone or soft tissue if advanced along its axis."
+    self.trajectoryForecastCheckBox.checked = False
+    parametersFormLayout.addRow(self.trajectoryForecastCheckBox)
+
+    # Trajectory Forecast Label
+    self.trajectoryForecastLabel = qt.QLabel('-')
+    self.trajectoryForecastLabel.setStyleSheet(self.defaultStyleSheet)
+    self.trajectoryForecastFormLayoutLabel = qt.QLabel('Distance to collision (mm): ')
+    self.trajectoryForecastFormLayoutLabel.setStyleSheet(self.defaultStyleSheet)
+    parametersFormLayout.addRow(self.trajectoryForecastFormLayoutLabel, self.trajectoryForecastLabel) 
+
     # Needle Viewpoint Button
     self.needleViewpointButton = qt.QPushButton()
     self.needleViewpointButton.toolTip = "Apply needle viewpoint."
@@ -182,6 +229,314 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
     self.pointerViewpointButton.setText(self.enablePointerViewpointButtonTextState0)
     parametersFormLayout.addRow(self.pointerViewpointButton)
 
+    # Level Of Detail Checkbox
+    self.levelOfDetailCheckBox = qt.QCheckBox("Reduce anatomy detail while moving")
+    self.levelOfDetailCheckBox.toolTip = "In needle or pointer viewpoint mode, show decimated bone and soft tissue models while the camera moves, and full detail when it is still."
+    self.levelOfDetailCheckBox.checked = False
+    parametersFormLayout.addRow(self.levelOfDetailCheckBox)
+
+    # Frame Batching Checkbox
+    self.frameBatchingCheckBox = qt.QCheckBox("Render once per tracker frame")
+    self.frameBatchingCheckBox.toolTip = "Apply the tip, line, label and camera updates of a tracker frame together and render the 3D view once for the whole frame."
+    self.frameBatchingCheckBox.checked = True
+    parametersFormLayout.addRow(self.frameBatchingCheckBox)
+
+    # Cached Clipping Range Checkbox
+    self.cachedClippingRangeCheckBox = qt.QCheckBox("Clipping range from cached model bounds")
+    self.cachedClippingRangeCheckBox.toolTip = "In viewpoint mode, compute the near and far clipping planes from the cached bounds of the anatomy and tool models instead of the bounds of the whole scene."
+    self.cachedClippingRangeCheckBox.checked = True
+    parametersFormLayout.addRow(self.cachedClippingRangeCheckBox)
+
+    # Needle Slice Reslicing Checkbox
+    self.needleSliceReslicingCheckBox = qt.QCheckBox("Reslice views along needle")
+    self.needleSliceReslicingCheckBox.toolTip = "Show the Red slice perpendicular to the needle and the Yellow and Green slices along the needle, through the needle tip."
+    self.needleSliceReslicingCheckBox.checked = False
+    parametersFormLayout.addRow(self.needleSliceReslicingCheckBox)
+
+    # Reslicing Rate Spin Box
+    self.needleSliceReslicingRateSpinBox = qt.QSpinBox()
+    self.needleSliceReslicingRateSpinBox.minimum = 1
+    self.needleSliceReslicingRateSpinBox.maximum = 60
+    self.needleSliceReslicingRateSpinBox.value = 20
+    self.needleSliceReslicingRateSpinBox.suffix = " Hz"
+    self.needleSliceReslicingRateSpinBox.toolTip = "Maximum rate of slice updates, tracker events in between are coalesced."
+    parametersFormLayout.addRow("Reslicing rate: ", self.needleSliceReslicingRateSpinBox)
+
+    # Latency Compensation Checkbox
+    self.latencyCompensationCheckBox = qt.QCheckBox("Latency compensation")
+    self.latencyCompensationCheckBox.toolTip = "Show the needle and pointer where they are predicted to be after the prediction horizon, to compensate the tracking and display delay."
+    self.latencyCompensationCheckBox.checked = False
+    parametersFormLayout.addRow(self.latencyCompensationCheckBox)
+
+    # Prediction Horizon Spin Box
+    self.predictionHorizonSpinBox = qt.QSpinBox()
+    self.predictionHorizonSpinBox.minimum = 0
+    self.predictionHorizonSpinBox.maximum = 200
+    self.predictionHorizonSpinBox.value = 30
+    self.predictionHorizonSpinBox.suffix = " ms"
+    self.predictionHorizonSpinBox.toolTip = "How far ahead the tool poses are extrapolated."
+    parametersFormLayout.addRow("Prediction horizon: ", self.predictionHorizonSpinBox)
+
+    # Prediction Error Label
+    self.predictionErrorLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("Prediction error RMS (mm): ", self.predictionErrorLabel)
+    self.predictionErrorTimer = qt.QTimer()
+    self.predictionErrorTimer.setInterval(1000)
+
+    # Multiple Views Area
+    multipleViewsCollapsibleButton = ctk.ctkCollapsibleButton()
+    multipleViewsCollapsibleButton.text = "Multiple Views"
+    multipleViewsCollapsibleButton.collapsed = True
+    self.layout.addWidget(multipleViewsCollapsibleButton)   
+    parametersFormLayout = qt.QFormLayout(multipleViewsCollapsibleButton)
+
+    # Dual 3D Layout Button
+    self.dualThreeDLayoutButton = qt.QPushButton("Dual 3D Layout")
+    self.dualThreeDLayoutButton.toolTip = "Switch to a layout with two 3D views, e.g. one per monitor."
+    parametersFormLayout.addRow(self.dualThreeDLayoutButton)
+
+    # View Selector
+    self.boundViewSelector = slicer.qMRMLNodeComboBox()
+    self.boundViewSelector.nodeTypes = ( ("vtkMRMLViewNode"), "" )
+    self.boundViewSelector.selectNodeUponCreation = False
+    self.boundViewSelector.addEnabled = False
+    self.boundViewSelector.removeEnabled = False
+    self.boundViewSelector.noneEnabled = False
+    self.boundViewSelector.showHidden = False
+    self.boundViewSelector.setMRMLScene( slicer.mrmlScene )
+    self.boundViewSelector.setToolTip( "Pick an additional 3D view. The first 3D view is controlled by the viewpoint buttons." )
+    parametersFormLayout.addRow("3D view: ", self.boundViewSelector)
+
+    # View Camera Selector
+    self.boundViewCameraSelector = qt.QComboBox()
+    self.boundViewCameraSelector.addItem("Overview")
+    self.boundViewCameraSelector.addItem("Needle")
+    self.boundViewCameraSelector.addItem("Pointer")
+    self.boundViewCameraSelector.toolTip = "Camera of the selected view: fixed overview, needle-eye or pointer-eye view."
+    parametersFormLayout.addRow("Camera: ", self.boundViewCameraSelector)
+
+    # Bind View Button
+    self.bindViewButton = qt.QPushButton("Bind View")
+    self.bindViewButton.toolTip = "Drive the selected view with the selected camera, updated with the other views on every tracker frame."
+    parametersFormLayout.addRow(self.bindViewButton)
+
+    # Unbind View Button
+    self.unbindViewButton = qt.QPushButton("Unbind View")
+    self.unbindViewButton.toolTip = "Stop updating the selected view."
+    parametersFormLayout.addRow(self.unbindViewButton)
+
+    # Tracked Tools Area
+    trackedToolsCollapsibleButton = ctk.ctkCollapsibleButton()
+    trackedToolsCollapsibleButton.text = "Additional Needles"
+    trackedToolsCollapsibleButton.collapsed = True
+    self.layout.addWidget(trackedToolsCollapsibleButton)   
+    parametersFormLayout = qt.QFormLayout(trackedToolsCollapsibleButton)
+
+    # Additional Needle ToTracker transform selector
+    self.trackedToolToTrackerSelector = slicer.qMRMLNodeComboBox()
+    self.trackedToolToTrackerSelector.nodeTypes = ( ("vtkMRMLLinearTransformNode"), "" )
+    self.trackedToolToTrackerSelector.selectNodeUponCreation = False
+    self.trackedToolToTrackerSelector.addEnabled = False
+    self.trackedToolToTrackerSelector.removeEnabled = False
+    self.trackedToolToTrackerSelector.noneEnabled = False
+    self.trackedToolToTrackerSelector.showHidden = False
+    self.trackedToolToTrackerSelector.showChildNodeTypes = False
+    self.trackedToolToTrackerSelector.setMRMLScene( slicer.mrmlScene )
+    self.trackedToolToTrackerSelector.setToolTip( "Pick the tracker transform of the needle, e.g. Needle2ToTracker." )
+    parametersFormLayout.addRow("NeedleToTracker transform: ", self.trackedToolToTrackerSelector)
+
+    # Additional Needle TipToNeedle transform selector
+    self.trackedToolTipToToolSelector = slicer.qMRMLNodeComboBox()
+    self.trackedToolTipToToolSelector.nodeTypes = ( ("vtkMRMLLinearTransformNode"), "" )
+    self.trackedToolTipToToolSelector.selectNodeUponCreation = False
+    self.trackedToolTipToToolSelector.addEnabled = False
+    self.trackedToolTipToToolSelector.removeEnabled = False
+    self.trackedToolTipToToolSelector.noneEnabled = False
+    self.trackedToolTipToToolSelector.showHidden = False
+    self.trackedToolTipToToolSelector.showChildNodeTypes = False
+    self.trackedToolTipToToolSelector.setMRMLScene( slicer.mrmlScene )
+    self.trackedToolTipToToolSelector.setToolTip( "Pick the tip calibration of the needle, e.g. Needle2TipToNeedle2." )
+    parametersFormLayout.addRow("NeedleTipToNeedle transform: ", self.trackedToolTipToToolSelector)
+
+    # Additional Needle model selector
+    self.trackedToolModelSelector = slicer.qMRMLNodeComboBox()
+    self.trackedToolModelSelector.nodeTypes = ( ("vtkMRMLModelNode"), "" )
+    self.trackedToolModelSelector.selectNodeUponCreation = False
+    self.trackedToolModelSelector.addEnabled = False
+    self.trackedToolModelSelector.removeEnabled = False
+    self.trackedToolModelSelector.noneEnabled = True
+    self.trackedToolModelSelector.showHidden = False
+    self.trackedToolModelSelector.setMRMLScene( slicer.mrmlScene )
+    self.trackedToolModelSelector.setToolTip( "Optionally pick a model to show at the needle." )
+    parametersFormLayout.addRow("Needle model: ", self.trackedToolModelSelector)
+
+    # Add Needle Button
+    self.addTrackedToolButton = qt.QPushButton("Add Needle")
+    self.addTrackedToolButton.toolTip = "Track the needle together with the others. Its camera can be bound to a 3D view in Multiple Views."
+    parametersFormLayout.addRow(self.addTrackedToolButton)
+
+    # Remove Needle Button
+    self.removeTrackedToolButton = qt.QPushButton("Remove Needle")
+    self.removeTrackedToolButton.toolTip = "Stop tracking the needle of the selected NeedleToTracker transform."
+    parametersFormLayout.addRow(self.removeTrackedToolButton)
+
+    # Tracked Tool Distances Label
+    self.trackedToolDistancesLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("Distance to nearest target (mm): ", self.trackedToolDistancesLabel)
+
+    # Pivot Calibration Area
+    pivotCalibrationCollapsibleButton = ctk.ctkCollapsibleButton()
+    pivotCalibrationCollapsibleButton.text = "Pivot Calibration"
+    pivotCalibrationCollapsibleButton.collapsed = True
+    self.layout.addWidget(pivotCalibrationCollapsibleButton)   
+    parametersFormLayout = qt.QFormLayout(pivotCalibrationCollapsibleButton)
+
+    # Pivot Calibration Tool Selector
+    self.pivotCalibrationToolSelector = qt.QComboBox()
+    self.pivotCalibrationToolSelector.addItem("Needle")
+    self.pivotCalibrationToolSelector.addItem("Pointer")
+    self.pivotCalibrationToolSelector.toolTip = "Tool to calibrate. The result is written into the selected NeedleTipToNeedle or PointerTipToPointer transform."
+    parametersFormLayout.addRow("Tool: ", self.pivotCalibrationToolSelector)
+
+    # Pivot Calibration Button
+    self.pivotCalibrationButton = qt.QPushButton("Collect Pivot Samples")
+    self.pivotCalibrationButton.toolTip = "While checked, pivot the tool around its tip. Uncheck to compute and apply the calibration."
+    self.pivotCalibrationButton.enabled = True
+    self.pivotCalibrationButton.checkable = True
+    parametersFormLayout.addRow(self.pivotCalibrationButton)
+
+    # Pivot Calibration Error Label
+    self.pivotCalibrationErrorLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("Pivot RMS error (mm): ", self.pivotCalibrationErrorLabel)
+
+    # The solution is updated incrementally while collecting, the label is refreshed at a UI rate
+    self.pivotCalibrationTimer = qt.QTimer()
+    self.pivotCalibrationTimer.setInterval(250)
+
+    # Registration Area
+    registrationCollapsibleButton = ctk.ctkCollapsibleButton()
+    registrationCollapsibleButton.text = "Landmark Registration"
+    registrationCollapsibleButton.collapsed = True
+    self.layout.addWidget(registrationCollapsibleButton)   
+    parametersFormLayout = qt.QFormLayout(registrationCollapsibleButton)
+
+    # Registration Fiducial Selector
+    self.registrationFiducialSelector = qt.QComboBox()
+    self.registrationFiducialSelector.toolTip = "Fiducial of VirtualFiducials that is touched with the pointer."
+    parametersFormLayout.addRow("Fiducial: ", self.registrationFiducialSelector)
+
+    # Collect Fiducial Button
+    self.collectFiducialButton = qt.QPushButton("Collect Fiducial")
+    self.collectFiducialButton.toolTip = "While checked, pointer tip positions are collected for the selected fiducial."
+    self.collectFiducialButton.enabled = True
+    self.collectFiducialButton.checkable = True
+    parametersFormLayout.addRow(self.collectFiducialButton)
+
+    # Register Button
+    self.registerButton = qt.QPushButton("Compute PatientToReference")
+    self.registerButton.toolTip = "Compute the registration from the collected fiducials and store it in the selected PatientToReference transform."
+    self.registerButton.enabled = True
+    parametersFormLayout.addRow(self.registerButton)
+
+    # Registration Error Label
+    self.registrationErrorLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("FRE (mm): ", self.registrationErrorLabel)
+
+    # Collect Surface Points Button
+    self.collectSurfacePointsButton = qt.QPushButton("Collect Surface Points")
+    self.collectSurfacePointsButton.toolTip = "While checked, pointer tip positions are collected while the pointer is swept over the exposed bone."
+    self.collectSurfacePointsButton.enabled = True
+    self.collectSurfacePointsButton.checkable = True
+    parametersFormLayout.addRow(self.collectSurfacePointsButton)
+
+    # Refine Registration Button
+    self.refineRegistrationButton = qt.QPushButton("Refine PatientToReference (ICP)")
+    self.refineRegistrationButton.toolTip = "Refine the selected PatientToReference transform by matching the collected surface points to BoneModel."
+    self.refineRegistrationButton.enabled = True
+    parametersFormLayout.addRow(self.refineRegistrationButton)
+
+    # Surface Registration Error Label
+    self.surfaceRegistrationErrorLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("ICP RMS (mm): ", self.surfaceRegistrationErrorLabel)
+
+    # Recording Area
+    recordingCollapsibleButton = ctk.ctkCollapsibleButton()
+    recordingCollapsibleButton.text = "Recording"
+    recordingCollapsibleButton.collapsed = True
+    self.layout.addWidget(recordingCollapsibleButton)   
+    parametersFormLayout = qt.QFormLayout(recordingCollapsibleButton)
+
+    # Record Tracking Button
+    self.recordTrackingButton = qt.QPushButton("Record Tracking Data")
+    self.recordTrackingButton.toolTip = "Record the NeedleToTracker, PointerToTracker and ReferenceToTracker transforms."
+    self.recordTrackingButton.enabled = True
+    self.recordTrackingButton.checkable = True
+    parametersFormLayout.addRow(self.recordTrackingButton)
+
+    # Save Recording Button
+    self.saveRecordingButton = qt.QPushButton("Save Recording")
+    self.saveRecordingButton.toolTip = "Save the recorded tracking data to a NumPy .npz file."
+    self.saveRecordingButton.enabled = False
+    parametersFormLayout.addRow(self.saveRecordingButton)
+
+    # Replay As Fast As Possible Checkbox
+    self.replayAsFastAsPossibleCheckBox = qt.QCheckBox("Replay as fast as possible")
+    self.replayAsFastAsPossibleCheckBox.toolTip = "If checked, the recording is replayed without waiting and the throughput of each stage is reported. Otherwise the original timing is kept."
+    self.replayAsFastAsPossibleCheckBox.checked = False
+    parametersFormLayout.addRow(self.replayAsFastAsPossibleCheckBox)
+
+    # Replay Recording Button
+    self.replayRecordingButton = qt.QPushButton("Replay Recording")
+    self.replayRecordingButton.toolTip = "Write recorded tracking data back into the transform nodes."
+    self.replayRecordingButton.enabled = True
+    parametersFormLayout.addRow(self.replayRecordingButton)
+
+    # Replay Statistics Label
+    self.replayStatisticsLabel = qt.QLabel('-')
+    parametersFormLayout.addRow('Replay throughput: ', self.replayStatisticsLabel)
+
+    # Profiling Area
+    profilingCollapsibleButton = ctk.ctkCollapsibleButton()
+    profilingCollapsibleButton.text = "Profiling"
+    profilingCollapsibleButton.collapsed = True
+    self.layout.addWidget(profilingCollapsibleButton)   
+    parametersFormLayout = qt.QFormLayout(profilingCollapsibleButton)
+
+    # Enable Profiling Checkbox
+    self.profilingCheckBox = qt.QCheckBox("Profile observer callbacks")
+    self.profilingCheckBox.toolTip = "Record the call count and execution time of every observer callback of the navigation and viewpoint logic."
+    self.profilingCheckBox.checked = False
+    parametersFormLayout.addRow(self.profilingCheckBox)
+
+    # Profiling Table
+    self.profilingTable = qt.QTableWidget()
+    self.profilingTable.setColumnCount(5)
+    self.profilingTable.setHorizontalHeaderLabels(['Callback', 'Calls', 'Total (ms)', 'Mean (ms)', 'Max (ms)'])
+    self.profilingTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.profilingTable.horizontalHeader().setStretchLastSection(True)
+    parametersFormLayout.addRow(self.profilingTable)
+
+    # Renders Per Frame Label
+    self.rendersPerFrameLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("Renders per tracker frame: ", self.rendersPerFrameLabel)
+
+    # Pose Cache Label
+    self.poseCacheLabel = qt.QLabel('-')
+    parametersFormLayout.addRow("Pose cache: ", self.poseCacheLabel)
+
+    # Reset Profiling Button
+    self.resetProfilingButton = qt.QPushButton("Reset")
+    self.resetProfilingButton.toolTip = "Clear the recorded callback statistics."
+    parametersFormLayout.addRow(self.resetProfilingButton)
+
+    # Export Profiling Button
+    self.exportProfilingButton = qt.QPushButton("Export CSV")
+    self.exportProfilingButton.toolTip = "Save the callback statistics, including the execution time histograms, as a CSV file."
+    parametersFormLayout.addRow(self.exportProfilingButton)
+
+    self.profilingTimer = qt.QTimer()
+    self.profilingTimer.setInterval(1000)
+
     # connections
     self.pointerTipToPointerSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectForRegistration)
     self.needleTipToNeedleSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectForRegistration)
@@ -191,50 +546,109 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
     self.softTissueVisibilityButton.connect('clicked(bool)', self.onSoftTissueVisibilityButtonClicked)
     self.boneVisibilityButton.connect('clicked(bool)', self.onBoneVisibilityButtonClicked)
     self.calculateDistanceButton.connect('clicked(bool)', self.onCalculateDistanceClicked)
+    self.boneSurfaceDistanceCheckBox.connect('toggled(bool)', self.onBoneSurfaceDistanceToggled)
+    self.trajectoryForecastCheckBox.connect('toggled(bool)', self.onTrajectoryForecastToggled)
     self.needleViewpointButton.connect('clicked(bool)', self.onNeedleViewpointButtonClicked)
     self.pointerViewpointButton.connect('clicked(bool)', self.onPointerViewpointButtonClicked)
+    self.levelOfDetailCheckBox.connect('toggled(bool)', self.onLevelOfDetailToggled)
+    self.latencyCompensationCheckBox.connect('toggled(bool)', self.onLatencyCompensationToggled)
+    self.predictionHorizonSpinBox.connect('valueChanged(int)', self.onPredictionHorizonChanged)
+    self.predictionErrorTimer.connect('timeout()', self.updatePredictionErrorLabel)
+    self.collectFiducialButton.connect('clicked(bool)', self.onCollectFiducialClicked)
+    self.registerButton.connect('clicked(bool)', self.onRegisterClicked)
+    self.collectSurfacePointsButton.connect('clicked(bool)', self.onCollectSurfacePointsClicked)
+    self.pivotCalibrationButton.connect('clicked(bool)', self.onPivotCalibrationClicked)
+    self.pivotCalibrationTimer.connect('timeout()', self.updatePivotCalibrationLabel)
+    self.refineRegistrationButton.connect('clicked(bool)', self.onRefineRegistrationClicked)
+    self.recordTrackingButton.connect('clicked(bool)', self.onRecordTrackingClicked)
+    self.saveRecordingButton.connect('clicked(bool)', self.onSaveRecordingClicked)
+    self.replayRecordingButton.connect('clicked(bool)', self.onReplayRecordingClicked)
+    self.profilingCheckBox.connect('toggled(bool)', self.onProfilingToggled)
+    self.dualThreeDLayoutButton.connect('clicked(bool)', self.onDualThreeDLayoutClicked)
+    self.bindViewButton.connect('clicked(bool)', self.onBindViewClicked)
+    self.unbindViewButton.connect('clicked(bool)', self.onUnbindViewClicked)
+    self.addTrackedToolButton.connect('clicked(bool)', self.onAddTrackedToolClicked)
+    self.removeTrackedToolButton.connect('clicked(bool)', self.onRemoveTrackedToolClicked)
+    self.frameBatchingCheckBox.connect('toggled(bool)', self.onFrameBatchingToggled)
+    self.cachedClippingRangeCheckBox.connect('toggled(bool)', self.onCachedClippingRangeToggled)
+    self.needleSliceReslicingCheckBox.connect('toggled(bool)', self.onNeedleSliceReslicingToggled)
+    self.needleSliceReslicingRateSpinBox.connect('valueChanged(int)', self.onNeedleSliceReslicingRateChanged)
+    self.resetProfilingButton.connect('clicked(bool)', self.onResetProfilingClicked)
+    self.exportProfilingButton.connect('clicked(bool)', self.onExportProfilingClicked)
+    self.profilingTimer.connect('timeout()', self.updateProfilingTable)
     
     # Add vertical spacer
     self.layout.addStretch(1)
 
     # Load models
+    # Models that are not in the scene yet are read (or taken from the preprocessed cache) in the background
+    # and added to the scene as soon as they are ready, so that setup does not block
     PercutaneousNavigationModuleDataPath = slicer.modules.percutaneousnavigation.path.replace("PercutaneousNavigation.py","") + 'Resources/Models/'
-    self.boneModel = slicer.util.getNode('BoneModel')
-    if not self.boneModel:
-        slicer.util.loadModel(PercutaneousNavigationModuleDataPath + 'BoneModel.stl')
-        self.boneModel = slicer.util.getNode(pattern="BoneModel")
-        self.boneModelDisplay=self.boneModel.GetModelDisplayNode()
-        self.boneModelDisplay.SetColor([1,1,1])
+    self.modelLoader = ModelLoader()
+    # Controls that need a model stay disabled until it is in the scene, a missing model file keeps them disabled
+    self.modelDependentControls = [
+      (self.softTissueVisibilityButton, ['softTissueModel']),
+      (self.boneVisibilityButton, ['boneModel']),
+      (self.boneSurfaceDistanceCheckBox, ['boneModel']),
+      (self.trajectoryForecastCheckBox, ['boneModel', 'softTissueModel']),
+      (self.needleViewpointButton, ['needleModel']),
+      (self.pointerViewpointButton, ['pointerModel']),
+      (self.levelOfDetailCheckBox, ['boneModel', 'softTissueModel']),
+      (self.collectSurfacePointsButton, ['boneModel'])]
+    for control, modelAttributeNames in self.modelDependentControls:
+      control.enabled = False
+    modelColors = [('BoneModel', [1,1,1]), ('SoftTissueModel', [1,0.7,0.53]), ('NeedleModel', [0,1,1]), ('PointerModel', [0,0,0])]
+    for modelName, modelColor in modelColors:
+      modelNode = self.nodeRegistry.getNode(modelName)
+      if modelNode:
+        self.onModelLoaded(modelNode)
+      else:
+        self.setModelAttributes(modelName, None)
+        self.modelLoader.addModel(modelName, PercutaneousNavigationModuleDataPath + modelName + '.stl', modelColor)
+    self.modelLoader.start(self.onModelLoaded, self.onAllModelsLoaded)
 
-    self.softTissueModel = slicer.util.getNode('SoftTissueModel')
-    if not self.softTissueModel:
-        slicer.util.loadModel(PercutaneousNavigationModuleDataPath + 'SoftTissueModel.stl')
-        self.softTissueModel = slicer.util.getNode(pattern="SoftTissueModel")
-        self.softTissueModelDisplay=self.softTissueModel.GetModelDisplayNode()
-        self.softTissueModelDisplay.SetColor([1,0.7,0.53])
-
-    self.needleModel = slicer.util.getNode('NeedleModel')
-    if not self.needleModel:
-        slicer.util.loadModel(PercutaneousNavigationModuleDataPath + 'NeedleModel.stl')
-        self.needleModel = slicer.util.getNode(pattern="NeedleModel")
-        self.needleModelDisplay=self.needleModel.GetModelDisplayNode()
-        self.needleModelDisplay.SetColor([0,1,1])
-
-    self.pointerModel = slicer.util.getNode('PointerModel')
-    if not self.pointerModel:
-        slicer.util.loadModel(PercutaneousNavigationModuleDataPath + 'PointerModel.stl')
-        self.pointerModel = slicer.util.getNode(pattern="PointerModel")
-        self.pointerModelDisplay=self.pointerModel.GetModelDisplayNode()
-        self.pointerModelDisplay.SetColor([0,0,0])
+  def setModelAttributes(self, modelName, modelNode):
+    # e.g. BoneModel -> self.boneModel, self.boneModelDisplay
+    attributeName = modelName[0].lower() + modelName[1:]
+    setattr(self, attributeName, modelNode)
+    setattr(self, attributeName + 'Display', modelNode.GetModelDisplayNode() if modelNode else None)
+
+  def onModelLoaded(self, modelNode):
+    self.setModelAttributes(modelNode.GetName(), modelNode)
+
+  def hasModels(self, modelAttributeNames=('boneModel', 'softTissueModel', 'pointerModel', 'needleModel')):
+    for modelAttributeName in modelAttributeNames:
+      if getattr(self, modelAttributeName, None) is None:
+        return False
+    return True
+
+  def onAllModelsLoaded(self):
+    # Spatial search trees for the trajectory forecast are built once, right after the models are loaded
+    self.PercutaneousNavigationLogic.setTrajectoryModels([self.boneModel, self.softTissueModel])
+    for control, modelAttributeNames in self.modelDependentControls:
+      control.enabled = self.hasModels(modelAttributeNames)
+    if not self.hasModels():
+      logging.error('Not all models could be loaded, the controls that need them stay disabled')
+    # Transforms may have been selected while the models were loading
+    if self.pointerTipToPointerSelector.enabled:
+      self.onSelectForRegistration()
+    if self.patientToReferenceSelector.enabled and self.patientToReferenceSelector.currentNode():
+      self.onSelectForNavigation()
     
   def cleanup(self):
-    pass
+    self.predictionErrorTimer.stop()
+    self.pivotCalibrationTimer.stop()
+    self.profilingTimer.stop()
+    self.PercutaneousNavigationLogic.stopNeedleSliceReslicing()
+    self.modelLoader.stop()
+    self.PercutaneousNavigationLogic.surfaceRegistration.cancel()
+    self.nodeRegistry.removeObservers()
 
   def onSelectForRegistration(self):
-    self.applyTransformsForRegistrationButton.enabled = self.pointerTipToPointerSelector.currentNode() and self.needleTipToNeedleSelector.currentNode() 
+    self.applyTransformsForRegistrationButton.enabled = self.pointerTipToPointerSelector.currentNode() and self.needleTipToNeedleSelector.currentNode() and self.hasModels()
   
   def onSelectForNavigation(self):
-    self.applyTransformsForNavigationButton.enabled = True
+    self.applyTransformsForNavigationButton.enabled = self.hasModels()
 
   def onApplyTransformsForRegistrationClicked(self):
     self.pointerTipToPointerSelector.enabled = False
@@ -249,27 +663,32 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
     self.PercutaneousNavigationLogic.buildTransformTreeForNavigation(self.boneModel, self.softTissueModel, self.pointerModel, self.needleModel, self.referenceToTrackerTransform, self.pointerToTrackerTransform, self.pointerTipToPointerSelector.currentNode(), self.needleToTrackerTransform, self.needleTipToNeedleSelector.currentNode(),self.patientToReferenceSelector.currentNode())
   
   def onSoftTissueVisibilityButtonClicked(self):
+    if not self.softTissueModel:
+      return
     if self.softTissueVisibilityButtonState == 0:
-          self.softTissueModelDisplay.VisibilityOff()
+          self.PercutaneousNavigationLogic.setModelVisibility(self.softTissueModel, False)
           self.softTissueVisibilityButtonState = 1
           self.softTissueVisibilityButton.setText(self.softTissueVisibilityButtonStateText1)
     else: 
-          self.softTissueModelDisplay.VisibilityOn()
+          self.PercutaneousNavigationLogic.setModelVisibility(self.softTissueModel, True)
           self.softTissueVisibilityButtonState = 0
           self.softTissueVisibilityButton.setText(self.softTissueVisibilityButtonStateText0)
 
   def onBoneVisibilityButtonClicked(self):
+    if not self.boneModel:
+      return
     if self.boneVisibilityButtonState == 0:
-          self.boneModelDisplay.VisibilityOff()
+          self.PercutaneousNavigationLogic.setModelVisibility(self.boneModel, False)
           self.boneVisibilityButtonState = 1
           self.boneVisibilityButton.setText(self.boneVisibilityButtonStateText1)
     else: 
-          self.boneModelDisplay.VisibilityOn()
+          self.PercutaneousNavigationLogic.setModelVisibility(self.boneModel, True)
           self.boneVisibilityButtonState = 0
           self.boneVisibilityButton.setText(self.boneVisibilityButtonStateText0)
           
   def onCalculateDistanceClicked(self):
     self.PercutaneousNavigationLogic.setOutPutDistanceLabel(self.calculateDistanceLabel)
+    self.PercutaneousNavigationLogic.setOutputNearestTargetLabel(self.nearestTargetLabel)
     if self.calculateDistanceButton.checked:
       self.PercutaneousNavigationLogic.transformTargetFiducial(self.patientToReferenceSelector.currentNode(), self.referenceToTrackerTransform)
       self.PercutaneousNavigationLogic.SetMembers(self.needleTipToNeedleSelector.currentNode(), self.needleToTrackerTransform)
@@ -279,6 +698,19 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
       self.PercutaneousNavigationLogic.removeCalculateDistanceObserver()
       # slicer.mrmlScene.RemoveNode(self.PercutaneousNavigationLogic.line) 
 
+  def onBoneSurfaceDistanceToggled(self, checked):
+    self.PercutaneousNavigationLogic.setOutputBoneSurfaceDistanceLabel(self.boneSurfaceDistanceLabel)
+    self.PercutaneousNavigationLogic.setBoneSurfaceModel(self.boneModel)
+    self.PercutaneousNavigationLogic.setBoneSurfaceDistanceEnabled(checked)
+    if not checked:
+      self.boneSurfaceDistanceLabel.setText('-')
+
+  def onTrajectoryForecastToggled(self, checked):
+    self.PercutaneousNavigationLogic.setOutputTrajectoryLabel(self.trajectoryForecastLabel)
+    self.PercutaneousNavigationLogic.setTrajectoryForecastEnabled(checked)
+    if not checked:
+      self.trajectoryForecastLabel.setText('-')
+
   def onNeedleViewpointButtonClicked(self):
     if self.enableNeedleViewpointButtonState == 0:
           self.pointerViewpointButton.enabled = False
@@ -287,7 +719,7 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
           self.enableNeedleViewpointButtonState = 1
           self.needleViewpointButton.setText(self.enableNeedleViewpointButtonTextState1)
     else: 
-          self.pointerViewpointButton.enabled = True
+          self.pointerViewpointButton.enabled = self.pointerModel is not None
           self.PercutaneousNavigationLogic.StopViewpoint()
           self.enableNeedleViewpointButtonState = 0
           self.needleViewpointButton.setText(self.enableNeedleViewpointButtonTextState0)
@@ -300,11 +732,238 @@ class PercutaneousNavigationWidget(ScriptedLoadableModuleWidget):
           self.enablePointerViewpointButtonState = 1
           self.pointerViewpointButton.setText(self.enablePointerViewpointButtonTextState1)
     else: 
-          self.needleViewpointButton.enabled = True
+          self.needleViewpointButton.enabled = self.needleModel is not None
           self.PercutaneousNavigationLogic.StopViewpoint()
           self.enablePointerViewpointButtonState = 0
           self.pointerViewpointButton.setText(self.enablePointerViewpointButtonTextState0)
 
+  def onLevelOfDetailToggled(self, checked):
+    self.PercutaneousNavigationLogic.setLevelOfDetailEnabled(checked, [self.boneModel, self.softTissueModel])
+
+  def onLatencyCompensationToggled(self, checked):
+    if checked:
+      self.PercutaneousNavigationLogic.startPosePrediction([self.needleToTrackerTransform, self.pointerToTrackerTransform], self.predictionHorizonSpinBox.value / 1000.0)
+      self.predictionErrorTimer.start()
+    else:
+      self.predictionErrorTimer.stop()
+      self.PercutaneousNavigationLogic.stopPosePrediction()
+      self.predictionErrorLabel.setText('-')
+
+  def onPredictionHorizonChanged(self, horizonMs):
+    self.PercutaneousNavigationLogic.setPosePredictionHorizonSec(horizonMs / 1000.0)
+
+  def updatePredictionErrorLabel(self):
+    statistics = self.PercutaneousNavigationLogic.getPosePredictionStatistics()
+    self.predictionErrorLabel.setText(', '.join(['%s %.2f (without %.2f)' % (nodeName, statistics[nodeName]['rmsErrorMm'], statistics[nodeName]['rmsUncompensatedErrorMm']) for nodeName in sorted(statistics)]))
+
+  def onCollectFiducialClicked(self):
+    if self.collectFiducialButton.checked:
+      virtualFiducials = self.nodeRegistry.getNode('VirtualFiducials')
+      if not virtualFiducials:
+        PercutaneousNavigationModuleDataPath = slicer.modules.percutaneousnavigation.path.replace("PercutaneousNavigation.py","") + 'Resources/Data/'
+        slicer.util.loadMarkupsFiducialList(PercutaneousNavigationModuleDataPath + 'VirtualFiducials.fcsv')
+        virtualFiducials = self.nodeRegistry.getNode('VirtualFiducials')
+      if not virtualFiducials:
+        logging.error('VirtualFiducials.fcsv could not be loaded')
+        self.registrationErrorLabel.setText('VirtualFiducials could not be loaded')
+        self.collectFiducialButton.checked = False
+        return
+      if self.registrationFiducialSelector.count != virtualFiducials.GetNumberOfFiducials():
+        self.PercutaneousNavigationLogic.setRegistrationFiducials(virtualFiducials, self.pointerTipToPointerSelector.currentNode(), self.pointerToTrackerTransform, self.referenceToTrackerTransform)
+        self.registrationFiducialSelector.clear()
+        for fiducialIndex in range(virtualFiducials.GetNumberOfFiducials()):
+          self.registrationFiducialSelector.addItem(virtualFiducials.GetNthFiducialLabel(fiducialIndex))
+      self.registrationFiducialSelector.enabled = False
+      self.PercutaneousNavigationLogic.startCollectingFiducial(self.registrationFiducialSelector.currentIndex)
+    else:
+      self.PercutaneousNavigationLogic.stopCollectingFiducial()
+      self.registrationFiducialSelector.enabled = True
+      self.registrationFiducialSelector.setCurrentIndex((self.registrationFiducialSelector.currentIndex + 1) % self.registrationFiducialSelector.count)
+
+  def onRegisterClicked(self):
+    patientToReference = self.patientToReferenceSelector.currentNode()
+    if not patientToReference:
+      patientToReference = slicer.vtkMRMLLinearTransformNode()
+      patientToReference.SetName('PatientToReference')
+      slicer.mrmlScene.AddNode(patientToReference)
+      self.patientToReferenceSelector.setCurrentNode(patientToReference)
+    fiducialRegistrationError = self.PercutaneousNavigationLogic.registerPatientToReference(patientToReference)
+    self.registrationErrorLabel.setText('%.2f' % fiducialRegistrationError if fiducialRegistrationError is not None else 'At least 3 fiducials are needed')
+
+  def getPivotCalibrationNodes(self):
+    if self.pivotCalibrationToolSelector.currentText == "Needle":
+      return self.needleToTrackerTransform, self.needleTipToNeedleSelector.currentNode()
+    return self.pointerToTrackerTransform, self.pointerTipToPointerSelector.currentNode()
+
+  def onPivotCalibrationClicked(self):
+    toolToTrackerTransform, toolTipToToolTransform = self.getPivotCalibrationNodes()
+    if self.pivotCalibrationButton.checked:
+      self.pivotCalibrationToolSelector.enabled = False
+      self.PercutaneousNavigationLogic.startPivotCalibration(toolToTrackerTransform)
+      self.pivotCalibrationTimer.start()
+    else:
+      self.pivotCalibrationTimer.stop()
+      self.pivotCalibrationToolSelector.enabled = True
+      if not toolTipToToolTransform:
+        self.PercutaneousNavigationLogic.pivotCalibration.stop()
+        self.pivotCalibrationErrorLabel.setText('Select the tip transform first')
+        return
+      result = self.PercutaneousNavigationLogic.stopPivotCalibration(toolTipToToolTransform)
+      if result:
+        self.pivotCalibrationErrorLabel.setText('%.2f (%d of %d samples used)' % (result['rmsErrorMm'], result['inliers'], result['samples']))
+      else:
+        self.pivotCalibrationErrorLabel.setText('Calibration failed, pivot over a wider range')
+
+  def updatePivotCalibrationLabel(self):
+    result = self.PercutaneousNavigationLogic.getPivotCalibrationResult()
+    if result:
+      self.pivotCalibrationErrorLabel.setText('%.2f (%d samples)' % (result['rmsErrorMm'], result['samples']))
+    else:
+      self.pivotCalibrationErrorLabel.setText('Collecting, %d samples' % self.PercutaneousNavigationLogic.pivotCalibration.numberOfSamples)
+
+  def onCollectSurfacePointsClicked(self):
+    if self.collectSurfacePointsButton.checked:
+      self.refineRegistrationButton.enabled = False
+      self.PercutaneousNavigationLogic.setSurfaceRegistrationNodes(self.boneModel, self.pointerTipToPointerSelector.currentNode(), self.pointerToTrackerTransform, self.referenceToTrackerTransform)
+      self.PercutaneousNavigationLogic.clearSurfacePoints()
+      self.PercutaneousNavigationLogic.startCollectingSurfacePoints()
+    else:
+      self.PercutaneousNavigationLogic.stopCollectingSurfacePoints()
+      self.refineRegistrationButton.enabled = True
+      self.surfaceRegistrationErrorLabel.setText('%d points collected' % self.PercutaneousNavigationLogic.surfaceRegistration.getNumberOfSamples())
+
+  def onRefineRegistrationClicked(self):
+    patientToReference = self.patientToReferenceSelector.currentNode()
+    if not patientToReference:
+      self.surfaceRegistrationErrorLabel.setText('Select or compute PatientToReference first')
+      return
+    if self.PercutaneousNavigationLogic.refinePatientToReference(patientToReference, self.onSurfaceRegistrationIteration, self.onSurfaceRegistrationFinished):
+      self.refineRegistrationButton.enabled = False
+      self.collectSurfacePointsButton.enabled = False
+
+  def onSurfaceRegistrationIteration(self, iteration, rmsMm, numberOfInliers):
+    self.surfaceRegistrationErrorLabel.setText('%.2f (iteration %d, %d inliers)' % (rmsMm, iteration + 1, numberOfInliers))
+
+  def onSurfaceRegistrationFinished(self, success):
+    self.refineRegistrationButton.enabled = True
+    self.collectSurfacePointsButton.enabled = self.boneModel is not None
+    if not success:
+      self.surfaceRegistrationErrorLabel.setText('Registration failed')
+
+  def onRecordTrackingClicked(self):
+    if self.recordTrackingButton.checked:
+      self.saveRecordingButton.enabled = False
+      self.PercutaneousNavigationLogic.startTrackingRecording([self.needleToTrackerTransform, self.pointerToTrackerTransform, self.referenceToTrackerTransform])
+    else:
+      self.PercutaneousNavigationLogic.stopTrackingRecording()
+      self.saveRecordingButton.enabled = True
+
+  def onSaveRecordingClicked(self):
+    fileName = qt.QFileDialog.getSaveFileName(None, "Save Recording", "", "NumPy archive (*.npz)")
+    if fileName:
+      self.PercutaneousNavigationLogic.saveTrackingRecording(fileName)
+
+  def onReplayRecordingClicked(self):
+    fileName = qt.QFileDialog.getOpenFileName(None, "Replay Recording", "", "NumPy archive (*.npz)")
+    if not fileName:
+      return
+    statistics = self.PercutaneousNavigationLogic.replayTrackingRecording(fileName, not self.replayAsFastAsPossibleCheckBox.checked)
+    if statistics:
+      self.replayStatisticsLabel.setText('%.0f samples/s (transform %.0f/s, camera %.0f/s)' % (statistics['samplesPerSec'], statistics['transformPerSec'], statistics['cameraPerSec']))
+
+  def onProfilingToggled(self, checked):
+    self.PercutaneousNavigationLogic.callbackProfiler.setEnabled(checked)
+    if checked:
+      self.profilingTimer.start()
+    else:
+      self.profilingTimer.stop()
+      self.updateProfilingTable()
+
+  def onDualThreeDLayoutClicked(self):
+    slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutDual3DView)
+
+  def onBindViewClicked(self):
+    viewNode = self.boundViewSelector.currentNode()
+    if not viewNode:
+      return
+    camera = self.boundViewCameraSelector.currentText
+    if camera == "Needle":
+      self.PercutaneousNavigationLogic.bindViewToTool(viewNode, self.needleToTrackerTransform, self.PercutaneousNavigationLogic.needleCameraToNeedle)
+    elif camera == "Pointer":
+      self.PercutaneousNavigationLogic.bindViewToTool(viewNode, self.pointerToTrackerTransform, self.PercutaneousNavigationLogic.pointerCameraToPointer)
+    elif camera == "Overview":
+      self.PercutaneousNavigationLogic.bindViewToTool(viewNode, None, None)
+    else:
+      self.PercutaneousNavigationLogic.bindViewToTrackedTool(viewNode, camera)
+
+  def onUnbindViewClicked(self):
+    viewNode = self.boundViewSelector.currentNode()
+    if viewNode:
+      self.PercutaneousNavigationLogic.unbindView(viewNode)
+
+  def onAddTrackedToolClicked(self):
+    toolToTrackerTransform = self.trackedToolToTrackerSelector.currentNode()
+    toolTipToToolTransform = self.trackedToolTipToToolSelector.currentNode()
+    if not toolToTrackerTransform or not toolTipToToolTransform:
+      return
+    # e.g. Needle2ToTracker -> Needle2
+    toolName = toolToTrackerTransform.GetName().replace('ToTracker', '')
+    if not self.PercutaneousNavigationLogic.addTrackedTool(toolName, self.trackedToolModelSelector.currentNode(), toolToTrackerTransform, toolTipToToolTransform):
+      return
+    self.PercutaneousNavigationLogic.setOutputTrackedToolDistancesLabel(self.trackedToolDistancesLabel)
+    if self.boundViewCameraSelector.findText(toolName) < 0:
+      self.boundViewCameraSelector.addItem(toolName)
+
+  def onRemoveTrackedToolClicked(self):
+    toolToTrackerTransform = self.trackedToolToTrackerSelector.currentNode()
+    if not toolToTrackerTransform:
+      return
+    toolName = toolToTrackerTransform.GetName().replace('ToTracker', '')
+    if self.PercutaneousNavigationLogic.removeTrackedTool(toolName):
+      self.boundViewCameraSelector.removeItem(self.boundViewCameraSelector.findText(toolName))
+
+  def onNeedleSliceReslicingToggled(self, checked):
+    if checked:
+      needleTipToNeedle = self.needleTipToNeedleSelector.currentNode()
+      if not needleTipToNeedle:
+        self.needleSliceReslicingCheckBox.checked = False
+        return
+      self.PercutaneousNavigationLogic.setNeedleSliceReslicingRateHz(self.needleSliceReslicingRateSpinBox.value)
+      self.PercutaneousNavigationLogic.startNeedleSliceReslicing(needleTipToNeedle)
+    else:
+      self.PercutaneousNavigationLogic.stopNeedleSliceReslicing()
+
+  def onNeedleSliceReslicingRateChanged(self, rateHz):
+    self.PercutaneousNavigationLogic.setNeedleSliceReslicingRateHz(rateHz)
+
+  def onCachedClippingRangeToggled(self, checked):
+    self.PercutaneousNavigationLogic.setCachedClippingRangeEnabled(checked)
+
+  def onFrameBatchingToggled(self, checked):
+    self.PercutaneousNavigationLogic.setFrameBatchingEnabled(checked)
+
+  def onResetProfilingClicked(self):
+    self.PercutaneousNavigationLogic.callbackProfiler.reset()
+    self.PercutaneousNavigationLogic.frameTransaction.resetStatistics()
+    self.updateProfilingTable()
+
+  def onExportProfilingClicked(self):
+    fileName = qt.QFileDialog.getSaveFileName(None, "Export Callback Profile", "", "CSV file (*.csv)")
+    if fileName:
+      self.PercutaneousNavigationLogic.callbackProfiler.exportToCsv(fileName)
+
+  def updateProfilingTable(self):
+    statisticsList = self.PercutaneousNavigationLogic.callbackProfiler.getStatistics()
+    self.profilingTable.setRowCount(len(statisticsList))
+    for row, statistics in enumerate(statisticsList):
+      values = [statistics['name'], '%d' % statistics['count'], '%.1f' % statistics['totalMs'], '%.3f' % statistics['meanMs'], '%.3f' % statistics['maxMs']]
+      for column, value in enumerate(values):
+        self.profilingTable.setItem(row, column, qt.QTableWidgetItem(value))
+    renderStatistics = self.PercutaneousNavigationLogic.getRenderStatistics()
+    self.rendersPerFrameLabel.setText('%.2f (%d renders, %d frames)' % (renderStatistics['rendersPerFrame'], renderStatistics['renders'], renderStatistics['frames']))
+    poseCacheStatistics = self.PercutaneousNavigationLogic.getPoseCacheStatistics()
+    self.poseCacheLabel.setText('%d poses computed for %d requests' % (poseCacheStatistics['computations'], poseCacheStatistics['requests']))
+
       
 #
 # PercutaneousNavigationLogic
@@ -320,7 +979,16 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
   def __init__(self):
-    self.toolTipToTool = slicer.util.getNode('toolTipToTool')
+    import Viewpoint # Viewpoint Module must have been added to Slicer 
+
+    # Observer callbacks of this logic and of its viewpoint logic share one profiler, disabled by default
+    self.callbackProfiler = Viewpoint.CallbackProfiler()
+    self.callbackProfiler.instrumentMethods(self, ['calculateCallback', 'onTargetFiducialModified'])
+
+    # Nodes are looked up by name only once, then by ID
+    self.nodeRegistry = NodeRegistry(callbackProfiler=self.callbackProfiler)
+
+    self.toolTipToTool = self.nodeRegistry.getNode('toolTipToTool')
     if not self.toolTipToTool:
       self.toolTipToTool=slicer.vtkMRMLLinearTransformNode()
       self.toolTipToTool.SetName("toolTipToTool")
@@ -340,7 +1008,7 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
       self.toolTipToTool.SetMatrixTransformToParent(m)
       slicer.mrmlScene.AddNode(self.toolTipToTool)
 
-    self.toolToReference = slicer.util.getNode('toolToReference')
+    self.toolToReference = self.nodeRegistry.getNode('toolToReference')
     if not self.toolToReference:
       self.toolToReference=slicer.vtkMRMLLinearTransformNode()
       self.toolToReference.SetName("toolToReference")
@@ -360,7 +1028,7 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
       self.toolToReference.SetMatrixTransformToParent(matrixRef)
       slicer.mrmlScene.AddNode(self.toolToReference)
    
-    self.tipFiducial = slicer.util.getNode('Tip')
+    self.tipFiducial = self.nodeRegistry.getNode('Tip')
     if not self.tipFiducial:
       self.tipFiducial = slicer.vtkMRMLMarkupsFiducialNode()  
       self.tipFiducial.SetName('Tip')
@@ -372,7 +1040,7 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
       self.tipFiducial.GetDisplayNode().SetTextScale(1.3)
       self.tipFiducial.GetDisplayNode().SetSelectedColor(1,1,1)
 
-    self.targetFiducial = slicer.util.getNode('Target')
+    self.targetFiducial = self.nodeRegistry.getNode('Target')
     if not self.targetFiducial:
       self.targetFiducial = slicer.vtkMRMLMarkupsFiducialNode()  
       self.targetFiducial.SetName('Target')
@@ -383,8 +1051,20 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
       self.targetFiducial.GetDisplayNode().SetGlyphType(1) # Vertex2D
       self.targetFiducial.GetDisplayNode().SetTextScale(1.3)
       self.targetFiducial.GetDisplayNode().SetSelectedColor(1,1,1)
+
+    # Target positions are cached in world coordinates and refreshed only when the markups or their transform change
+    self.targetPositionsInWorld = np.zeros((0, 3))
+    self.targetLabels = []
+    self.targetDistances = np.zeros(0)
+    self.targetOrder = np.zeros(0, dtype=int)
+    self.nearestTargetIndex = -1
+    self.targetPositionsModified = True
+    self.targetToWorldMatrix = vtk.vtkMatrix4x4()
+    self.targetFiducialObserverTags = []
+    for event in [vtk.vtkCommand.ModifiedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, slicer.vtkMRMLTransformableNode.TransformModifiedEvent]:
+      self.targetFiducialObserverTags.append(self.targetFiducial.AddObserver(event, self.onTargetFiducialModified))
       
-    self.line = slicer.util.getNode('Line')
+    self.line = self.nodeRegistry.getNode('Line')
     if not self.line:
       self.line = slicer.vtkMRMLModelNode()
       self.line.SetName('Line')
@@ -396,10 +1076,39 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
       slicer.mrmlScene.AddNode(modelDisplay)      
       self.line.SetAndObserveDisplayNodeID(modelDisplay.GetID())      
       slicer.mrmlScene.AddNode(self.line)
+    self.initializeLineGeometry()
       
     # VTK objects
     self.transformPolyDataFilter = vtk.vtkTransformPolyDataFilter()
     self.cellLocator = vtk.vtkCellLocator()
+
+    # Bone surface distance: the locator is built on the bone mesh in model coordinates
+    # and the tip is transformed into model coordinates each frame
+    self.boneSurfaceModel = None
+    self.boneSurfaceDistanceEnabled = False
+    self.outputBoneSurfaceDistanceLabel = None
+    self.cellLocatorPolyData = None
+    self.cellLocatorPolyDataMTime = -1
+    self.boneModelToWorldMatrix = vtk.vtkMatrix4x4()
+    self.worldToBoneModelMatrix = vtk.vtkMatrix4x4()
+    self.closestPointInBoneModel = [0.0, 0.0, 0.0]
+    self.closestCell = vtk.vtkGenericCell()
+    self.closestCellId = vtk.mutable(0)
+    self.closestSubId = vtk.mutable(0)
+    self.closestDistance2 = vtk.mutable(0.0)
+
+    # Trajectory forecast: one OBB tree per model, kept in model coordinates.
+    # The needle in NeedleTip coordinates extends along +X from the tip, so it advances along -X.
+    self.trajectoryModels = []
+    self.trajectoryObbTrees = {}
+    self.trajectoryForecastEnabled = False
+    self.outputTrajectoryLabel = None
+    self.needleDirectionInTip = [-1.0, 0.0, 0.0]
+    self.trajectoryLengthMm = 300.0
+    self.trajectoryModelToWorldMatrix = vtk.vtkMatrix4x4()
+    self.worldToTrajectoryModelMatrix = vtk.vtkMatrix4x4()
+    self.trajectoryIntersectionPoints = vtk.vtkPoints()
+    self.trajectoryIntersectionCellIds = vtk.vtkIdList()
     
     # 3D View
     threeDWidget = slicer.app.layoutManager().threeDWidget(0)
@@ -407,84 +1116,223 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
     
     self.callbackObserverTag = -1
     self.observerTag=None
+    self.observedTransformNode = None
 
     # Output Distance Label
     self.outputDistanceLabel=None
+    self.outputNearestTargetLabel=None
 
-    import Viewpoint # Viewpoint Module must have been added to Slicer 
-    self.viewpointLogic = Viewpoint.ViewpointLogic()
+    # World matrices: calibration and registration transforms are precomposed and cached,
+    # so that only the tracker transforms are multiplied per frame
+    self.precomposeStaticTransforms = True
+    self.staticTransformCache = StaticTransformCache()
+    self.callbackProfiler.instrumentMethods(self.staticTransformCache, ['onStaticTransformModified'])
+    self.tipToWorldMatrix = vtk.vtkMatrix4x4()
+
+    # Tracking recorder
+    self.trackingRecorder = TrackingRecorder()
+    self.callbackProfiler.instrumentMethods(self.trackingRecorder, ['onTransformModified'])
+
+    # Landmark registration
+    self.pairedPointRegistration = PairedPointRegistration()
+    self.surfaceRegistration = SurfaceRegistration()
+    self.pivotCalibration = PivotCalibration()
+    for pointerTipSampler in [self.pairedPointRegistration.sampler, self.surfaceRegistration.sampler]:
+      self.callbackProfiler.instrumentMethods(pointerTipSampler, ['onPointerTransformModified'])
+    self.callbackProfiler.instrumentMethods(self.pivotCalibration, ['onToolTransformModified'])
+
+    # Level of detail of the anatomy models in viewpoint mode
+    self.levelOfDetailEnabled = False
+    self.levelOfDetailModels = []
+    self.modelLevelOfDetail = None
+
+    # Latency compensation: tracker transform node ID -> PosePredictor
+    self.posePredictors = {}
+
+    self.viewpointLogic = Viewpoint.ViewpointLogic(self.callbackProfiler)
+    # Near and far planes from the cached bounds of the anatomy and tool models, set in buildTransformTreeForNavigation
+    self.viewpointLogic.setCachedClippingRangeEnabled(True)
+
+    # Tool poses are computed once per frame and shared by every camera
+    self.poseCache = PoseCache(self.getMatrixTransformToWorld)
+    self.callbackProfiler.instrumentMethods(self.poseCache, ['onTransformModified'])
+    self.viewpointLogic.setMatrixTransformToWorldFunction(self.poseCache.getMatrixTransformToWorld)
+
+    # Red, Yellow and Green slices follow the needle, see startNeedleSliceReslicing
+    self.needleSliceReslicer = NeedleSliceReslicer(self.poseCache.getMatrixTransformToWorld)
+    self.callbackProfiler.instrumentMethods(self.needleSliceReslicer, ['onNeedleTransformModified', 'onUpdateTimerTimeout'])
+
+    # Additional 3D views, view node ID: [ViewpointLogic or None for a fixed overview, 3D view]
+    self.viewBindings = {}
+    self.clippingModelNodes = []
+
+    # All updates caused by a tracker frame are rendered together
+    self.frameTransaction = FrameTransaction(self.viewpointLogic, [self.threeDView])
+    self.callbackProfiler.instrumentMethods(self.frameTransaction, ['onTrackerTransformModified', 'endFrame'])
+    self.frameTransaction.setBatchedNodes([self.tipFiducial, self.line])
+
+    # Tracking replay, drives the same nodes and observers as the live stream
+    self.trackingReplayer = TrackingReplayer(self.viewpointLogic, self.threeDView, self.nodeRegistry)
 
     # Camera transformations
-    self.needleCameraToNeedle = slicer.util.getNode('needleCameraToNeedle')
-    if not self.needleCameraToNeedle:
-      self.needleCameraToNeedle=slicer.vtkMRMLLinearTransformNode()
-      self.needleCameraToNeedle.SetName("needleCameraToNeedle")
-      matrixNeedleCamera = vtk.vtkMatrix4x4()
-      matrixNeedleCamera.SetElement( 0, 0, -0.05 ) # Row 1
-      matrixNeedleCamera.SetElement( 0, 1, 0.09 )
-      matrixNeedleCamera.SetElement( 0, 2, -0.99 )
-      matrixNeedleCamera.SetElement( 0, 3, 60.72 )      
-      matrixNeedleCamera.SetElement( 1, 0, -0.01 )  # Row 2
-      matrixNeedleCamera.SetElement( 1, 1, 1 )
-      matrixNeedleCamera.SetElement( 1, 2, 0.09 )
-      matrixNeedleCamera.SetElement( 1, 3, 12.17 )       
-      matrixNeedleCamera.SetElement( 2, 0, 1 )  # Row 3
-      matrixNeedleCamera.SetElement( 2, 1, 0.01 )
-      matrixNeedleCamera.SetElement( 2, 2, -0.05 )
-      matrixNeedleCamera.SetElement( 2, 3, -7.26 )
-      self.needleCameraToNeedle.SetMatrixTransformToParent(matrixNeedleCamera)
-      slicer.mrmlScene.AddNode(self.needleCameraToNeedle)
-
-    self.pointerCameraToPointer = slicer.util.getNode('pointerCameraToPointer')
-    if not self.pointerCameraToPointer:
-      self.pointerCameraToPointer=slicer.vtkMRMLLinearTransformNode()
-      self.pointerCameraToPointer.SetName("pointerCameraToPointer")
-      matrixPointerCamera = vtk.vtkMatrix4x4()
-      matrixPointerCamera.SetElement( 0, 0, -0.05 ) # Row 1
-      matrixPointerCamera.SetElement( 0, 1, 0.09 )
-      matrixPointerCamera.SetElement( 0, 2, -0.99 )
-      matrixPointerCamera.SetElement( 0, 3, 121.72 )      
-      matrixPointerCamera.SetElement( 1, 0, -0.01 )  # Row 2
-      matrixPointerCamera.SetElement( 1, 1, 1 )
-      matrixPointerCamera.SetElement( 1, 2, 0.09 )
-      matrixPointerCamera.SetElement( 1, 3, 17.17 )       
-      matrixPointerCamera.SetElement( 2, 0, 1 )  # Row 3
-      matrixPointerCamera.SetElement( 2, 1, 0.01 )
-      matrixPointerCamera.SetElement( 2, 2, -0.05 )
-      matrixPointerCamera.SetElement( 2, 3, -7.26 )
-      self.pointerCameraToPointer.SetMatrixTransformToParent(matrixPointerCamera)
-      slicer.mrmlScene.AddNode(self.pointerCameraToPointer)
+    self.needleCameraToNeedle = self.getOrCreateToolCameraTransformNode('needleCameraToNeedle', [60.72, 12.17, -7.26])
+    self.pointerCameraToPointer = self.getOrCreateToolCameraTransformNode('pointerCameraToPointer', [121.72, 17.17, -7.26])
 
+    # Tracked tools: tip positions, directions and target distances of all tools are computed once per frame
+    self.toolRegistry = ToolRegistry(self.poseCache)
+    self.outputTrackedToolDistancesLabel = None
+    self.frameTransaction.addEndFrameCallback(lambda: self.updateTrackedTools()) # looked up on every call, may be instrumented
+    self.callbackProfiler.instrumentMethods(self, ['updateTrackedTools'])
+    self.trackerTransformNodes = []
+    self.staticTransformNodes = []
+    self.addedTrackedTools = {} # tool name: [tool model node, parent IDs of the model and the tip transform before adding]
 
-  def SetNeedleViewpoint(self, NeedleModelNode, NeedleToTrackerTransformNode):
-    if NeedleToTrackerTransformNode:
-      self.needleCameraToNeedle.SetAndObserveTransformNodeID(NeedleToTrackerTransformNode.GetID())  
-      NeedleModelNode.GetDisplayNode().SetOpacity(1)
+  def getOrCreateToolCameraTransformNode(self, name, cameraPositionInTool):
+    # All tool cameras look along the tool towards its tip, only their distance from the tip differs
+    toolCameraToTool = self.nodeRegistry.getNode(name)
+    if not toolCameraToTool:
+      toolCameraToTool = slicer.vtkMRMLLinearTransformNode()
+      toolCameraToTool.SetName(name)
+      cameraOrientationInTool = [[-0.05, 0.09, -0.99], [-0.01, 1, 0.09], [1, 0.01, -0.05]]
+      matrixToolCamera = vtk.vtkMatrix4x4()
+      for row in range(3):
+        for column in range(3):
+          matrixToolCamera.SetElement(row, column, cameraOrientationInTool[row][column])
+        matrixToolCamera.SetElement(row, 3, cameraPositionInTool[row])
+      toolCameraToTool.SetMatrixTransformToParent(matrixToolCamera)
+      slicer.mrmlScene.AddNode(toolCameraToTool)
+    return toolCameraToTool
 
-      SceneCameraNode=slicer.util.getNode('Default Scene Camera')
-      
-      # Viewpoint
-      self.viewpointLogic.setCameraNode(SceneCameraNode)
-      self.viewpointLogic.setTransformNode(self.needleCameraToNeedle)
-      self.viewpointLogic.startViewpoint()
+  def SetNeedleViewpoint(self, NeedleModelNode, NeedleToTrackerTransformNode):
+    self.SetToolViewpoint(NeedleModelNode, NeedleToTrackerTransformNode, self.needleCameraToNeedle)
 
   def SetPointerViewpoint(self, PointerModelNode, PointerToTrackerTransformNode):
-    if PointerToTrackerTransformNode:
-      self.pointerCameraToPointer.SetAndObserveTransformNodeID(PointerToTrackerTransformNode.GetID())  
-      PointerModelNode.GetDisplayNode().SetOpacity(1)
+    self.SetToolViewpoint(PointerModelNode, PointerToTrackerTransformNode, self.pointerCameraToPointer)
 
-      SceneCameraNode=slicer.util.getNode('Default Scene Camera')
+  def SetToolViewpoint(self, toolModelNode, toolToTrackerTransformNode, toolCameraToToolTransformNode):
+    if toolToTrackerTransformNode:
+      toolCameraToToolTransformNode.SetAndObserveTransformNodeID(self.getConsumerToolTransformNode(toolToTrackerTransformNode).GetID())
+      if toolModelNode:
+        toolModelNode.GetDisplayNode().SetOpacity(1)
+
+      SceneCameraNode=self.nodeRegistry.getNode('Default Scene Camera')
       
       # Viewpoint
       self.viewpointLogic.setCameraNode(SceneCameraNode)
-      self.viewpointLogic.setTransformNode(self.pointerCameraToPointer)
+      self.viewpointLogic.setTransformNode(toolCameraToToolTransformNode)
       self.viewpointLogic.startViewpoint()
      
+  def getCameraNodeForView(self, viewNode):
+    for cameraNode in self.nodeRegistry.getNodesByClass('vtkMRMLCameraNode'):
+      if cameraNode.GetActiveTag() == viewNode.GetID():
+        return cameraNode
+    return None
+
+  def getThreeDViewForViewNode(self, viewNode):
+    layoutManager = slicer.app.layoutManager()
+    for viewIndex in range(layoutManager.threeDViewCount):
+      threeDView = layoutManager.threeDWidget(viewIndex).threeDView()
+      if threeDView.mrmlViewNode() and threeDView.mrmlViewNode().GetID() == viewNode.GetID():
+        return threeDView
+    return None
+
+  def bindViewToTool(self, viewNode, toolToTrackerTransformNode, toolCameraToToolTransformNode):
+    """Drives the camera of another 3D view from a tool camera (e.g. needleCameraToNeedle), or keeps it as a fixed
+    overview if toolCameraToToolTransformNode is None. All bound cameras read the tool poses from the shared
+    pose cache and are rendered together with the main view, once per tracker frame.
+    """
+    import Viewpoint # Viewpoint Module must have been added to Slicer 
+    self.unbindView(viewNode)
+    threeDView = self.getThreeDViewForViewNode(viewNode)
+    if not threeDView:
+      logging.error('bindViewToTool: %s is not shown in the current layout' % viewNode.GetName())
+      return False
+    if threeDView is self.threeDView:
+      logging.error('bindViewToTool: the camera of the main 3D view is controlled by the needle and pointer viewpoints')
+      return False
+    viewpointLogic = None
+    if toolCameraToToolTransformNode:
+      cameraNode = self.getCameraNodeForView(viewNode)
+      if not cameraNode or not toolToTrackerTransformNode:
+        logging.error('bindViewToTool: camera or tool transform of %s not found' % viewNode.GetName())
+        return False
+      toolCameraToToolTransformNode.SetAndObserveTransformNodeID(self.getConsumerToolTransformNode(toolToTrackerTransformNode).GetID())
+      viewpointLogic = Viewpoint.ViewpointLogic(self.callbackProfiler)
+      viewpointLogic.setMatrixTransformToWorldFunction(self.poseCache.getMatrixTransformToWorld)
+      viewpointLogic.setCachedClippingRangeEnabled(self.viewpointLogic.cachedClippingRangeEnabled)
+      viewpointLogic.setClippingModelNodes(self.getClippingModelNodes(), self.getDynamicTransformNodes())
+      viewpointLogic.setCameraNode(cameraNode)
+      viewpointLogic.setTransformNode(toolCameraToToolTransformNode)
+      viewpointLogic.startViewpoint()
+      self.frameTransaction.addViewpointLogic(viewpointLogic)
+    self.frameTransaction.addView(threeDView)
+    self.viewBindings[viewNode.GetID()] = [viewpointLogic, threeDView]
+    return True
+
+  def bindViewToTrackedTool(self, viewNode, toolName):
+    tool = self.toolRegistry.getTool(toolName)
+    if not tool or not tool['toolCameraToTool']:
+      logging.error('bindViewToTrackedTool: %s is not a tracked tool with a camera' % toolName)
+      return False
+    return self.bindViewToTool(viewNode, tool['toolToTracker'], tool['toolCameraToTool'])
+
+  def unbindView(self, viewNode):
+    viewBinding = self.viewBindings.pop(viewNode.GetID(), None)
+    if not viewBinding:
+      return
+    viewpointLogic, threeDView = viewBinding
+    if viewpointLogic:
+      viewpointLogic.stopViewpoint()
+      viewpointLogic.removeClippingModelObservers()
+      self.frameTransaction.removeViewpointLogic(viewpointLogic)
+    if threeDView is not self.threeDView:
+      self.frameTransaction.removeView(threeDView)
+
+  def startNeedleSliceReslicing(self, needleTipToNeedleTransformNode):
+    self.needleSliceReslicer.start(needleTipToNeedleTransformNode)
+
+  def stopNeedleSliceReslicing(self):
+    self.needleSliceReslicer.stop()
+
+  def setNeedleSliceReslicingRateHz(self, rateHz):
+    self.needleSliceReslicer.maximumUpdateRateHz = rateHz
+
+  def getPoseCacheStatistics(self):
+    return self.poseCache.getStatistics()
+
   def StartViewpoint(self):
     self.viewpointLogic.startViewpoint()
+    if self.levelOfDetailEnabled and self.viewpointLogic.cameraNode:
+      if not self.modelLevelOfDetail:
+        self.modelLevelOfDetail = ModelLevelOfDetail(nodeRegistry=self.nodeRegistry)
+        self.modelLevelOfDetail.setModelNodes(self.levelOfDetailModels)
+        self.updateClippingModelNodes()
+      self.modelLevelOfDetail.start(self.viewpointLogic.cameraNode, self.threeDView)
 
   def StopViewpoint(self):
     self.viewpointLogic.stopViewpoint()
+    if self.modelLevelOfDetail:
+      self.modelLevelOfDetail.stop()
+
+  def setModelVisibility(self, modelNode, visible):
+    if not modelNode:
+      return
+    # While the level of detail is active it decides which version of the model is shown
+    if self.modelLevelOfDetail and modelNode in self.modelLevelOfDetail.modelNodes:
+      self.modelLevelOfDetail.setRequestedVisibility(modelNode, visible)
+    else:
+      modelNode.GetDisplayNode().SetVisibility(visible)
+
+  def setLevelOfDetailEnabled(self, enabled, anatomyModelNodes):
+    # Takes effect the next time the viewpoint is started
+    self.levelOfDetailEnabled = enabled
+    self.levelOfDetailModels = anatomyModelNodes
+    if self.modelLevelOfDetail:
+      modelLevelOfDetail = self.modelLevelOfDetail
+      modelLevelOfDetail.stop()
+      self.modelLevelOfDetail = None
+      self.updateClippingModelNodes()
+      modelLevelOfDetail.removeLowDetailModelNodes()
      
   def buildTransformTreeForRegistration(self, boneModelNode, softTissueModelNode, pointerModelNode, needleModelNode, trackerToReferenceTransformNode, pointerToTrackerTransformNode, pointerTipToPointerTransformNode, needleToTrackerTransformNode, needleTipToNeedleTransformNode):
     # Pointer
@@ -510,6 +1358,111 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
     softTissueModelNode.SetAndObserveTransformNodeID(patientToReferenceTransformNode.GetID())
     patientToReferenceTransformNode.SetAndObserveTransformNodeID(referenceToTrackerTransformNode.GetID())
 
+    # Tracked tools, more needles can be added with addTrackedTool
+    self.toolRegistry.setTool('Needle', needleToTrackerTransformNode, needleTipToNeedleTransformNode, self.needleCameraToNeedle, self.needleDirectionInTip)
+    self.toolRegistry.setTool('Pointer', pointerToTrackerTransformNode, pointerTipToPointerTransformNode, self.pointerCameraToPointer, directionInTip=None)
+
+    # Calibration and registration transforms do not change during the procedure
+    self.staticTransformNodes = [pointerTipToPointerTransformNode, needleTipToNeedleTransformNode, patientToReferenceTransformNode, self.needleCameraToNeedle, self.pointerCameraToPointer]
+    self.trackerTransformNodes = [referenceToTrackerTransformNode, pointerToTrackerTransformNode, needleToTrackerTransformNode]
+    self.clippingModelNodes = [boneModelNode, softTissueModelNode, pointerModelNode, needleModelNode]
+    self.updateNavigationObservers()
+
+  def addTrackedTool(self, toolName, toolModelNode, toolToTrackerTransformNode, toolTipToToolTransformNode, directionInTip=None):
+    """Adds another tracked tool (e.g. a second ablation needle) to the navigation transform tree. Its tip position,
+    direction and distances to all targets are computed together with the other tools, once per tracker frame.
+    """
+    if not toolToTrackerTransformNode or not toolTipToToolTransformNode:
+      logging.error('addTrackedTool: the tracker and tip transforms of %s are required' % toolName)
+      return False
+    if not self.trackerTransformNodes:
+      logging.error('addTrackedTool: apply the transforms for navigation first')
+      return False
+    if self.toolRegistry.getTool(toolName):
+      logging.error('addTrackedTool: %s is already tracked' % toolName)
+      return False
+    # Parents are restored by removeTrackedTool
+    previousParentIDs = [toolModelNode.GetTransformNodeID() if toolModelNode else None, toolTipToToolTransformNode.GetTransformNodeID()]
+    if toolModelNode:
+      toolModelNode.SetAndObserveTransformNodeID(toolTipToToolTransformNode.GetID())
+    toolTipToToolTransformNode.SetAndObserveTransformNodeID(self.getConsumerToolTransformNode(toolToTrackerTransformNode).GetID())
+    toolCameraName = toolName + 'CameraTo' + toolName
+    # a camera transform that was already in the scene is kept by removeTrackedTool
+    toolCameraCreated = self.nodeRegistry.getNode(toolCameraName) is None
+    toolCameraToTool = self.getOrCreateToolCameraTransformNode(toolCameraName, [60.72, 12.17, -7.26])
+    if directionInTip is None:
+      directionInTip = self.needleDirectionInTip
+    self.toolRegistry.setTool(toolName, toolToTrackerTransformNode, toolTipToToolTransformNode, toolCameraToTool, directionInTip)
+    self.addedTrackedTools[toolName] = [toolModelNode, previousParentIDs, toolCameraCreated]
+
+    self.staticTransformNodes += [toolTipToToolTransformNode, toolCameraToTool]
+    self.trackerTransformNodes.append(toolToTrackerTransformNode)
+    if toolModelNode:
+      self.clippingModelNodes.append(toolModelNode)
+    self.updateNavigationObservers()
+    return True
+
+  def removeTrackedTool(self, toolName):
+    """Undoes addTrackedTool: unbinds the views that follow the tool, removes its transforms and model from the
+    caches and the clipping range, restores the previous parents and deletes its camera transform if addTrackedTool created it.
+    """
+    addedTrackedTool = self.addedTrackedTools.pop(toolName, None)
+    tool = self.toolRegistry.getTool(toolName)
+    if not addedTrackedTool or not tool:
+      logging.error('removeTrackedTool: %s was not added with addTrackedTool' % toolName)
+      return False
+    toolModelNode, previousParentIDs, toolCameraCreated = addedTrackedTool
+    toolToTrackerTransformNode = tool['toolToTracker']
+    toolTipToToolTransformNode = tool['toolTipToTool']
+    toolCameraToTool = tool['toolCameraToTool']
+    for viewNodeID, viewBinding in list(self.viewBindings.items()):
+      viewpointLogic = viewBinding[0]
+      if viewpointLogic and viewpointLogic.transformNode is toolCameraToTool:
+        self.unbindView(slicer.mrmlScene.GetNodeByID(viewNodeID))
+    self.toolRegistry.removeTool(toolName)
+
+    for staticTransformNode in [toolTipToToolTransformNode, toolCameraToTool]:
+      self.staticTransformNodes.remove(staticTransformNode)
+    self.trackerTransformNodes.remove(toolToTrackerTransformNode)
+    if toolModelNode:
+      self.clippingModelNodes.remove(toolModelNode)
+    self.poseCache.removeTransformNodes([toolTipToToolTransformNode, toolCameraToTool])
+    self.updateNavigationObservers()
+
+    if toolModelNode:
+      toolModelNode.SetAndObserveTransformNodeID(previousParentIDs[0])
+    toolTipToToolTransformNode.SetAndObserveTransformNodeID(previousParentIDs[1])
+    if toolCameraCreated:
+      slicer.mrmlScene.RemoveNode(toolCameraToTool)
+    return True
+
+  def updateNavigationObservers(self):
+    self.staticTransformCache.setStaticTransformNodes(self.staticTransformNodes)
+    self.frameTransaction.setTrackerTransformNodes(self.trackerTransformNodes)
+    self.poseCache.setTrackerTransformNodes(self.trackerTransformNodes)
+    self.updateClippingModelNodes()
+    self.frameTransaction.start()
+
+  def getClippingModelNodes(self):
+    # Hidden models do not widen the clipping range, so the decimated anatomy shown while the camera moves
+    # must be included as well
+    clippingModelNodes = list(self.clippingModelNodes)
+    if self.modelLevelOfDetail:
+      clippingModelNodes += self.modelLevelOfDetail.lowDetailModelNodes
+    return clippingModelNodes
+
+  def getDynamicTransformNodes(self):
+    # Transforms that change on every frame: the tracker transforms and, with pose prediction, the predicted ones
+    return self.trackerTransformNodes + [posePredictor.outputTransformNode for posePredictor in self.posePredictors.values()]
+
+  def updateClippingModelNodes(self):
+    clippingModelNodes = self.getClippingModelNodes()
+    dynamicTransformNodes = self.getDynamicTransformNodes()
+    self.viewpointLogic.setClippingModelNodes(clippingModelNodes, dynamicTransformNodes)
+    for viewpointLogic, threeDView in self.viewBindings.values():
+      if viewpointLogic:
+        viewpointLogic.setClippingModelNodes(clippingModelNodes, dynamicTransformNodes)
+
   def resetTransformTree(self, boneModelNode, softTissueModelNode, pointerModelNode, needleModelNode, pointerToTrackerTransformNode):
      # Reset transform tree
     pointerModelNode.SetAndObserveTransformNodeID(None)
@@ -518,83 +1471,2427 @@ class PercutaneousNavigationLogic(ScriptedLoadableModuleLogic):
     needleModelNode.SetAndObserveTransformNodeID(None)
     pointerToTrackerTransformNode.SetAndObserveTransformNodeID(None)
   
+  def startPosePrediction(self, toolToTrackerTransformNodes, horizonSec=0.03):
+    """Inserts a PosePredictor after each tool tracker transform. Everything that was attached to
+    a tracker transform is moved under its predicted counterpart (e.g. NeedleToTrackerPredicted).
+    """
+    for toolToTrackerTransformNode in toolToTrackerTransformNodes:
+      if not toolToTrackerTransformNode or toolToTrackerTransformNode.GetID() in self.posePredictors:
+        continue
+      predictedName = toolToTrackerTransformNode.GetName() + 'Predicted'
+      predictedTransformNode = self.nodeRegistry.getNode(predictedName)
+      if not predictedTransformNode:
+        predictedTransformNode = slicer.vtkMRMLLinearTransformNode()
+        predictedTransformNode.SetName(predictedName)
+        slicer.mrmlScene.AddNode(predictedTransformNode)
+      predictedTransformNode.SetAndObserveTransformNodeID(toolToTrackerTransformNode.GetTransformNodeID())
+      posePredictor = PosePredictor(toolToTrackerTransformNode, predictedTransformNode, horizonSec)
+      self.callbackProfiler.instrumentMethods(posePredictor, ['onInputTransformModified'])
+      self.posePredictors[toolToTrackerTransformNode.GetID()] = posePredictor
+      self.moveTransformChildren(toolToTrackerTransformNode, predictedTransformNode)
+      posePredictor.start()
+    self.reconnectCalculateDistanceObserver()
+    self.updateClippingModelNodes()
+    logging.info('Pose prediction started')
+
+  def stopPosePrediction(self):
+    for posePredictor in self.posePredictors.values():
+      posePredictor.stop()
+      self.moveTransformChildren(posePredictor.outputTransformNode, posePredictor.inputTransformNode)
+    self.posePredictors = {}
+    self.reconnectCalculateDistanceObserver()
+    self.updateClippingModelNodes()
+    logging.info('Pose prediction stopped')
+
+  def setPosePredictionHorizonSec(self, horizonSec):
+    for posePredictor in self.posePredictors.values():
+      posePredictor.horizonSec = horizonSec
+
+  def getPosePredictionStatistics(self):
+    return dict([(posePredictor.inputTransformNode.GetName(), posePredictor.getStatistics()) for posePredictor in self.posePredictors.values()])
+
+  def getConsumerToolTransformNode(self, toolToTrackerTransformNode):
+    # The predicted transform if latency compensation is active, the tracker transform otherwise
+    posePredictor = self.posePredictors.get(toolToTrackerTransformNode.GetID())
+    return posePredictor.outputTransformNode if posePredictor else toolToTrackerTransformNode
+
+  def moveTransformChildren(self, fromTransformNode, toTransformNode):
+    for transformableNode in self.nodeRegistry.getNodesByClass('vtkMRMLTransformableNode'):
+      if transformableNode.GetTransformNodeID() == fromTransformNode.GetID():
+        transformableNode.SetAndObserveTransformNodeID(toTransformNode.GetID())
+
+  def setPrecomposeStaticTransforms(self, enabled):
+    self.precomposeStaticTransforms = enabled
+
+  def getMatrixTransformToWorld(self, transformNode, matrix):
+    # no logging - it slows Slicer down a *lot*
+    if self.precomposeStaticTransforms:
+      self.staticTransformCache.getMatrixTransformToWorld(transformNode, matrix)
+    else:
+      transformNode.GetMatrixTransformToWorld(matrix)
+
   def SetMembers(self, toolTipToTool, toolToReference):
     self.toolTipToTool = toolTipToTool
     self.toolToReference = toolToReference
     
   def addCalculateDistanceObserver(self):
-    print("[TEST] addCalculateDistanceObserver")
     if self.callbackObserverTag == -1:
       self.tipFiducial.SetAndObserveTransformNodeID(self.toolTipToTool.GetID())
-      self.observerTag = self.toolToReference.AddObserver('ModifiedEvent', self.calculateCallback) # slicer.vtkMRMLMarkupsNode.MarkupAddedEvent
+      # With pose prediction the distances are computed when the predicted pose has been written, not when the tracker pose arrives
+      self.observedTransformNode = self.getConsumerToolTransformNode(self.toolToReference)
+      if self.observedTransformNode is self.toolToReference:
+        self.observerTag = self.toolToReference.AddObserver('ModifiedEvent', self.calculateCallback) # slicer.vtkMRMLMarkupsNode.MarkupAddedEvent
+      else:
+        self.observerTag = self.observedTransformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.calculateCallback)
       logging.info('addCalculateDistanceObserver')
       
   def removeCalculateDistanceObserver(self):
-    print("[TEST] removeCalculateDistanceObserver")
     self.callbackObserverTag = 1
     if self.callbackObserverTag != -1:
-      self.toolToReference.RemoveObserver(self.observerTag)
+      if self.observedTransformNode:
+        self.observedTransformNode.RemoveObserver(self.observerTag)
+      self.observedTransformNode = None
       self.callbackObserverTag = -1
       logging.info('removeCalculateDistanceObserver')
+
+  def reconnectCalculateDistanceObserver(self):
+    # The consumer node of the needle changes when pose prediction is started or stopped
+    if self.observedTransformNode:
+      self.removeCalculateDistanceObserver()
+      self.addCalculateDistanceObserver()
       
   def calculateCallback(self, transformNode, event=None):
     self.calculateDistance()
 
   def calculateDistance(self):
     tipPoint = [0.0,0.0,0.0]
-    targetPoint = [0.0, 0.0, 0.0]
 
-    m = vtk.vtkMatrix4x4()
-    self.toolTipToTool.GetMatrixTransformToWorld(m)
+    m = self.tipToWorldMatrix
+    self.getMatrixTransformToWorld(self.toolTipToTool, m)
     tipPoint[0] = m.GetElement(0, 3)
     tipPoint[1] = m.GetElement(1, 3)
     tipPoint[2] = m.GetElement(2, 3)
 
-    self.targetFiducial.GetNthFiducialPosition (1, targetPoint)
-    # print(targetPoint)
+    # Labels are set through the frame transaction, so they are repainted once per tracker frame
+    frameTransaction = self.frameTransaction
+    if self.calculateTargetDistances(tipPoint) < 0:
+      frameTransaction.setLabelText(self.outputDistanceLabel, '-')
+    else:
+      frameTransaction.setLabelText(self.outputDistanceLabel, '%.1f' % self.targetDistances[self.nearestTargetIndex])
+      if self.outputNearestTargetLabel:
+        frameTransaction.setLabelText(self.outputNearestTargetLabel, self.targetLabels[self.nearestTargetIndex])
+      self.drawLineBetweenPoints(tipPoint, self.targetPositionsInWorld[self.nearestTargetIndex])
 
-    # Prueba David
-    needlePoint = [0.0, 0.0, 0.0]
-    v = vtk.vtkMatrix4x4()
-    self.toolToReference.GetMatrixTransformToWorld(v)
-    needlePoint[0] = v.GetElement(0, 3)
-    needlePoint[1] = v.GetElement(1, 3)
-    needlePoint[2] = v.GetElement(2, 3)
-    # print(needlePoint)
+    if self.boneSurfaceDistanceEnabled:
+      boneSurfaceDistance = self.calculateBoneSurfaceDistance(tipPoint)
+      if boneSurfaceDistance is not None:
+        frameTransaction.setLabelText(self.outputBoneSurfaceDistanceLabel, '%.1f' % boneSurfaceDistance)
 
-    distance = math.sqrt(math.pow(tipPoint[0]-targetPoint[0], 2) + math.pow(tipPoint[1]-targetPoint[1], 2) + math.pow(tipPoint[2]-targetPoint[2], 2))
-    
-    self.outputDistanceLabel.setText('%.1f' % distance)
+    if self.trajectoryForecastEnabled:
+      trajectoryHit = self.calculateTrajectoryIntersection(m)
+      if trajectoryHit and trajectoryHit[3]:
+        frameTransaction.setLabelText(self.outputTrajectoryLabel, 'inside (%s)' % trajectoryHit[2].GetName())
+      elif trajectoryHit:
+        frameTransaction.setLabelText(self.outputTrajectoryLabel, '%.1f (%s)' % (trajectoryHit[0], trajectoryHit[2].GetName()))
+      else:
+        frameTransaction.setLabelText(self.outputTrajectoryLabel, '-')
+
+  def onTargetFiducialModified(self, caller, event=None):
+    self.targetPositionsModified = True
+
+  def updateTargetPositions(self):
+    numberOfTargets = self.targetFiducial.GetNumberOfFiducials()
+    targetPositions = np.zeros((numberOfTargets, 3))
+    targetPoint = [0.0, 0.0, 0.0]
+    self.targetLabels = []
+    for targetIndex in range(numberOfTargets):
+      self.targetFiducial.GetNthFiducialPosition(targetIndex, targetPoint)
+      targetPositions[targetIndex] = targetPoint
+      self.targetLabels.append(self.targetFiducial.GetNthFiducialLabel(targetIndex))
+
+    # Local to world coordinates for all targets at once
+    targetTransformNode = self.targetFiducial.GetParentTransformNode()
+    if targetTransformNode:
+      self.getMatrixTransformToWorld(targetTransformNode, self.targetToWorldMatrix)
+    else:
+      self.targetToWorldMatrix.Identity()
+    targetToWorld = np.array([[self.targetToWorldMatrix.GetElement(row, column) for column in range(4)] for row in range(3)])
+    self.targetPositionsInWorld = targetPositions.dot(targetToWorld[:, 0:3].T) + targetToWorld[:, 3]
+    self.targetPositionsModified = False
 
-    self.drawLineBetweenPoints(tipPoint, targetPoint)
+  def calculateTargetDistances(self, tipPoint):
+    # no logging - it slows Slicer down a *lot*
+    if self.targetPositionsModified:
+      self.updateTargetPositions()
+    if len(self.targetPositionsInWorld) == 0:
+      self.targetDistances = np.zeros(0)
+      self.targetOrder = np.zeros(0, dtype=int)
+      self.nearestTargetIndex = -1
+      return self.nearestTargetIndex
+    differences = self.targetPositionsInWorld - tipPoint
+    self.targetDistances = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+    self.targetOrder = np.argsort(self.targetDistances)
+    self.nearestTargetIndex = int(self.targetOrder[0])
+    return self.nearestTargetIndex
+
+  def updateTrackedTools(self):
+    # no logging - it slows Slicer down a *lot*
+    if self.toolRegistry.getNumberOfTools() == 0:
+      return
+    if self.targetPositionsModified:
+      self.updateTargetPositions()
+    if self.toolRegistry.update(self.targetPositionsInWorld) and self.outputTrackedToolDistancesLabel:
+      lines = []
+      for toolName, targetIndex, distance, depth, lateralOffset in self.toolRegistry.getNearestTargets():
+        if targetIndex < 0:
+          lines.append('%s: -' % toolName)
+        elif math.isnan(depth):
+          lines.append('%s: %.1f to %s' % (toolName, distance, self.targetLabels[targetIndex]))
+        else:
+          lines.append('%s: %.1f to %s (depth %.1f, off-axis %.1f)' % (toolName, distance, self.targetLabels[targetIndex], depth, lateralOffset))
+      self.frameTransaction.setLabelText(self.outputTrackedToolDistancesLabel, '\n'.join(lines))
+
+  def setOutputTrackedToolDistancesLabel(self, label):
+    self.outputTrackedToolDistancesLabel = label
+
+  def getTargetDistanceTable(self):
+    """Returns (label, distance in mm) for all targets, nearest first, as of the last calculateDistance call.
+    """
+    return [(self.targetLabels[targetIndex], float(self.targetDistances[targetIndex])) for targetIndex in self.targetOrder]
+
+  def setBoneSurfaceModel(self, boneModelNode):
+    self.boneSurfaceModel = boneModelNode
+
+  def setBoneSurfaceDistanceEnabled(self, enabled):
+    self.boneSurfaceDistanceEnabled = enabled
+    if enabled:
+      self.updateBoneSurfaceLocator()
+
+  def setOutputBoneSurfaceDistanceLabel(self, label):
+    self.outputBoneSurfaceDistanceLabel = label
+
+  def updateBoneSurfaceLocator(self):
+    # Rebuild the locator only if the mesh itself changed, moving the model does not require a rebuild
+    if not self.boneSurfaceModel:
+      return False
+    polyData = self.boneSurfaceModel.GetPolyData()
+    if not polyData or polyData.GetNumberOfCells() == 0:
+      return False
+    if polyData is self.cellLocatorPolyData and polyData.GetMTime() == self.cellLocatorPolyDataMTime:
+      return True
+    self.cellLocator.SetDataSet(polyData)
+    self.cellLocator.BuildLocator()
+    self.cellLocatorPolyData = polyData
+    self.cellLocatorPolyDataMTime = polyData.GetMTime()
+    logging.info('Bone surface locator rebuilt')
+    return True
+
+  def calculateBoneSurfaceDistance(self, tipPointInWorld):
+    # no logging - it slows Slicer down a *lot*
+    if not self.updateBoneSurfaceLocator():
+      return None
+
+    # Tip to bone model coordinates
+    boneTransformNode = self.boneSurfaceModel.GetParentTransformNode()
+    if boneTransformNode:
+      self.getMatrixTransformToWorld(boneTransformNode, self.boneModelToWorldMatrix)
+    else:
+      self.boneModelToWorldMatrix.Identity()
+    vtk.vtkMatrix4x4.Invert(self.boneModelToWorldMatrix, self.worldToBoneModelMatrix)
+    tipPointInBoneModel = self.worldToBoneModelMatrix.MultiplyPoint([tipPointInWorld[0], tipPointInWorld[1], tipPointInWorld[2], 1.0])
+
+    self.cellLocator.FindClosestPoint(tipPointInBoneModel[0:3], self.closestPointInBoneModel, self.closestCell, self.closestCellId, self.closestSubId, self.closestDistance2)
+
+    # Measure in world coordinates so that the result is correct even if the registration contains scaling
+    closestPointInWorld = self.boneModelToWorldMatrix.MultiplyPoint(self.closestPointInBoneModel + [1.0])
+    return math.sqrt(math.pow(tipPointInWorld[0]-closestPointInWorld[0], 2) + math.pow(tipPointInWorld[1]-closestPointInWorld[1], 2) + math.pow(tipPointInWorld[2]-closestPointInWorld[2], 2))
     
+  def setTrajectoryModels(self, modelNodes):
+    self.trajectoryModels = [modelNode for modelNode in modelNodes if modelNode]
+    for modelNode in self.trajectoryModels:
+      self.updateTrajectoryObbTree(modelNode)
+
+  def setTrajectoryForecastEnabled(self, enabled):
+    self.trajectoryForecastEnabled = enabled
+
+  def setOutputTrajectoryLabel(self, label):
+    self.outputTrajectoryLabel = label
+
+  def updateTrajectoryObbTree(self, modelNode):
+    # Rebuild the tree only if the mesh itself changed, moving the model does not require a rebuild
+    polyData = modelNode.GetPolyData()
+    if not polyData or polyData.GetNumberOfCells() == 0:
+      return None
+    obbTreeEntry = self.trajectoryObbTrees.get(modelNode.GetID())
+    if obbTreeEntry and obbTreeEntry[1] is polyData and obbTreeEntry[2] == polyData.GetMTime():
+      return obbTreeEntry[0]
+    obbTree = vtk.vtkOBBTree()
+    obbTree.SetDataSet(polyData)
+    obbTree.BuildLocator()
+    self.trajectoryObbTrees[modelNode.GetID()] = [obbTree, polyData, polyData.GetMTime()]
+    logging.info('Trajectory OBB tree built for ' + modelNode.GetName())
+    return obbTree
+
+  def calculateTrajectoryIntersection(self, tipToWorldMatrix):
+    """Casts a ray from the needle tip along the needle axis against the trajectory models.
+    Returns (distance in mm, entry point in world coordinates, model node, tip is inside) of the first hit, or None.
+    If the tip is already inside a model, the distance is 0 and the entry point is the tip.
+    """
+    # no logging - it slows Slicer down a *lot*
+    tipPointInWorld = [tipToWorldMatrix.GetElement(0, 3), tipToWorldMatrix.GetElement(1, 3), tipToWorldMatrix.GetElement(2, 3), 1.0]
+    directionInWorld = tipToWorldMatrix.MultiplyPoint(self.needleDirectionInTip + [0.0])
+    directionLength = math.sqrt(directionInWorld[0]*directionInWorld[0] + directionInWorld[1]*directionInWorld[1] + directionInWorld[2]*directionInWorld[2])
+    if directionLength == 0:
+      return None
+    scale = self.trajectoryLengthMm / directionLength
+    rayEndInWorld = [tipPointInWorld[0] + scale*directionInWorld[0], tipPointInWorld[1] + scale*directionInWorld[1], tipPointInWorld[2] + scale*directionInWorld[2], 1.0]
+
+    firstHit = None
+    for modelNode in self.trajectoryModels:
+      obbTree = self.updateTrajectoryObbTree(modelNode)
+      if not obbTree:
+        continue
+      # Ray to model coordinates
+      modelTransformNode = modelNode.GetParentTransformNode()
+      if modelTransformNode:
+        self.getMatrixTransformToWorld(modelTransformNode, self.trajectoryModelToWorldMatrix)
+      else:
+        self.trajectoryModelToWorldMatrix.Identity()
+      vtk.vtkMatrix4x4.Invert(self.trajectoryModelToWorldMatrix, self.worldToTrajectoryModelMatrix)
+      rayStartInModel = self.worldToTrajectoryModelMatrix.MultiplyPoint(tipPointInWorld)
+      rayEndInModel = self.worldToTrajectoryModelMatrix.MultiplyPoint(rayEndInWorld)
+
+      # 1 if the ray starts outside of the model, -1 if it starts inside, 0 if it does not hit the model
+      intersection = obbTree.IntersectWithLine(rayStartInModel[0:3], rayEndInModel[0:3], self.trajectoryIntersectionPoints, self.trajectoryIntersectionCellIds)
+      if intersection == 0:
+        continue
+      if intersection < 0:
+        # the first intersection is where the ray leaves the model
+        firstHit = (0.0, tipPointInWorld[0:3], modelNode, True)
+        continue
+      # Intersections are sorted along the ray, the first one is the entry point
+      entryPointInWorld = self.trajectoryModelToWorldMatrix.MultiplyPoint(self.trajectoryIntersectionPoints.GetPoint(0) + (1.0,))
+      distance = math.sqrt(math.pow(tipPointInWorld[0]-entryPointInWorld[0], 2) + math.pow(tipPointInWorld[1]-entryPointInWorld[1], 2) + math.pow(tipPointInWorld[2]-entryPointInWorld[2], 2))
+      if not firstHit or distance < firstHit[0]:
+        firstHit = (distance, entryPointInWorld[0:3], modelNode, False)
+    return firstHit
+
+  def initializeLineGeometry(self):
+    # The line is built once with two points and one cell, afterwards only the point coordinates are updated
+    linePolyData = self.line.GetPolyData()
+    if not linePolyData:
+      linePolyData = vtk.vtkPolyData()
+      self.line.SetAndObservePolyData(linePolyData)
+    if linePolyData.GetNumberOfPoints() != 2 or linePolyData.GetNumberOfLines() != 1:
+      points = vtk.vtkPoints()
+      points.SetNumberOfPoints(2)
+      points.SetPoint(0, 0, 0, 0)
+      points.SetPoint(1, 0, 0, 0)
+
+      # Create line
+      line = vtk.vtkLine()
+      line.GetPointIds().SetId(0,0) 
+      line.GetPointIds().SetId(1,1)
+      lineCellArray = vtk.vtkCellArray()
+      lineCellArray.InsertNextCell(line)
+
+      linePolyData.SetPoints(points)
+      linePolyData.SetLines(lineCellArray)
+    self.linePolyData = linePolyData
+    self.linePoints = linePolyData.GetPoints()
+
   def drawLineBetweenPoints(self, point1, point2):        
-    # Create a vtkPoints object and store the points in it
-    points = vtk.vtkPoints()
-    points.InsertNextPoint(point1)
-    points.InsertNextPoint(point2)
-
-    # Create line
-    line = vtk.vtkLine()
-    line.GetPointIds().SetId(0,0) 
-    line.GetPointIds().SetId(1,1)
-    lineCellArray = vtk.vtkCellArray()
-    lineCellArray.InsertNextCell(line)
-    
-    # Update model data
-    self.line.GetPolyData().SetPoints(points)
-    self.line.GetPolyData().SetLines(lineCellArray)
+    # Update the existing points in place. SetPoint does not touch the MTime of the points, which the mapper
+    # and the bounds depend on, so mark them modified; the poly data Modified() notifies the model node
+    self.linePoints.SetPoint(0, point1)
+    self.linePoints.SetPoint(1, point2)
+    self.linePoints.Modified()
+    self.linePolyData.Modified()
 
   def setOutPutDistanceLabel(self, label):
     self.outputDistanceLabel = label
 
+  def setCachedClippingRangeEnabled(self, enabled):
+    self.viewpointLogic.setCachedClippingRangeEnabled(enabled)
+    for viewpointLogic, threeDView in self.viewBindings.values():
+      if viewpointLogic:
+        viewpointLogic.setCachedClippingRangeEnabled(enabled)
+
+  def setFrameBatchingEnabled(self, enabled):
+    self.frameTransaction.setBatchingEnabled(enabled)
+    self.frameTransaction.resetStatistics()
+
+  def getRenderStatistics(self):
+    return self.frameTransaction.getStatistics()
+
+  def setOutputNearestTargetLabel(self, label):
+    self.outputNearestTargetLabel = label
+
+  def startPivotCalibration(self, toolToTrackerTransformNode):
+    self.pivotCalibration.start(toolToTrackerTransformNode)
+
+  def getPivotCalibrationResult(self):
+    if not self.pivotCalibration.updateSolution():
+      return None
+    return self.pivotCalibration.getResult()
+
+  def stopPivotCalibration(self, toolTipToToolTransformNode):
+    """Stops collecting, rejects outliers and writes the calibrated tip position into toolTipToToolTransformNode.
+    Returns the calibration result, or None if the samples do not determine the tip.
+    """
+    self.pivotCalibration.stop()
+    numberOfRejectedSamples = self.pivotCalibration.rejectOutliers()
+    if not self.pivotCalibration.updateSolution():
+      logging.error('Pivot calibration failed: collect more samples while pivoting the tool over a wider range')
+      return None
+    self.pivotCalibration.applyToTransformNode(toolTipToToolTransformNode)
+    result = self.pivotCalibration.getResult()
+    logging.info('Pivot calibration of %s: RMS error %.2f mm, %d of %d samples rejected' % (toolTipToToolTransformNode.GetName(), result['rmsErrorMm'], numberOfRejectedSamples, result['samples']))
+    return result
+
+  def setRegistrationFiducials(self, fiducialNode, pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode):
+    self.pairedPointRegistration.setFiducials(fiducialNode)
+    self.pairedPointRegistration.setTransformNodes(pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode)
+
+  def startCollectingFiducial(self, fiducialIndex):
+    self.pairedPointRegistration.clearSamples(fiducialIndex)
+    self.pairedPointRegistration.startCollecting(fiducialIndex)
+
+  def stopCollectingFiducial(self):
+    self.pairedPointRegistration.stopCollecting()
+
+  def registerPatientToReference(self, patientToReferenceTransformNode):
+    if self.pairedPointRegistration.register() is None:
+      return None
+    patientToReferenceMatrix = vtk.vtkMatrix4x4()
+    self.pairedPointRegistration.getPatientToReferenceMatrix(patientToReferenceMatrix)
+    patientToReferenceTransformNode.SetMatrixTransformToParent(patientToReferenceMatrix)
+    return self.pairedPointRegistration.fiducialRegistrationError
+
+  def setSurfaceRegistrationNodes(self, surfaceModelNode, pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode):
+    self.surfaceRegistration.setTransformNodes(pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode)
+    return self.surfaceRegistration.setSurfaceModel(surfaceModelNode)
+
+  def startCollectingSurfacePoints(self):
+    self.surfaceRegistration.startCollecting()
+
+  def stopCollectingSurfacePoints(self):
+    self.surfaceRegistration.stopCollecting()
+
+  def clearSurfacePoints(self):
+    self.surfaceRegistration.clearSamples()
+
+  def refinePatientToReference(self, patientToReferenceTransformNode, iterationCallback=None, finishedCallback=None):
+    """Runs surface ICP in the background, starting from the current PatientToReference.
+    The refined transform is written into the node on the main thread when the registration finishes.
+    """
+    initialMatrix = vtk.vtkMatrix4x4()
+    patientToReferenceTransformNode.GetMatrixTransformToParent(initialMatrix)
+    initialPatientToReference = np.array([[initialMatrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+    def onFinished(success):
+      if success:
+        patientToReferenceMatrix = vtk.vtkMatrix4x4()
+        self.surfaceRegistration.getPatientToReferenceMatrix(patientToReferenceMatrix)
+        patientToReferenceTransformNode.SetMatrixTransformToParent(patientToReferenceMatrix)
+      if finishedCallback:
+        finishedCallback(success)
+
+    return self.surfaceRegistration.start(initialPatientToReference, iterationCallback, onFinished)
+
+  def startTrackingRecording(self, trackerTransformNodes):
+    self.trackingRecorder.setTransformNodes(trackerTransformNodes)
+    self.trackingRecorder.clear()
+    self.trackingRecorder.startRecording()
+
+  def stopTrackingRecording(self):
+    self.trackingRecorder.stopRecording()
+
+  def saveTrackingRecording(self, fileName):
+    self.trackingRecorder.save(fileName)
+
+  def replayTrackingRecording(self, fileName, realTime=True):
+    self.trackingReplayer.load(fileName)
+    if realTime:
+      self.trackingReplayer.startRealTimeReplay()
+      return None
+    # Without returning to the event loop tracker frames would never end, the replayer renders by itself
+    batchingEnabled = self.frameTransaction.batchingEnabled
+    self.frameTransaction.setBatchingEnabled(False)
+    statistics = self.trackingReplayer.replayAsFastAsPossible()
+    self.frameTransaction.setBatchingEnabled(batchingEnabled)
+    return statistics
+
   def transformTargetFiducial(self, patientToReferenceTransformNode, referenceToTrackerTransformNode):
     self.targetFiducial.SetAndObserveTransformNodeID(patientToReferenceTransformNode.GetID())
-      
 
 
+#
+# NodeRegistry
+#
+
+class NodeRegistry:
+  """Resolves nodes by name with a single scene scan and afterwards returns them by ID.
+  Names that were not found are remembered until a node is added to the scene, and all
+  entries are invalidated when a node is removed or the scene is closed.
+  Nodes of a class are collected with one scene scan and kept until a node is added or removed.
+  """
+  def __init__(self, scene=None, callbackProfiler=None):
+    self.scene = scene if scene else slicer.mrmlScene
+    if callbackProfiler:
+      callbackProfiler.instrumentMethods(self, ['onNodeAdded', 'onNodeRemoved'])
+    self.nodeIDs = {} # node name: node ID
+    self.missingNodeNames = set()
+    self.classNodeIDs = {} # class name: list of node IDs
+    self.observerTags = []
+    self.observerTags.append(self.scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded))
+    for event in [slicer.vtkMRMLScene.NodeRemovedEvent, slicer.vtkMRMLScene.EndCloseEvent]:
+      self.observerTags.append(self.scene.AddObserver(event, self.onNodeRemoved))
+
+  def removeObservers(self):
+    for tag in self.observerTags:
+      self.scene.RemoveObserver(tag)
+    self.observerTags = []
+
+  def onNodeAdded(self, caller, event=None):
+    # a new node never replaces an already resolved one (it comes later in the scene), but it may be a missing one
+    self.missingNodeNames.clear()
+    self.classNodeIDs = {}
+
+  def onNodeRemoved(self, caller, event=None):
+    self.nodeIDs = {}
+    self.missingNodeNames.clear()
+    self.classNodeIDs = {}
+
+  def getNode(self, nodeName):
+    """Returns the first node with the given name, or None if there is no such node.
+    """
+    nodeID = self.nodeIDs.get(nodeName)
+    if nodeID:
+      node = self.scene.GetNodeByID(nodeID)
+      # the node may have been renamed since it was resolved
+      if node and node.GetName() == nodeName:
+        return node
+    elif nodeName in self.missingNodeNames:
+      return None
+    node = self.scene.GetFirstNodeByName(nodeName)
+    if node:
+      self.nodeIDs[nodeName] = node.GetID()
+    else:
+      self.missingNodeNames.add(nodeName)
+    return node
+
+  def getNodesByClass(self, className):
+    """Returns all nodes of the given class (including subclasses) in scene order.
+    """
+    nodeIDs = self.classNodeIDs.get(className)
+    if nodeIDs is None:
+      nodeIDs = [self.scene.GetNthNodeByClass(nodeIndex, className).GetID()
+        for nodeIndex in range(self.scene.GetNumberOfNodesByClass(className))]
+      self.classNodeIDs[className] = nodeIDs
+    return [self.scene.GetNodeByID(nodeID) for nodeID in nodeIDs]
+
+#
+# FrameTransaction
+#
+
+class FrameTransaction:
+  """Groups the scene and panel updates caused by one tracker frame so that the frame is rendered once.
+  The first tracker transform event of a frame opens the transaction: rendering of the views is paused, the
+  batched nodes are put in StartModify state and label texts are deferred. OpenIGTLink delivers all transforms of
+  a frame in the same event loop pass, so a zero interval timer closes the transaction after the last of them:
+  the nodes are released, the labels and the pending viewpoint camera updates are applied and every view is
+  rendered exactly once. Renders are counted on the render windows, so the renders per tracker frame are
+  measured whether batching is enabled or not. End frame callbacks run once per frame, after all transforms
+  of the frame have arrived and before the labels are applied.
+  """
+  def __init__(self, viewpointLogic=None, views=None):
+    self.viewpointLogics = [viewpointLogic] if viewpointLogic else []
+    self.views = views if views else []
+    self.batchingEnabled = True
+    self.trackerTransformNodes = []
+    self.batchedNodes = []
+    self.trackerObserverTags = []
+    self.renderObserverTags = []
+    self.inFrame = False
+    self.nodeModifyStates = []
+    self.deferredLabelTexts = {}
+    self.endFrameCallbacks = []
+    self.endFrameTimer = qt.QTimer()
+    self.endFrameTimer.setSingleShot(True)
+    self.endFrameTimer.setInterval(0)
+    self.endFrameTimer.connect('timeout()', lambda: self.endFrame()) # looked up on every call, endFrame may be instrumented
+    self.resetStatistics()
+
+  def setTrackerTransformNodes(self, trackerTransformNodes):
+    self.trackerTransformNodes = [transformNode for transformNode in trackerTransformNodes if transformNode]
+
+  def setBatchedNodes(self, nodes):
+    self.batchedNodes = [node for node in nodes if node]
+
+  def addEndFrameCallback(self, callback):
+    self.endFrameCallbacks.append(callback)
+
+  def addViewpointLogic(self, viewpointLogic):
+    if viewpointLogic not in self.viewpointLogics:
+      self.viewpointLogics.append(viewpointLogic)
+
+  def removeViewpointLogic(self, viewpointLogic):
+    if viewpointLogic in self.viewpointLogics:
+      self.viewpointLogics.remove(viewpointLogic)
+
+  def addView(self, view):
+    if view in self.views:
+      return
+    self.views.append(view)
+    if self.trackerObserverTags:
+      self.addRenderObserver(view)
+    if self.inFrame and self.batchingEnabled:
+      view.setRenderEnabled(False)
+
+  def removeView(self, view):
+    if view not in self.views:
+      return
+    self.views.remove(view)
+    renderWindow = view.renderWindow()
+    for observerTag in [observerTag for observerTag in self.renderObserverTags if observerTag[0] is renderWindow]:
+      renderWindow.RemoveObserver(observerTag[1])
+      self.renderObserverTags.remove(observerTag)
+    view.setRenderEnabled(True)
+
+  def addRenderObserver(self, view):
+    renderWindow = view.renderWindow()
+    self.renderObserverTags.append([renderWindow, renderWindow.AddObserver(vtk.vtkCommand.EndEvent, self.onRenderEnd)])
+
+  def setBatchingEnabled(self, enabled):
+    if not enabled and self.inFrame:
+      self.endFrame()
+    self.batchingEnabled = enabled
+
+  def start(self):
+    self.stop()
+    for transformNode in self.trackerTransformNodes:
+      # high priority: the frame must be open before the other observers of the tracker transforms run
+      self.trackerObserverTags.append([transformNode, transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTrackerTransformModified, 1.0)])
+    for view in self.views:
+      self.addRenderObserver(view)
+    self.resetStatistics()
+
+  def stop(self):
+    if self.inFrame:
+      self.endFrame()
+    for observedObject, tag in self.trackerObserverTags + self.renderObserverTags:
+      observedObject.RemoveObserver(tag)
+    self.trackerObserverTags = []
+    self.renderObserverTags = []
+
+  def resetStatistics(self):
+    self.numberOfFrames = 0
+    self.numberOfRenders = 0
+
+  def getStatistics(self):
+    rendersPerFrame = float(self.numberOfRenders) / self.numberOfFrames if self.numberOfFrames else 0.0
+    return {'frames': self.numberOfFrames, 'renders': self.numberOfRenders, 'rendersPerFrame': rendersPerFrame}
+
+  def onTrackerTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    self.beginFrame()
+
+  def onRenderEnd(self, caller, event=None):
+    self.numberOfRenders += 1
+
+  def beginFrame(self):
+    if self.inFrame:
+      return
+    self.inFrame = True
+    self.numberOfFrames += 1
+    self.endFrameTimer.start()
+    if not self.batchingEnabled:
+      return
+    for view in self.views:
+      view.setRenderEnabled(False)
+    self.nodeModifyStates = [[node, node.StartModify()] for node in self.batchedNodes]
+
+  def setLabelText(self, label, text):
+    # no logging - it slows Slicer down a *lot*
+    if self.inFrame and self.batchingEnabled:
+      self.deferredLabelTexts[label] = text # only the last text of the frame is shown
+    else:
+      label.setText(text)
+
+  def endFrame(self):
+    # no logging - it slows Slicer down a *lot*
+    if not self.inFrame:
+      return
+    self.endFrameTimer.stop()
+    for callback in self.endFrameCallbacks:
+      callback()
+    self.inFrame = False
+    if not self.batchingEnabled:
+      return
+    for node, wasModifying in self.nodeModifyStates:
+      node.EndModify(wasModifying)
+    self.nodeModifyStates = []
+    for label, text in self.deferredLabelTexts.items():
+      label.setText(text)
+    self.deferredLabelTexts = {}
+    for viewpointLogic in self.viewpointLogics:
+      if viewpointLogic.cameraUpdatePending:
+        # the camera moves in the same render as the tools instead of in a render of its own
+        viewpointLogic.flushViewpointCameraUpdate()
+    for view in self.views:
+      view.setRenderEnabled(True)
+      view.forceRender()
+
+#
+# PoseCache
+#
+
+class PoseCache:
+  """Per-frame cache of the world matrices of transform nodes, shared by all cameras and distance computations.
+  The first request for a node in a frame computes its matrix, later requests copy it. Every tracker transform
+  event invalidates the whole cache (observed with high priority, before any consumer can read it), as does
+  a change of any cached node or its parents (e.g. a calibration or registration update).
+  """
+  def __init__(self, computeMatrixTransformToWorld):
+    self.computeMatrixTransformToWorld = computeMatrixTransformToWorld
+    self.generation = 0
+    self.entries = {} # node ID: [node, observer tag, matrix, generation of the matrix]
+    self.trackerTransformNodes = []
+    self.trackerObserverTags = []
+    self.resetStatistics()
+
+  def setTrackerTransformNodes(self, trackerTransformNodes):
+    for transformNode, tag in self.trackerObserverTags:
+      transformNode.RemoveObserver(tag)
+    self.trackerTransformNodes = [transformNode for transformNode in trackerTransformNodes if transformNode]
+    self.trackerObserverTags = [[transformNode, transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTransformModified, 1.0)] for transformNode in self.trackerTransformNodes]
+    self.invalidate()
+
+  def clear(self):
+    self.setTrackerTransformNodes([])
+    for transformNode, tag, matrix, generation in self.entries.values():
+      transformNode.RemoveObserver(tag)
+    self.entries = {}
+
+  def removeTransformNodes(self, transformNodes):
+    for transformNode in transformNodes:
+      entry = self.entries.pop(transformNode.GetID(), None)
+      if entry:
+        transformNode.RemoveObserver(entry[1])
+
+  def invalidate(self):
+    self.generation += 1
 
+  def onTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    self.generation += 1
 
+  def resetStatistics(self):
+    self.numberOfRequests = 0
+    self.numberOfComputations = 0
+
+  def getStatistics(self):
+    return {'requests': self.numberOfRequests, 'computations': self.numberOfComputations}
+
+  def getMatrixTransformToWorld(self, transformNode, matrix):
+    # no logging - it slows Slicer down a *lot*
+    self.numberOfRequests += 1
+    entry = self.entries.get(transformNode.GetID())
+    if entry is None:
+      entry = [transformNode, transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTransformModified), vtk.vtkMatrix4x4(), -1]
+      self.entries[transformNode.GetID()] = entry
+    if entry[3] != self.generation:
+      self.computeMatrixTransformToWorld(transformNode, entry[2])
+      entry[3] = self.generation
+      self.numberOfComputations += 1
+    matrix.DeepCopy(entry[2])
+
+#
+# ToolRegistry
+#
+
+class ToolRegistry:
+  """Tracked tools (needles, pointers) with their tip calibrations (ToolTipToTool), tip offsets and directions in the
+  tip coordinate system stored in stacked arrays. A calibration is copied into the stack only when its transform
+  changes. Per frame the pose of the parent of each tip transform (the tracker or predicted transform) is read from
+  the pose cache, so tracker matrices are shared with the cameras, then the tip poses, positions, directions and the
+  tool to target distances of all tools are computed in one vectorized step. Only the pose gathering loops over the tools.
+  """
+  def __init__(self, poseCache):
+    self.poseCache = poseCache
+    self.toolNames = []
+    self.toolToTrackerTransformNodes = []
+    self.toolTipToToolTransformNodes = []
+    self.toolCameraToToolTransformNodes = []
+    self.tipOffsetsInTip = np.zeros((0, 3))
+    self.directionsInTip = np.zeros((0, 3))
+    self.hasDirection = np.zeros(0, dtype=bool)
+    self.tipToToolMatrices = np.zeros((0, 4, 4))
+    self.tipToToolMTimes = [] # modification time of each calibration transform when it was copied into the stack
+    self.toolToWorldElements = []
+    self.toolToWorldMatrix = vtk.vtkMatrix4x4()
+    self.generation = -1
+    self.targetPositionsInWorld = np.zeros((0, 3))
+    self.clearResults()
+
+  def clearResults(self):
+    numberOfTools = len(self.toolNames)
+    self.tipToWorld = np.tile(np.eye(4), (numberOfTools, 1, 1))
+    self.tipPositions = np.zeros((numberOfTools, 3))
+    self.tipDirections = np.zeros((numberOfTools, 3))
+    self.targetDistances = np.zeros((numberOfTools, 0))
+    self.nearestTargetIndices = -np.ones(numberOfTools, dtype=int)
+    self.nearestTargetDistances = np.zeros(numberOfTools)
+    self.nearestTargetDepths = np.zeros(numberOfTools)
+    self.nearestTargetLateralOffsets = np.zeros(numberOfTools)
+    self.generation = -1
+
+  def setTool(self, toolName, toolToTrackerTransformNode, toolTipToToolTransformNode, toolCameraToToolTransformNode=None, directionInTip=(-1.0, 0.0, 0.0), tipOffsetInTip=(0.0, 0.0, 0.0)):
+    """Adds a tool, or replaces the tool of the same name. tipOffsetInTip moves the tracked point away from the
+    calibrated tip, e.g. to the center of the ablation zone of a needle. directionInTip is None for tools without
+    a meaningful axis, their depth and off-axis distance are not computed.
+    """
+    if toolName in self.toolNames:
+      self.removeTool(toolName)
+    self.toolNames.append(toolName)
+    self.toolToTrackerTransformNodes.append(toolToTrackerTransformNode)
+    self.toolTipToToolTransformNodes.append(toolTipToToolTransformNode)
+    self.toolCameraToToolTransformNodes.append(toolCameraToToolTransformNode)
+    direction = np.zeros(3) if directionInTip is None else np.array(directionInTip, dtype=float) / np.linalg.norm(directionInTip)
+    self.directionsInTip = np.vstack([self.directionsInTip, direction])
+    self.hasDirection = np.append(self.hasDirection, directionInTip is not None)
+    self.tipOffsetsInTip = np.vstack([self.tipOffsetsInTip, np.array(tipOffsetInTip, dtype=float)])
+    self.tipToToolMatrices = np.concatenate([self.tipToToolMatrices, np.eye(4)[np.newaxis]])
+    self.tipToToolMTimes.append(None)
+    self.toolToWorldElements.append([0.0] * 16)
+    self.clearResults()
+
+  def removeTool(self, toolName):
+    if toolName not in self.toolNames:
+      return
+    toolIndex = self.toolNames.index(toolName)
+    for toolList in [self.toolNames, self.toolToTrackerTransformNodes, self.toolTipToToolTransformNodes, self.toolCameraToToolTransformNodes, self.tipToToolMTimes, self.toolToWorldElements]:
+      del toolList[toolIndex]
+    self.tipToToolMatrices = np.delete(self.tipToToolMatrices, toolIndex, axis=0)
+    self.directionsInTip = np.delete(self.directionsInTip, toolIndex, axis=0)
+    self.hasDirection = np.delete(self.hasDirection, toolIndex)
+    self.tipOffsetsInTip = np.delete(self.tipOffsetsInTip, toolIndex, axis=0)
+    self.clearResults()
+
+  def getNumberOfTools(self):
+    return len(self.toolNames)
+
+  def getTool(self, toolName):
+    if toolName not in self.toolNames:
+      return None
+    toolIndex = self.toolNames.index(toolName)
+    return {'toolToTracker': self.toolToTrackerTransformNodes[toolIndex],
+      'toolTipToTool': self.toolTipToToolTransformNodes[toolIndex],
+      'toolCameraToTool': self.toolCameraToToolTransformNodes[toolIndex],
+      'tipPosition': self.tipPositions[toolIndex],
+      'tipDirection': self.tipDirections[toolIndex]}
+
+  def updateCalibrations(self):
+    """Copies the calibrations that changed since the last call into the stack. Returns True if any did."""
+    # no logging - it slows Slicer down a *lot*
+    calibrationModified = False
+    for toolIndex, toolTipToToolTransformNode in enumerate(self.toolTipToToolTransformNodes):
+      mTime = toolTipToToolTransformNode.GetTransformToParent().GetMTime()
+      if mTime == self.tipToToolMTimes[toolIndex]:
+        continue
+      toolTipToToolTransformNode.GetMatrixTransformToParent(self.toolToWorldMatrix)
+      tipToTool = self.tipToToolMatrices[toolIndex]
+      for row in range(4):
+        for column in range(4):
+          tipToTool[row, column] = self.toolToWorldMatrix.GetElement(row, column)
+      self.tipToToolMTimes[toolIndex] = mTime
+      calibrationModified = True
+    return calibrationModified
+
+  def update(self, targetPositionsInWorld):
+    """Returns False if neither the poses, the calibrations nor the targets changed since the last update."""
+    # no logging - it slows Slicer down a *lot*
+    calibrationModified = self.updateCalibrations()
+    if not calibrationModified and self.generation == self.poseCache.generation and targetPositionsInWorld is self.targetPositionsInWorld:
+      return False
+    self.generation = self.poseCache.generation
+    self.targetPositionsInWorld = targetPositionsInWorld
+    if not self.toolNames:
+      return True
+
+    # Gather: one pose cache lookup per tool for the parent of its tip transform, the matrices are copied into nested
+    # lists and converted at once, then composed with the stacked calibrations
+    matrix = self.toolToWorldMatrix
+    for toolTipToToolTransformNode, elements in zip(self.toolTipToToolTransformNodes, self.toolToWorldElements):
+      toolTransformNode = toolTipToToolTransformNode.GetParentTransformNode()
+      if toolTransformNode:
+        self.poseCache.getMatrixTransformToWorld(toolTransformNode, matrix)
+      else:
+        matrix.Identity()
+      vtk.vtkMatrix4x4.DeepCopy(elements, matrix)
+    toolToWorld = np.array(self.toolToWorldElements).reshape((-1, 4, 4))
+    tipToWorld = np.einsum('nij,njk->nik', toolToWorld, self.tipToToolMatrices)
+    self.tipToWorld = tipToWorld
+
+    # Tips and directions of all tools
+    rotations = tipToWorld[:, 0:3, 0:3]
+    self.tipPositions = np.einsum('nij,nj->ni', rotations, self.tipOffsetsInTip) + tipToWorld[:, 0:3, 3]
+    self.tipDirections = np.einsum('nij,nj->ni', rotations, self.directionsInTip)
+
+    # Tool to target distances, and the position of the nearest target of each tool relative to the tool axis
+    numberOfTools = len(self.toolNames)
+    if len(targetPositionsInWorld) == 0:
+      self.targetDistances = np.zeros((numberOfTools, 0))
+      self.nearestTargetIndices = -np.ones(numberOfTools, dtype=int)
+      self.nearestTargetDistances = np.zeros(numberOfTools)
+      self.nearestTargetDepths = np.zeros(numberOfTools)
+      self.nearestTargetLateralOffsets = np.zeros(numberOfTools)
+      return True
+    tipToTargets = targetPositionsInWorld[np.newaxis, :, :] - self.tipPositions[:, np.newaxis, :]
+    self.targetDistances = np.sqrt(np.einsum('ntk,ntk->nt', tipToTargets, tipToTargets))
+    self.nearestTargetIndices = np.argmin(self.targetDistances, axis=1)
+    toolIndices = np.arange(numberOfTools)
+    self.nearestTargetDistances = self.targetDistances[toolIndices, self.nearestTargetIndices]
+    self.nearestTargetDepths = np.einsum('nk,nk->n', tipToTargets[toolIndices, self.nearestTargetIndices], self.tipDirections)
+    self.nearestTargetLateralOffsets = np.sqrt(np.maximum(self.nearestTargetDistances ** 2 - self.nearestTargetDepths ** 2, 0.0))
+    self.nearestTargetDepths[~self.hasDirection] = np.nan
+    self.nearestTargetLateralOffsets[~self.hasDirection] = np.nan
+    return True
+
+  def getNearestTargets(self):
+    """Returns (tool name, nearest target index or -1, distance, depth along the tool direction, off-axis distance)
+    for each tool, as of the last update. Depth is positive if the target is ahead of the tip. Depth and off-axis
+    distance are NaN for tools without a direction.
+    """
+    return [(self.toolNames[toolIndex], int(self.nearestTargetIndices[toolIndex]), float(self.nearestTargetDistances[toolIndex]),
+      float(self.nearestTargetDepths[toolIndex]), float(self.nearestTargetLateralOffsets[toolIndex])) for toolIndex in range(len(self.toolNames))]
+
+#
+# NeedleSliceReslicer
+#
+
+class NeedleSliceReslicer:
+  """Reslices the Red view perpendicular to the needle and the Yellow and Green views along the needle, through the tip.
+  Transform events only mark the slices as outdated; a single-shot timer applies at most one update per interval
+  (latest pose wins), and updates are skipped while the tip moves less than the translation and rotation thresholds.
+  SliceToRAS matrices are modified in place, the original orientations are restored when reslicing stops.
+  """
+  # Slice axes (x, y, normal) as signed axes of the NeedleTip coordinate system, in which the needle advances along -X
+  sliceAxesInTip = {
+    'Red': [(1, 1.0), (2, 1.0), (0, 1.0)], # perpendicular to the needle
+    'Yellow': [(2, 1.0), (0, 1.0), (1, 1.0)], # along the needle, needle shown vertically
+    'Green': [(1, 1.0), (0, 1.0), (2, -1.0)]} # along the needle, orthogonal to Yellow
+
+  def __init__(self, computeMatrixTransformToWorld):
+    self.computeMatrixTransformToWorld = computeMatrixTransformToWorld
+    self.needleTipTransformNode = None
+    self.observerTag = None
+    self.sliceNodes = {}
+    self.originalSliceToRASMatrices = {}
+    self.maximumUpdateRateHz = 20.0
+    self.minimumTranslationMm = 0.5
+    self.minimumRotationDeg = 0.5
+    self.updatePending = False
+    self.lastUpdateTimeSec = 0.0
+    self.tipToWorldMatrix = vtk.vtkMatrix4x4()
+    self.lastAppliedTipToWorldMatrix = None
+    self.updateTimer = qt.QTimer()
+    self.updateTimer.setSingleShot(True)
+    self.updateTimer.connect('timeout()', lambda: self.onUpdateTimerTimeout()) # looked up on every call, may be instrumented
+    self.resetStatistics()
+
+  def resetStatistics(self):
+    self.numberOfEvents = 0
+    self.numberOfUpdates = 0
+    self.numberOfSkippedUpdates = 0
+
+  def getStatistics(self):
+    return {'events': self.numberOfEvents, 'updates': self.numberOfUpdates, 'skippedUpdates': self.numberOfSkippedUpdates}
+
+  def start(self, needleTipTransformNode, sliceViewNames=('Red', 'Yellow', 'Green')):
+    self.stop()
+    self.needleTipTransformNode = needleTipTransformNode
+    self.sliceNodes = {}
+    self.originalSliceToRASMatrices = {}
+    for sliceViewName in sliceViewNames:
+      sliceNode = slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNode' + sliceViewName)
+      if not sliceNode:
+        continue
+      self.sliceNodes[sliceViewName] = sliceNode
+      originalSliceToRASMatrix = vtk.vtkMatrix4x4()
+      originalSliceToRASMatrix.DeepCopy(sliceNode.GetSliceToRAS())
+      self.originalSliceToRASMatrices[sliceViewName] = originalSliceToRASMatrix
+    self.lastAppliedTipToWorldMatrix = None
+    self.resetStatistics()
+    self.observerTag = needleTipTransformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onNeedleTransformModified)
+    self.updatePending = True
+    self.onUpdateTimerTimeout()
+
+  def stop(self):
+    if self.observerTag is None:
+      return
+    self.needleTipTransformNode.RemoveObserver(self.observerTag)
+    self.observerTag = None
+    self.updateTimer.stop()
+    self.updatePending = False
+    for sliceViewName, sliceNode in self.sliceNodes.items():
+      sliceNode.GetSliceToRAS().DeepCopy(self.originalSliceToRASMatrices[sliceViewName])
+      sliceNode.UpdateMatrices()
+
+  def onNeedleTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    self.numberOfEvents += 1
+    self.updatePending = True
+    if self.updateTimer.isActive():
+      return # an update is already scheduled, it will use the latest pose
+    minimumIntervalSec = 1.0 / self.maximumUpdateRateHz if self.maximumUpdateRateHz > 0 else 0.0
+    delayMs = max(0, int((minimumIntervalSec - (time.time() - self.lastUpdateTimeSec)) * 1000))
+    self.updateTimer.start(delayMs)
+
+  def onUpdateTimerTimeout(self):
+    # no logging - it slows Slicer down a *lot*
+    if not self.updatePending or self.observerTag is None:
+      return
+    self.updatePending = False
+    self.lastUpdateTimeSec = time.time()
+    self.computeMatrixTransformToWorld(self.needleTipTransformNode, self.tipToWorldMatrix)
+    if not self.isMotionAboveThreshold(self.tipToWorldMatrix):
+      self.numberOfSkippedUpdates += 1
+      return
+    self.applySliceOrientations(self.tipToWorldMatrix)
+    if not self.lastAppliedTipToWorldMatrix:
+      self.lastAppliedTipToWorldMatrix = vtk.vtkMatrix4x4()
+    self.lastAppliedTipToWorldMatrix.DeepCopy(self.tipToWorldMatrix)
+    self.numberOfUpdates += 1
+
+  def isMotionAboveThreshold(self, tipToWorldMatrix):
+    last = self.lastAppliedTipToWorldMatrix
+    if not last:
+      return True
+    squaredTranslationMm = 0.0
+    trace = 0.0 # trace of inverse(last) * current rotation, gives the rotation angle between the two poses
+    for row in range(3):
+      squaredTranslationMm += (tipToWorldMatrix.GetElement(row, 3) - last.GetElement(row, 3)) ** 2
+      for column in range(3):
+        trace += last.GetElement(row, column) * tipToWorldMatrix.GetElement(row, column)
+    if squaredTranslationMm >= self.minimumTranslationMm ** 2:
+      return True
+    cosAngle = max(-1.0, min(1.0, (trace - 1.0) / 2.0))
+    return math.degrees(math.acos(cosAngle)) >= self.minimumRotationDeg
+
+  def applySliceOrientations(self, tipToWorldMatrix):
+    for sliceViewName, sliceNode in self.sliceNodes.items():
+      sliceToRAS = sliceNode.GetSliceToRAS()
+      for sliceAxis, (tipAxis, sign) in enumerate(self.sliceAxesInTip[sliceViewName]):
+        for row in range(3):
+          sliceToRAS.SetElement(row, sliceAxis, sign * tipToWorldMatrix.GetElement(row, tipAxis))
+      for row in range(3):
+        sliceToRAS.SetElement(row, 3, tipToWorldMatrix.GetElement(row, 3))
+      sliceNode.UpdateMatrices()
+
+#
+# ModelLoader
+#
+
+class ModelLoader:
+  """Reads STL models in a background thread and adds them to the scene on the main thread.
+  The cleaned poly data with computed normals is cached as binary VTP, keyed by the hash of the STL file,
+  so that later loads skip the STL parsing and preprocessing.
+  Points are converted to RAS the same way vtkMRMLModelStorageNode reads the file (STL is LPS in current
+  Slicer versions), and each model gets a storage node, so the models are placed and saved as if they had
+  been loaded with slicer.util.loadModel.
+  """
+  def __init__(self, cacheDirectory=None):
+    if not cacheDirectory:
+      cacheDirectory = os.path.join(slicer.app.temporaryPath, 'PercutaneousNavigationModelCache')
+    self.cacheDirectory = cacheDirectory
+    # Decided on the main thread, the loader thread must not touch MRML
+    coordinateSystemLPS = getattr(slicer.vtkMRMLStorageNode, 'CoordinateSystemLPS', None)
+    self.convertLPSToRAS = coordinateSystemLPS is not None and slicer.vtkMRMLModelStorageNode().GetCoordinateSystem() == coordinateSystemLPS
+    self.modelsToLoad = []
+    self.numberOfPendingModels = 0
+    self.loadedQueue = queue.Queue()
+    self.modelLoadedCallback = None
+    self.allModelsLoadedCallback = None
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(50)
+    self.pollTimer.connect('timeout()', self.onPollTimerTimeout)
+
+  def addModel(self, modelName, fileName, color):
+    self.modelsToLoad.append((modelName, fileName, color))
+
+  def start(self, modelLoadedCallback=None, allModelsLoadedCallback=None):
+    self.modelLoadedCallback = modelLoadedCallback
+    self.allModelsLoadedCallback = allModelsLoadedCallback
+    self.numberOfPendingModels = len(self.modelsToLoad)
+    if self.numberOfPendingModels == 0:
+      if self.allModelsLoadedCallback:
+        self.allModelsLoadedCallback()
+      return
+    loaderThread = threading.Thread(target=self.loadModels, args=(list(self.modelsToLoad),))
+    loaderThread.daemon = True
+    self.modelsToLoad = []
+    loaderThread.start()
+    self.pollTimer.start()
+
+  def stop(self):
+    self.pollTimer.stop()
+
+  def loadModels(self, modelsToLoad):
+    # Background thread: no MRML scene or Qt access here
+    for modelName, fileName, color in modelsToLoad:
+      try:
+        polyData = self.readPreprocessedPolyData(fileName)
+      except Exception as e:
+        logging.error('Failed to load model %s from %s: %s' % (modelName, fileName, e))
+        polyData = None
+      self.loadedQueue.put((modelName, fileName, color, polyData))
+
+  def readPreprocessedPolyData(self, fileName):
+    with open(fileName, 'rb') as modelFile:
+      fileHash = hashlib.sha1(modelFile.read()).hexdigest()
+    # the cached poly data is in RAS, so entries with and without conversion must not be mixed
+    cachedFileName = os.path.join(self.cacheDirectory, fileHash + ('_ras.vtp' if self.convertLPSToRAS else '.vtp'))
+    if os.path.exists(cachedFileName):
+      reader = vtk.vtkXMLPolyDataReader()
+      reader.SetFileName(cachedFileName)
+      reader.Update()
+      return reader.GetOutput()
+
+    reader = vtk.vtkSTLReader()
+    reader.SetFileName(fileName)
+    cleaner = vtk.vtkCleanPolyData()
+    if self.convertLPSToRAS:
+      lpsToRas = vtk.vtkTransform()
+      lpsToRas.Scale(-1.0, -1.0, 1.0)
+      transformFilter = vtk.vtkTransformPolyDataFilter()
+      transformFilter.SetTransform(lpsToRas)
+      transformFilter.SetInputConnection(reader.GetOutputPort())
+      cleaner.SetInputConnection(transformFilter.GetOutputPort())
+    else:
+      cleaner.SetInputConnection(reader.GetOutputPort())
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(cleaner.GetOutputPort())
+    normals.Update()
+    if normals.GetOutput().GetNumberOfPoints() == 0:
+      raise IOError('no points read')
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(normals.GetOutput())
+
+    if not os.path.exists(self.cacheDirectory):
+      os.makedirs(self.cacheDirectory)
+    # Write to a temporary file first so that an interrupted write never leaves a broken cache entry
+    temporaryFileName = cachedFileName + '.' + str(os.getpid()) + '.tmp'
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(temporaryFileName)
+    writer.SetInputData(polyData)
+    writer.SetDataModeToBinary()
+    if writer.Write():
+      if os.path.exists(cachedFileName):
+        os.remove(temporaryFileName)
+      else:
+        os.rename(temporaryFileName, cachedFileName)
+    return polyData
+
+  def onPollTimerTimeout(self):
+    while True:
+      try:
+        modelName, fileName, color, polyData = self.loadedQueue.get_nowait()
+      except queue.Empty:
+        break
+      self.numberOfPendingModels -= 1
+      if polyData:
+        modelNode = self.addModelToScene(modelName, fileName, color, polyData)
+        if self.modelLoadedCallback:
+          self.modelLoadedCallback(modelNode)
+    if self.numberOfPendingModels <= 0:
+      self.pollTimer.stop()
+      if self.allModelsLoadedCallback:
+        self.allModelsLoadedCallback()
+
+  def addModelToScene(self, modelName, fileName, color, polyData):
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(modelName)
+    modelNode.SetAndObservePolyData(polyData)
+    modelDisplay = slicer.vtkMRMLModelDisplayNode()
+    modelDisplay.SetColor(color)
+    slicer.mrmlScene.AddNode(modelDisplay)
+    modelNode.SetAndObserveDisplayNodeID(modelDisplay.GetID())
+    # Same storage node as slicer.util.loadModel creates, so that the model is saved with the scene
+    modelStorage = slicer.vtkMRMLModelStorageNode()
+    modelStorage.SetFileName(fileName)
+    slicer.mrmlScene.AddNode(modelStorage)
+    modelNode.SetAndObserveStorageNodeID(modelStorage.GetID())
+    slicer.mrmlScene.AddNode(modelNode)
+    return modelNode
+
+#
+# ModelLevelOfDetail
+#
+
+class ModelLevelOfDetail:
+  """Shows decimated versions of the anatomy models while the camera moves fast or rendering exceeds
+  the frame time budget, and the full resolution models when the camera is still.
+  The decimated models are separate, normally hidden model nodes (<name>LOD) that follow the same
+  transform, so the original poly data (and the spatial search trees built on it) are never touched.
+  Decimated poly data is cached on disk, keyed by the hash of the original mesh.
+  While active, the display visibility of both versions is derived from the visibility requested for each
+  model (see setRequestedVisibility), so visibility changes must go through it.
+  Low detail is entered when the camera moves fast or rendering is over budget, and left only after the
+  camera has been nearly still for a while, so the detail level does not toggle at the thresholds.
+  """
+  def __init__(self, cacheDirectory=None, targetReduction=0.9, nodeRegistry=None):
+    if not cacheDirectory:
+      cacheDirectory = os.path.join(slicer.app.temporaryPath, 'PercutaneousNavigationModelCache')
+    self.cacheDirectory = cacheDirectory
+    self.targetReduction = targetReduction
+    self.nodeRegistry = nodeRegistry if nodeRegistry else NodeRegistry()
+    self.maximumTranslationSpeedMmPerSec = 20.0
+    self.maximumRotationSpeedDegPerSec = 20.0
+    # below these speeds the camera counts as still, the gap to the maximum speeds is the hysteresis
+    self.stillTranslationSpeedMmPerSec = 1.0
+    self.stillRotationSpeedDegPerSec = 1.0
+    self.frameTimeBudgetSec = 1.0 / 30.0
+    self.stillTimeSec = 0.5 # full detail is restored after the camera has been still for this long
+    self.modelNodes = []
+    self.lowDetailModelNodes = []
+    self.requestedVisibilities = {} # model node ID: visibility requested by the user
+    self.cameraNode = None
+    self.renderer = None
+    self.lowDetail = False
+    self.previousCameraPosition = None
+    self.previousCameraDirection = None
+    self.previousTimeSec = 0.0
+    self.lastMotionTimeSec = 0.0
+    self.monitorTimer = qt.QTimer()
+    self.monitorTimer.setInterval(100)
+    self.monitorTimer.connect('timeout()', self.onMonitorTimerTimeout)
+
+  def setModelNodes(self, modelNodes):
+    self.setLowDetail(False)
+    self.modelNodes = [modelNode for modelNode in modelNodes if modelNode]
+    self.lowDetailModelNodes = []
+    self.requestedVisibilities = {}
+    for modelNode in self.modelNodes:
+      # in full detail the displayed visibility is the requested one
+      self.requestedVisibilities[modelNode.GetID()] = bool(modelNode.GetDisplayNode().GetVisibility())
+      self.lowDetailModelNodes.append(self.getLowDetailModelNode(modelNode))
+
+  def setRequestedVisibility(self, modelNode, visible):
+    self.requestedVisibilities[modelNode.GetID()] = bool(visible)
+    self.applyVisibilities()
+
+  def applyVisibilities(self):
+    for modelNode, lowDetailModelNode in zip(self.modelNodes, self.lowDetailModelNodes):
+      visible = self.requestedVisibilities.get(modelNode.GetID(), True)
+      if self.lowDetail:
+        lowDetailModelNode.SetAndObserveTransformNodeID(modelNode.GetTransformNodeID())
+      lowDetailModelNode.GetDisplayNode().SetVisibility(visible and self.lowDetail)
+      modelNode.GetDisplayNode().SetVisibility(visible and not self.lowDetail)
+
+  def getLowDetailModelNode(self, modelNode):
+    lowDetailModelName = modelNode.GetName() + 'LOD'
+    lowDetailModelNode = self.nodeRegistry.getNode(lowDetailModelName)
+    if not lowDetailModelNode:
+      # Generated from the original model, so never saved with the scene
+      lowDetailModelNode = slicer.vtkMRMLModelNode()
+      lowDetailModelNode.SetName(lowDetailModelName)
+      lowDetailModelNode.SetHideFromEditors(True)
+      lowDetailModelNode.SetSaveWithScene(False)
+      modelDisplay = slicer.vtkMRMLModelDisplayNode()
+      modelDisplay.SetHideFromEditors(True)
+      modelDisplay.SetSaveWithScene(False)
+      slicer.mrmlScene.AddNode(modelDisplay)
+      lowDetailModelNode.SetAndObserveDisplayNodeID(modelDisplay.GetID())
+      slicer.mrmlScene.AddNode(lowDetailModelNode)
+    lowDetailModelNode.SetAndObservePolyData(self.getLowDetailPolyData(modelNode.GetPolyData()))
+    lowDetailModelNode.SetAndObserveTransformNodeID(modelNode.GetTransformNodeID())
+    lowDetailModelNode.GetDisplayNode().SetColor(modelNode.GetDisplayNode().GetColor())
+    lowDetailModelNode.GetDisplayNode().SetOpacity(modelNode.GetDisplayNode().GetOpacity())
+    lowDetailModelNode.GetDisplayNode().SetVisibility(False)
+    return lowDetailModelNode
+
+  def removeLowDetailModelNodes(self):
+    # The decimated poly data stays in the file cache, so the nodes are cheap to create again
+    self.setLowDetail(False)
+    for lowDetailModelNode in self.lowDetailModelNodes:
+      displayNode = lowDetailModelNode.GetDisplayNode()
+      if displayNode:
+        slicer.mrmlScene.RemoveNode(displayNode)
+      slicer.mrmlScene.RemoveNode(lowDetailModelNode)
+    self.modelNodes = []
+    self.lowDetailModelNodes = []
+
+  def getLowDetailPolyData(self, polyData):
+    from vtk.util.numpy_support import vtk_to_numpy
+    meshHash = hashlib.sha1()
+    meshHash.update(vtk_to_numpy(polyData.GetPoints().GetData()).tobytes())
+    meshHash.update(vtk_to_numpy(polyData.GetPolys().GetData()).tobytes())
+    meshHash.update(str(self.targetReduction).encode('ascii'))
+    cachedFileName = os.path.join(self.cacheDirectory, meshHash.hexdigest() + '_lod.vtp')
+    if os.path.exists(cachedFileName):
+      reader = vtk.vtkXMLPolyDataReader()
+      reader.SetFileName(cachedFileName)
+      reader.Update()
+      return reader.GetOutput()
+
+    triangulator = vtk.vtkTriangleFilter()
+    triangulator.SetInputData(polyData)
+    decimator = vtk.vtkQuadricDecimation()
+    decimator.SetInputConnection(triangulator.GetOutputPort())
+    decimator.SetTargetReduction(self.targetReduction)
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(decimator.GetOutputPort())
+    normals.Update()
+    lowDetailPolyData = vtk.vtkPolyData()
+    lowDetailPolyData.DeepCopy(normals.GetOutput())
+    logging.info('Decimated model: %d -> %d triangles' % (polyData.GetNumberOfCells(), lowDetailPolyData.GetNumberOfCells()))
+
+    if not os.path.exists(self.cacheDirectory):
+      os.makedirs(self.cacheDirectory)
+    # Write to a temporary file first so that an interrupted write never leaves a broken cache entry
+    temporaryFileName = cachedFileName + '.' + str(os.getpid()) + '.tmp'
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(temporaryFileName)
+    writer.SetInputData(lowDetailPolyData)
+    writer.SetDataModeToBinary()
+    if writer.Write():
+      if os.path.exists(cachedFileName):
+        os.remove(temporaryFileName)
+      else:
+        os.rename(temporaryFileName, cachedFileName)
+    return lowDetailPolyData
+
+  def start(self, cameraNode, threeDView):
+    self.cameraNode = cameraNode
+    self.renderer = threeDView.renderWindow().GetRenderers().GetFirstRenderer()
+    self.previousCameraPosition = None
+    self.monitorTimer.start()
+
+  def stop(self):
+    self.monitorTimer.stop()
+    self.setLowDetail(False)
+
+  def onMonitorTimerTimeout(self):
+    currentTimeSec = time.time()
+    camera = self.cameraNode.GetCamera()
+    cameraPosition = camera.GetPosition()
+    cameraDirection = camera.GetDirectionOfProjection()
+    movingFast = False
+    still = True
+    if self.previousCameraPosition is not None and currentTimeSec > self.previousTimeSec:
+      intervalSec = currentTimeSec - self.previousTimeSec
+      translationSpeedMmPerSec = math.sqrt(vtk.vtkMath.Distance2BetweenPoints(cameraPosition, self.previousCameraPosition)) / intervalSec
+      cosAngle = max(-1.0, min(1.0, vtk.vtkMath.Dot(cameraDirection, self.previousCameraDirection)))
+      rotationSpeedDegPerSec = math.degrees(math.acos(cosAngle)) / intervalSec
+      movingFast = translationSpeedMmPerSec > self.maximumTranslationSpeedMmPerSec or rotationSpeedDegPerSec > self.maximumRotationSpeedDegPerSec
+      still = translationSpeedMmPerSec < self.stillTranslationSpeedMmPerSec and rotationSpeedDegPerSec < self.stillRotationSpeedDegPerSec
+    # The last render time is only meaningful while the camera keeps the views rendering. It is checked in full
+    # detail only: the low detail render time says nothing about whether full detail would fit the budget.
+    overBudget = not still and not self.lowDetail and self.renderer.GetLastRenderTimeInSeconds() > self.frameTimeBudgetSec
+    self.previousCameraPosition = cameraPosition
+    self.previousCameraDirection = cameraDirection
+    self.previousTimeSec = currentTimeSec
+
+    if movingFast or overBudget or (self.lowDetail and not still):
+      self.lastMotionTimeSec = currentTimeSec
+      self.setLowDetail(True)
+    elif self.lowDetail and currentTimeSec - self.lastMotionTimeSec > self.stillTimeSec:
+      self.setLowDetail(False)
+
+  def setLowDetail(self, lowDetail):
+    if lowDetail == self.lowDetail:
+      return
+    self.lowDetail = lowDetail
+    self.applyVisibilities()
+
+#
+# StaticTransformCache
+#
+
+class StaticTransformCache:
+  """Computes world matrices of transform nodes where runs of consecutive static transforms
+  (calibrations, registrations) are precomposed into cached matrices. The cache of all runs is
+  invalidated whenever a static node is modified or re-parented, so per query only the dynamic
+  (tracker) transforms need to be multiplied.
+  """
+  def __init__(self):
+    self.staticTransformNodeIDs = set()
+    self.observerTags = []
+    self.staticRuns = {} # first static node ID: [run-to-parent matrix, first non-static ancestor]
+    self.staticNodeStates = {} # static node ID: [modification time of its own transform, parent node ID]
+    self.matrixToParent = vtk.vtkMatrix4x4()
+
+  def setStaticTransformNodes(self, transformNodes):
+    for nodeTagPair in self.observerTags:
+      nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+    self.observerTags = []
+    self.staticTransformNodeIDs = set()
+    self.staticNodeStates = {}
+    for transformNode in transformNodes:
+      if not transformNode or transformNode.GetID() in self.staticTransformNodeIDs:
+        continue
+      self.staticTransformNodeIDs.add(transformNode.GetID())
+      self.staticNodeStates[transformNode.GetID()] = self.getStaticNodeState(transformNode)
+      self.observerTags.append([transformNode, transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onStaticTransformModified)])
+    self.invalidate()
+
+  def invalidate(self):
+    self.staticRuns = {}
+
+  def getStaticNodeState(self, transformNode):
+    return [transformNode.GetTransformToParent().GetMTime(), transformNode.GetTransformNodeID()]
+
+  def onStaticTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    # TransformModifiedEvent is also invoked on a static node whenever a transform above it moves, that is on
+    # every tracker frame. Only a change of the node's own matrix or of its parent invalidates the cache.
+    state = self.getStaticNodeState(caller)
+    if state != self.staticNodeStates.get(caller.GetID()):
+      self.staticNodeStates[caller.GetID()] = state
+      self.invalidate()
+
+  def getStaticRun(self, transformNode):
+    staticRun = self.staticRuns.get(transformNode.GetID())
+    if staticRun:
+      return staticRun
+    runToParentMatrix = vtk.vtkMatrix4x4()
+    runNode = transformNode
+    while runNode and runNode.GetID() in self.staticTransformNodeIDs:
+      runNode.GetMatrixTransformToParent(self.matrixToParent)
+      vtk.vtkMatrix4x4.Multiply4x4(self.matrixToParent, runToParentMatrix, runToParentMatrix)
+      runNode = runNode.GetParentTransformNode()
+    staticRun = [runToParentMatrix, runNode]
+    self.staticRuns[transformNode.GetID()] = staticRun
+    return staticRun
+
+  def getMatrixTransformToWorld(self, transformNode, matrix):
+    # no logging - it slows Slicer down a *lot*
+    matrix.Identity()
+    while transformNode:
+      if transformNode.GetID() in self.staticTransformNodeIDs:
+        runToParentMatrix, transformNode = self.getStaticRun(transformNode)
+        vtk.vtkMatrix4x4.Multiply4x4(runToParentMatrix, matrix, matrix)
+      else:
+        transformNode.GetMatrixTransformToParent(self.matrixToParent)
+        vtk.vtkMatrix4x4.Multiply4x4(self.matrixToParent, matrix, matrix)
+        transformNode = transformNode.GetParentTransformNode()
+
+#
+# PosePredictor
+#
+
+class PosePredictor:
+  """Extrapolates the pose of a tracked tool ahead by a fixed horizon to compensate the tracking and rendering latency.
+  A constant linear and angular velocity model is used, the velocities are exponentially smoothed.
+  The predicted pose is written into an output transform node that replaces the tracker transform for the consumers.
+  All state is kept in preallocated NumPy arrays.
+  """
+  def __init__(self, inputTransformNode, outputTransformNode, horizonSec=0.03, velocitySmoothing=0.5):
+    self.inputTransformNode = inputTransformNode
+    self.outputTransformNode = outputTransformNode
+    self.horizonSec = horizonSec
+    self.velocitySmoothing = velocitySmoothing # weight of the newest velocity estimate
+    self.observerTag = None
+    self.inputMatrix = vtk.vtkMatrix4x4()
+    self.outputMatrix = vtk.vtkMatrix4x4()
+    self.pose = np.eye(4)
+    self.previousPose = np.eye(4)
+    self.predictedRotation = np.eye(3)
+    self.linearVelocity = np.zeros(3)
+    self.angularVelocity = np.zeros(3) # rotation vector per second, in tracker coordinates
+    self.previousTimeSec = None
+    # Pending predictions for the error measurement: target time, predicted position, position when predicted
+    self.maximumPendingPredictions = 64
+    self.pendingTimesSec = np.zeros(self.maximumPendingPredictions)
+    self.pendingPredictedPositions = np.zeros((self.maximumPendingPredictions, 3))
+    self.pendingMeasuredPositions = np.zeros((self.maximumPendingPredictions, 3))
+    self.pendingValid = np.zeros(self.maximumPendingPredictions, dtype=bool)
+    self.pendingWriteIndex = 0
+    self.resetStatistics()
+
+  def start(self):
+    if self.observerTag is None:
+      # High priority, so that the prediction is written before other observers of the tracker transform run
+      self.observerTag = self.inputTransformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onInputTransformModified, 1.0)
+    self.previousTimeSec = None
+    self.pendingValid[:] = False
+    self.onInputTransformModified(self.inputTransformNode)
+
+  def stop(self):
+    if self.observerTag is not None:
+      self.inputTransformNode.RemoveObserver(self.observerTag)
+      self.observerTag = None
+
+  def resetStatistics(self):
+    self.numberOfErrorSamples = 0
+    self.sumSquaredPredictionErrorMm2 = 0.0
+    self.maximumPredictionErrorMm = 0.0
+    self.sumSquaredUncompensatedErrorMm2 = 0.0
+
+  def getStatistics(self):
+    """Returns RMS and maximum position error of the prediction, and the RMS error without prediction for comparison (mm).
+    """
+    if self.numberOfErrorSamples == 0:
+      return {'samples': 0, 'rmsErrorMm': 0.0, 'maxErrorMm': 0.0, 'rmsUncompensatedErrorMm': 0.0}
+    return {'samples': self.numberOfErrorSamples,
+            'rmsErrorMm': math.sqrt(self.sumSquaredPredictionErrorMm2 / self.numberOfErrorSamples),
+            'maxErrorMm': self.maximumPredictionErrorMm,
+            'rmsUncompensatedErrorMm': math.sqrt(self.sumSquaredUncompensatedErrorMm2 / self.numberOfErrorSamples)}
+
+  def onInputTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    currentTimeSec = time.time()
+    self.inputTransformNode.GetMatrixTransformToParent(self.inputMatrix)
+    self.previousPose[:] = self.pose
+    for row in range(3):
+      for column in range(4):
+        self.pose[row, column] = self.inputMatrix.GetElement(row, column)
+    position = self.pose[0:3, 3]
+    rotation = self.pose[0:3, 0:3]
+
+    self.updatePredictionError(currentTimeSec, position)
+
+    if self.previousTimeSec is not None and currentTimeSec > self.previousTimeSec:
+      intervalSec = currentTimeSec - self.previousTimeSec
+      linearVelocity = (position - self.previousPose[0:3, 3]) / intervalSec
+      angularVelocity = self.rotationVector(rotation.dot(self.previousPose[0:3, 0:3].T)) / intervalSec
+      self.linearVelocity += self.velocitySmoothing * (linearVelocity - self.linearVelocity)
+      self.angularVelocity += self.velocitySmoothing * (angularVelocity - self.angularVelocity)
+    self.previousTimeSec = currentTimeSec
+
+    # Extrapolate
+    predictedPosition = position + self.horizonSec * self.linearVelocity
+    self.predictedRotation[:] = self.rotationMatrix(self.horizonSec * self.angularVelocity).dot(rotation)
+    for row in range(3):
+      for column in range(3):
+        self.outputMatrix.SetElement(row, column, self.predictedRotation[row, column])
+      self.outputMatrix.SetElement(row, 3, predictedPosition[row])
+    self.outputTransformNode.SetMatrixTransformToParent(self.outputMatrix)
+
+    # Remember the prediction to measure its error when the target time is reached
+    pendingIndex = self.pendingWriteIndex
+    self.pendingTimesSec[pendingIndex] = currentTimeSec + self.horizonSec
+    self.pendingPredictedPositions[pendingIndex] = predictedPosition
+    self.pendingMeasuredPositions[pendingIndex] = position
+    self.pendingValid[pendingIndex] = True
+    self.pendingWriteIndex = (pendingIndex + 1) % self.maximumPendingPredictions
+
+  def updatePredictionError(self, currentTimeSec, position):
+    # no logging - it slows Slicer down a *lot*
+    due = self.pendingValid & (self.pendingTimesSec <= currentTimeSec)
+    if not due.any():
+      return
+    predictionErrors = np.linalg.norm(self.pendingPredictedPositions[due] - position, axis=1)
+    uncompensatedErrors = np.linalg.norm(self.pendingMeasuredPositions[due] - position, axis=1)
+    self.numberOfErrorSamples += len(predictionErrors)
+    self.sumSquaredPredictionErrorMm2 += float(np.dot(predictionErrors, predictionErrors))
+    self.sumSquaredUncompensatedErrorMm2 += float(np.dot(uncompensatedErrors, uncompensatedErrors))
+    self.maximumPredictionErrorMm = max(self.maximumPredictionErrorMm, float(predictionErrors.max()))
+    self.pendingValid[due] = False
+
+  @staticmethod
+  def rotationVector(rotation):
+    # Axis-angle (log map) of a rotation matrix
+    cosAngle = max(-1.0, min(1.0, (rotation[0, 0] + rotation[1, 1] + rotation[2, 2] - 1.0) / 2.0))
+    angle = math.acos(cosAngle)
+    axis = np.array([rotation[2, 1] - rotation[1, 2], rotation[0, 2] - rotation[2, 0], rotation[1, 0] - rotation[0, 1]])
+    if angle < 1e-6:
+      return 0.5 * axis
+    return angle / (2.0 * math.sin(angle)) * axis
+
+  @staticmethod
+  def rotationMatrix(rotationVector):
+    # Rodrigues formula (exp map)
+    angle = math.sqrt(float(np.dot(rotationVector, rotationVector)))
+    if angle < 1e-9:
+      return np.eye(3)
+    x, y, z = rotationVector / angle
+    skew = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    return np.eye(3) + math.sin(angle) * skew + (1 - math.cos(angle)) * skew.dot(skew)
+
+#
+# PointerTipSampler
+#
+
+def computeRigidTransform(sourcePoints, targetPoints):
+  """Least-squares rigid transform (Arun/Kabsch SVD) mapping sourcePoints onto targetPoints (both Nx3).
+  Returns (rotation 3x3, translation 3).
+  """
+  sourceCentroid = sourcePoints.mean(axis=0)
+  targetCentroid = targetPoints.mean(axis=0)
+  covariance = (sourcePoints - sourceCentroid).T.dot(targetPoints - targetCentroid)
+  u, singularValues, vt = np.linalg.svd(covariance)
+  reflectionCorrection = np.diag([1.0, 1.0, np.sign(np.linalg.det(vt.T.dot(u.T)))])
+  rotation = vt.T.dot(reflectionCorrection).dot(u.T)
+  return rotation, targetCentroid - rotation.dot(sourceCentroid)
+
+class PointerTipSampler:
+  """Collects pointer tip positions in Reference coordinates into a growable NumPy buffer.
+  The tip is computed from the PointerTipToPointer, PointerToTracker and ReferenceToTracker matrices,
+  independent of the current transform tree. Every sample is tagged with an integer label.
+  """
+  def __init__(self, initialCapacity=4096):
+    self.samples = np.zeros((initialCapacity, 3))
+    self.labels = np.zeros(initialCapacity, dtype=int)
+    self.numberOfSamples = 0
+    self.currentLabel = -1
+    self.pointerTipToPointerTransformNode = None
+    self.pointerToTrackerTransformNode = None
+    self.referenceToTrackerTransformNode = None
+    self.observerTag = None
+    self.pointerTipToPointerMatrix = vtk.vtkMatrix4x4()
+    self.pointerToTrackerMatrix = vtk.vtkMatrix4x4()
+    self.referenceToTrackerMatrix = vtk.vtkMatrix4x4()
+    self.trackerToReferenceMatrix = vtk.vtkMatrix4x4()
+    self.pointerTipToReferenceMatrix = vtk.vtkMatrix4x4()
+
+  def setTransformNodes(self, pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode):
+    self.pointerTipToPointerTransformNode = pointerTipToPointerTransformNode
+    self.pointerToTrackerTransformNode = pointerToTrackerTransformNode
+    self.referenceToTrackerTransformNode = referenceToTrackerTransformNode
+
+  def start(self, label=0):
+    self.stop()
+    self.currentLabel = label
+    self.observerTag = self.pointerToTrackerTransformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onPointerTransformModified)
+
+  def stop(self):
+    if self.observerTag is not None:
+      self.pointerToTrackerTransformNode.RemoveObserver(self.observerTag)
+      self.observerTag = None
+    self.currentLabel = -1
+
+  def onPointerTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    # PointerTipToReference = inverse(ReferenceToTracker) * PointerToTracker * PointerTipToPointer
+    self.pointerTipToPointerTransformNode.GetMatrixTransformToParent(self.pointerTipToPointerMatrix)
+    self.pointerToTrackerTransformNode.GetMatrixTransformToParent(self.pointerToTrackerMatrix)
+    self.referenceToTrackerTransformNode.GetMatrixTransformToParent(self.referenceToTrackerMatrix)
+    vtk.vtkMatrix4x4.Invert(self.referenceToTrackerMatrix, self.trackerToReferenceMatrix)
+    vtk.vtkMatrix4x4.Multiply4x4(self.pointerToTrackerMatrix, self.pointerTipToPointerMatrix, self.pointerTipToReferenceMatrix)
+    vtk.vtkMatrix4x4.Multiply4x4(self.trackerToReferenceMatrix, self.pointerTipToReferenceMatrix, self.pointerTipToReferenceMatrix)
+    self.addSample(self.currentLabel, [self.pointerTipToReferenceMatrix.GetElement(0, 3), self.pointerTipToReferenceMatrix.GetElement(1, 3), self.pointerTipToReferenceMatrix.GetElement(2, 3)])
+
+  def addSample(self, label, positionInReference):
+    if self.numberOfSamples == len(self.samples):
+      # amortized growth, samples are never stored as Python objects
+      self.samples = np.concatenate([self.samples, np.zeros(self.samples.shape)])
+      self.labels = np.concatenate([self.labels, np.zeros(self.labels.shape, dtype=int)])
+    self.samples[self.numberOfSamples] = positionInReference
+    self.labels[self.numberOfSamples] = label
+    self.numberOfSamples += 1
+
+  def clear(self, label=None):
+    if label is None:
+      self.numberOfSamples = 0
+      return
+    keep = self.labels[:self.numberOfSamples] != label
+    numberOfKeptSamples = int(keep.sum())
+    self.samples[:numberOfKeptSamples] = self.samples[:self.numberOfSamples][keep]
+    self.labels[:numberOfKeptSamples] = self.labels[:self.numberOfSamples][keep]
+    self.numberOfSamples = numberOfKeptSamples
+
+  def getSamples(self):
+    """Returns (positions in Reference coordinates, labels) as views of the buffer.
+    """
+    return self.samples[:self.numberOfSamples], self.labels[:self.numberOfSamples]
+
+#
+# PairedPointRegistration
+#
+
+class PairedPointRegistration:
+  """Computes PatientToReference from pointer tip positions collected on known fiducials (e.g. VirtualFiducials.fcsv).
+  The samples of each fiducial are averaged and the rigid transform is solved with SVD.
+  """
+  def __init__(self):
+    self.fiducialPositions = np.zeros((0, 3)) # patient coordinates
+    self.fiducialLabels = []
+    self.sampler = PointerTipSampler()
+    self.patientToReference = np.eye(4)
+    self.fiducialResiduals = np.zeros(0)
+    self.fiducialRegistrationError = 0.0
+    self.registeredFiducials = np.zeros(0, dtype=int)
+
+  def setFiducials(self, fiducialNode):
+    numberOfFiducials = fiducialNode.GetNumberOfFiducials()
+    self.fiducialPositions = np.zeros((numberOfFiducials, 3))
+    self.fiducialLabels = []
+    fiducialPosition = [0.0, 0.0, 0.0]
+    for fiducialIndex in range(numberOfFiducials):
+      fiducialNode.GetNthFiducialPosition(fiducialIndex, fiducialPosition)
+      self.fiducialPositions[fiducialIndex] = fiducialPosition
+      self.fiducialLabels.append(fiducialNode.GetNthFiducialLabel(fiducialIndex))
+    self.sampler.clear()
+
+  def setTransformNodes(self, pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode):
+    self.sampler.setTransformNodes(pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode)
+
+  def clearSamples(self, fiducialIndex=None):
+    self.sampler.clear(fiducialIndex)
+
+  def startCollecting(self, fiducialIndex):
+    self.sampler.start(fiducialIndex)
+
+  def stopCollecting(self):
+    self.sampler.stop()
+
+  def getNumberOfSamplesPerFiducial(self):
+    return np.bincount(self.sampler.getSamples()[1], minlength=len(self.fiducialPositions))
+
+  def register(self):
+    """Computes PatientToReference from the mean collected position of each fiducial.
+    Returns the 4x4 matrix as a NumPy array, or None if fewer than 3 fiducials have samples.
+    """
+    samples, sampleFiducialIndices = self.sampler.getSamples()
+    numberOfSamplesPerFiducial = self.getNumberOfSamplesPerFiducial()
+    collectedFiducials = np.nonzero(numberOfSamplesPerFiducial)[0]
+    if len(collectedFiducials) < 3:
+      logging.error('PairedPointRegistration: at least 3 fiducials must be collected')
+      return None
+    # Mean measured position of every fiducial in one pass
+    sums = np.zeros((len(self.fiducialPositions), 3))
+    np.add.at(sums, sampleFiducialIndices, samples)
+    measuredPositions = sums[collectedFiducials] / numberOfSamplesPerFiducial[collectedFiducials][:, np.newaxis]
+    fiducialPositions = self.fiducialPositions[collectedFiducials]
+
+    rotation, translation = computeRigidTransform(fiducialPositions, measuredPositions)
+    self.patientToReference = np.eye(4)
+    self.patientToReference[0:3, 0:3] = rotation
+    self.patientToReference[0:3, 3] = translation
+
+    self.fiducialResiduals = np.full(len(self.fiducialPositions), np.nan)
+    self.fiducialResiduals[collectedFiducials] = np.linalg.norm(fiducialPositions.dot(rotation.T) + translation - measuredPositions, axis=1)
+    self.fiducialRegistrationError = float(np.sqrt(np.mean(self.fiducialResiduals[collectedFiducials] ** 2)))
+    self.registeredFiducials = collectedFiducials
+    logging.info('PairedPointRegistration: FRE = %.2f mm using %d fiducials' % (self.fiducialRegistrationError, len(collectedFiducials)))
+    return self.patientToReference
+
+  def computeTargetRegistrationError(self, targetPositions, fiducialLocalizationError=None):
+    """Expected TRE (Fitzpatrick et al. 1998) at each of the targets (Nx3, patient coordinates), in one vectorized pass.
+    If the fiducial localization error is not given, it is estimated from the FRE.
+    """
+    fiducialPositions = self.fiducialPositions[self.registeredFiducials]
+    numberOfFiducials = len(fiducialPositions)
+    if fiducialLocalizationError is None:
+      fiducialLocalizationError = self.fiducialRegistrationError * math.sqrt(numberOfFiducials / max(1.0, numberOfFiducials - 2.0))
+    centroid = fiducialPositions.mean(axis=0)
+    # principal axes of the fiducial configuration
+    _, _, principalAxes = np.linalg.svd(fiducialPositions - centroid)
+    fiducialsInPrincipal = (fiducialPositions - centroid).dot(principalAxes.T)
+    targetsInPrincipal = (np.asarray(targetPositions, dtype=float) - centroid).dot(principalAxes.T)
+    squaredCoordinates = np.square(targetsInPrincipal)
+    squaredTargetDistances = squaredCoordinates.sum(axis=1)[:, np.newaxis] - squaredCoordinates # distance^2 to each axis
+    squaredFiducialDistances = (np.square(fiducialsInPrincipal).sum(axis=1)[:, np.newaxis] - np.square(fiducialsInPrincipal)).mean(axis=0)
+    ratio = (squaredTargetDistances / squaredFiducialDistances).sum(axis=1)
+    return np.sqrt(fiducialLocalizationError ** 2 / numberOfFiducials * (1.0 + ratio / 3.0))
+
+  def computeTargetRegistrationErrorOnGrid(self, bounds, spacingMm):
+    """TRE on a regular grid covering bounds [xmin, xmax, ymin, ymax, zmin, zmax]. Returns (grid points, TRE).
+    """
+    axes = [np.arange(bounds[2 * axis], bounds[2 * axis + 1] + spacingMm, spacingMm) for axis in range(3)]
+    gridPoints = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    return gridPoints, self.computeTargetRegistrationError(gridPoints)
+
+  def getPatientToReferenceMatrix(self, matrix):
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, self.patientToReference[row, column])
+
+#
+# SurfaceRegistration
+#
+
+class SurfaceRegistration:
+  """Refines PatientToReference by iterative closest point (ICP) between pointer tip sweeps and a surface model.
+  Pointer tip samples are streamed into a PointerTipSampler buffer. The search structure of the surface is built once
+  per mesh, and ICP runs in a background thread. Progress and the result are handed back to the main thread
+  through a queue polled by a QTimer, so the MRML scene is only modified on the main thread.
+  The closest mesh vertex of all samples is found in one batched query per iteration, with a SciPy KD-tree if
+  available, otherwise with a VTK point interpolator whose Voronoi kernel returns the index of the closest vertex
+  (Slicer does not bundle SciPy). The samples are then projected onto the tangent plane at that vertex.
+  Only if neither is available, a cell locator is queried point by point, on at most maximumNumberOfLocatorSamples
+  samples so that the thread does not hold the interpreter for long.
+  """
+  def __init__(self):
+    self.sampler = PointerTipSampler()
+    self.surfacePolyData = None
+    self.surfacePolyDataSource = None
+    self.surfacePolyDataSourceMTime = 0
+    self.cellLocator = vtk.vtkCellLocator()
+    self.vertexTree = None
+    self.vertexInterpolator = None
+    self.vertexProbe = None
+    self.vertexPositions = np.zeros((0, 3))
+    self.vertexNormals = np.zeros((0, 3))
+    self.maximumNumberOfLocatorSamples = 500
+    self.maximumNumberOfIterations = 50
+    self.rmsChangeToleranceMm = 0.01
+    self.maximumInlierDistanceMm = 10.0 # hard limit for outlier rejection
+    self.inlierMedianFactor = 3.0 # points farther than this times the median distance are rejected
+    self.downsamplingGridSpacingMm = 1.0 # sweeps oversample the surface, keep one point per voxel
+    self.patientToReference = np.eye(4)
+    self.rmsPerIteration = []
+    self.isRunning = False
+    self.cancelEvent = threading.Event()
+    self.resultQueue = queue.Queue()
+    self.iterationCallback = None
+    self.finishedCallback = None
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(50)
+    self.pollTimer.connect('timeout()', self.onPollTimerTimeout)
+
+  def setTransformNodes(self, pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode):
+    self.sampler.setTransformNodes(pointerTipToPointerTransformNode, pointerToTrackerTransformNode, referenceToTrackerTransformNode)
+
+  def startCollecting(self):
+    self.sampler.start()
+
+  def stopCollecting(self):
+    self.sampler.stop()
+
+  def clearSamples(self):
+    self.sampler.clear()
+
+  def getNumberOfSamples(self):
+    return self.sampler.numberOfSamples
+
+  def setSurfaceModel(self, surfaceModelNode):
+    """The poly data is expected in patient coordinates (BoneModel is a child of PatientToReference).
+    The locator is built on a private copy, so that the background thread never reads a mesh that the main thread modifies.
+    """
+    polyData = surfaceModelNode.GetPolyData() if surfaceModelNode else None
+    if not polyData or polyData.GetNumberOfCells() == 0:
+      return False
+    if self.isRunning:
+      # the locator is in use by the registration thread
+      return True
+    if polyData is self.surfacePolyDataSource and polyData.GetMTime() == self.surfacePolyDataSourceMTime:
+      return True
+    self.surfacePolyData = vtk.vtkPolyData()
+    self.surfacePolyData.DeepCopy(polyData)
+    if cKDTree is not None or hasattr(vtk, 'vtkPointInterpolator'):
+      self.buildVertexTree()
+    else:
+      self.cellLocator.SetDataSet(self.surfacePolyData)
+      self.cellLocator.BuildLocator()
+    self.surfacePolyDataSource = polyData
+    self.surfacePolyDataSourceMTime = polyData.GetMTime()
+    logging.info('SurfaceRegistration: locator built on %d cells' % self.surfacePolyData.GetNumberOfCells())
+    return True
+
+  def buildVertexTree(self):
+    from vtk.util.numpy_support import vtk_to_numpy
+    # Point normals without splitting, so that normals and points correspond one to one
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(self.surfacePolyData)
+    normals.SplittingOff()
+    normals.ComputePointNormalsOn()
+    normals.Update()
+    self.vertexPositions = vtk_to_numpy(normals.GetOutput().GetPoints().GetData()).astype(float)
+    self.vertexNormals = vtk_to_numpy(normals.GetOutput().GetPointData().GetNormals()).astype(float)
+    if cKDTree is not None:
+      self.vertexTree = cKDTree(self.vertexPositions)
+      return
+    # The Voronoi kernel copies the data of the closest vertex, here its index, to every probe point in one update
+    from vtk.util.numpy_support import numpy_to_vtk
+    vertices = vtk.vtkPolyData()
+    vertices.SetPoints(normals.GetOutput().GetPoints())
+    vertexIndices = numpy_to_vtk(np.arange(len(self.vertexPositions), dtype=float), deep=True)
+    vertexIndices.SetName('VertexIndex')
+    vertices.GetPointData().AddArray(vertexIndices)
+    vertexLocator = vtk.vtkStaticPointLocator()
+    vertexLocator.SetDataSet(vertices)
+    vertexLocator.BuildLocator()
+    self.vertexProbe = vtk.vtkPolyData()
+    self.vertexInterpolator = vtk.vtkPointInterpolator()
+    self.vertexInterpolator.SetInputData(self.vertexProbe)
+    self.vertexInterpolator.SetSourceData(vertices)
+    self.vertexInterpolator.SetLocator(vertexLocator)
+    self.vertexInterpolator.SetKernel(vtk.vtkVoronoiKernel())
+    self.vertexInterpolator.SetNullPointsStrategyToClosestPoint()
+
+  def findClosestVertexIndices(self, points):
+    # Background thread: no MRML scene or Qt access here
+    if self.vertexTree is not None:
+      return self.vertexTree.query(points)[1]
+    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+    probePoints = vtk.vtkPoints()
+    probePoints.SetData(numpy_to_vtk(np.ascontiguousarray(points), deep=True))
+    self.vertexProbe.SetPoints(probePoints)
+    self.vertexInterpolator.Update()
+    return np.rint(vtk_to_numpy(self.vertexInterpolator.GetOutput().GetPointData().GetArray('VertexIndex'))).astype(int)
+
+  def findClosestPoints(self, points, closestPoints, distances):
+    # Background thread: no MRML scene or Qt access here
+    if self.vertexTree is not None or self.vertexInterpolator is not None:
+      vertexIndices = self.findClosestVertexIndices(points)
+      vertexNormals = self.vertexNormals[vertexIndices]
+      offsets = np.einsum('ij,ij->i', points - self.vertexPositions[vertexIndices], vertexNormals)
+      closestPoints[:] = points - offsets[:, np.newaxis] * vertexNormals
+      np.abs(offsets, out=distances)
+      return
+    closestPoint = [0.0, 0.0, 0.0]
+    cellId = vtk.mutable(0)
+    subId = vtk.mutable(0)
+    squaredDistance = vtk.mutable(0.0)
+    for pointIndex in range(len(points)):
+      self.cellLocator.FindClosestPoint(points[pointIndex], closestPoint, cellId, subId, squaredDistance)
+      closestPoints[pointIndex] = closestPoint
+      distances[pointIndex] = squaredDistance.get()
+    np.sqrt(distances, out=distances)
+
+  def start(self, initialPatientToReference, iterationCallback=None, finishedCallback=None):
+    """Starts ICP from initialPatientToReference (4x4 NumPy array), e.g. the result of the landmark registration.
+    iterationCallback(iteration, rmsMm, numberOfInliers) and finishedCallback(success) are called on the main thread.
+    """
+    if self.isRunning:
+      logging.warning('SurfaceRegistration: registration is already running')
+      return False
+    if not self.surfacePolyData:
+      logging.error('SurfaceRegistration: surface model is not set')
+      return False
+    samples = self.downsample(self.sampler.getSamples()[0])
+    if len(samples) < 3:
+      logging.error('SurfaceRegistration: at least 3 surface points must be collected')
+      return False
+    if self.vertexTree is None and self.vertexInterpolator is None and len(samples) > self.maximumNumberOfLocatorSamples:
+      logging.warning('SurfaceRegistration: no batched closest point search available, using %d of %d samples' % (self.maximumNumberOfLocatorSamples, len(samples)))
+      samples = samples[np.linspace(0, len(samples) - 1, self.maximumNumberOfLocatorSamples).astype(int)]
+    self.iterationCallback = iterationCallback
+    self.finishedCallback = finishedCallback
+    self.rmsPerIteration = []
+    self.cancelEvent.clear()
+    self.isRunning = True
+    registrationThread = threading.Thread(target=self.runIterations, args=(samples, np.array(initialPatientToReference, dtype=float)))
+    registrationThread.daemon = True
+    registrationThread.start()
+    self.pollTimer.start()
+    return True
+
+  def cancel(self):
+    self.cancelEvent.set()
+
+  def downsample(self, samples):
+    # Keep the first sample in every grid cell, copies the buffer so that collection may continue meanwhile
+    if self.downsamplingGridSpacingMm <= 0 or len(samples) == 0:
+      return np.array(samples)
+    gridIndices = np.floor(samples / self.downsamplingGridSpacingMm).astype(np.int64)
+    _, uniqueIndices = np.unique(gridIndices, axis=0, return_index=True)
+    return samples[np.sort(uniqueIndices)]
+
+  def runIterations(self, samplesInReference, initialPatientToReference):
+    # Background thread: no MRML scene or Qt access here
+    try:
+      referenceToPatient = np.linalg.inv(initialPatientToReference)
+      rotation = referenceToPatient[0:3, 0:3]
+      translation = referenceToPatient[0:3, 3]
+      numberOfSamples = len(samplesInReference)
+      closestPoints = np.zeros((numberOfSamples, 3))
+      distances = np.zeros(numberOfSamples)
+      previousRmsMm = None
+      for iteration in range(self.maximumNumberOfIterations):
+        if self.cancelEvent.is_set():
+          self.resultQueue.put(('failed', 'cancelled'))
+          return
+        samplesInPatient = samplesInReference.dot(rotation.T) + translation
+        self.findClosestPoints(samplesInPatient, closestPoints, distances)
+
+        inlierDistanceMm = min(self.maximumInlierDistanceMm, self.inlierMedianFactor * np.median(distances))
+        inliers = distances <= inlierDistanceMm
+        numberOfInliers = int(inliers.sum())
+        if numberOfInliers < 3:
+          self.resultQueue.put(('failed', 'too few inliers (%d)' % numberOfInliers))
+          return
+        rmsMm = float(np.sqrt(np.mean(np.square(distances[inliers]))))
+        self.resultQueue.put(('iteration', iteration, rmsMm, numberOfInliers))
+        if previousRmsMm is not None and abs(previousRmsMm - rmsMm) < self.rmsChangeToleranceMm:
+          break
+        previousRmsMm = rmsMm
+        rotation, translation = computeRigidTransform(samplesInReference[inliers], closestPoints[inliers])
+
+      referenceToPatient = np.eye(4)
+      referenceToPatient[0:3, 0:3] = rotation
+      referenceToPatient[0:3, 3] = translation
+      self.resultQueue.put(('done', np.linalg.inv(referenceToPatient)))
+    except Exception as e:
+      self.resultQueue.put(('failed', str(e)))
+
+  def onPollTimerTimeout(self):
+    while not self.resultQueue.empty():
+      result = self.resultQueue.get()
+      if result[0] == 'iteration':
+        iteration, rmsMm, numberOfInliers = result[1:]
+        self.rmsPerIteration.append(rmsMm)
+        if self.iterationCallback:
+          self.iterationCallback(iteration, rmsMm, numberOfInliers)
+        continue
+      self.pollTimer.stop()
+      self.isRunning = False
+      success = result[0] == 'done'
+      if success:
+        self.patientToReference = result[1]
+        logging.info('SurfaceRegistration: RMS = %.2f mm after %d iterations' % (self.rmsPerIteration[-1], len(self.rmsPerIteration)))
+      else:
+        logging.error('SurfaceRegistration: registration failed, %s' % result[1])
+      if self.finishedCallback:
+        self.finishedCallback(success)
+      return
+
+  def getPatientToReferenceMatrix(self, matrix):
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, self.patientToReference[row, column])
+
+#
+# PivotCalibration
+#
+
+class PivotCalibration:
+  """Streaming pivot calibration of a tool tip (e.g. NeedleTipToNeedle from NeedleToTracker samples).
+  For every sample ToolToTracker = [R | p] the tip satisfies R * tipInTool + p = pivotInTracker, i.e.
+  [R, -I] * [tipInTool; pivotInTracker] = -p. The 6x6 normal equations of this least-squares problem are
+  accumulated incrementally, so updating the solution costs the same regardless of the number of samples.
+  The transform observer only copies the matrix into a preallocated buffer, samples are folded into the
+  normal equations in vectorized batches when the solution is requested.
+  """
+  def __init__(self, initialCapacity=8192):
+    self.rotations = np.zeros((initialCapacity, 3, 3))
+    self.translations = np.zeros((initialCapacity, 3))
+    self.inliers = np.ones(initialCapacity, dtype=bool)
+    self.numberOfSamples = 0
+    self.numberOfAccumulatedSamples = 0
+    self.toolToTrackerTransformNode = None
+    self.observerTag = None
+    self.toolToTrackerMatrix = vtk.vtkMatrix4x4()
+    self.minimumRotationDeg = 15.0 # below this the orientation range cannot determine the tip
+    self.maximumInlierErrorMm = 2.0 # hard limit for outlier rejection
+    self.inlierMedianFactor = 3.0 # samples with residuals larger than this times the median are rejected
+    self.clearAccumulators()
+    self.tipInTool = np.zeros(3)
+    self.pivotInTracker = np.zeros(3)
+    self.rmsErrorMm = 0.0
+
+  def clearAccumulators(self):
+    self.sumOfRotations = np.zeros((3, 3))
+    self.sumOfTranslations = np.zeros(3)
+    self.sumOfRotatedTranslations = np.zeros(3) # sum of R^T * p
+    self.numberOfInliers = 0
+
+  def clear(self):
+    self.numberOfSamples = 0
+    self.numberOfAccumulatedSamples = 0
+    self.clearAccumulators()
+
+  def start(self, toolToTrackerTransformNode):
+    self.stop()
+    self.clear()
+    self.toolToTrackerTransformNode = toolToTrackerTransformNode
+    self.observerTag = toolToTrackerTransformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onToolTransformModified)
+
+  def stop(self):
+    if self.observerTag is not None:
+      self.toolToTrackerTransformNode.RemoveObserver(self.observerTag)
+      self.observerTag = None
+
+  def onToolTransformModified(self, caller, event=None):
+    # no logging - it slows Slicer down a *lot*
+    self.toolToTrackerTransformNode.GetMatrixTransformToParent(self.toolToTrackerMatrix)
+    if self.numberOfSamples == len(self.translations):
+      self.rotations = np.concatenate([self.rotations, np.zeros(self.rotations.shape)])
+      self.translations = np.concatenate([self.translations, np.zeros(self.translations.shape)])
+      self.inliers = np.concatenate([self.inliers, np.ones(self.inliers.shape, dtype=bool)])
+    matrix = self.toolToTrackerMatrix
+    rotation = self.rotations[self.numberOfSamples]
+    for row in range(3):
+      rotation[row, 0] = matrix.GetElement(row, 0)
+      rotation[row, 1] = matrix.GetElement(row, 1)
+      rotation[row, 2] = matrix.GetElement(row, 2)
+      self.translations[self.numberOfSamples, row] = matrix.GetElement(row, 3)
+    self.inliers[self.numberOfSamples] = True
+    self.numberOfSamples += 1
+
+  def accumulate(self, sampleIndices, sign=1.0):
+    # Add (sign=1) or remove (sign=-1) the contribution of the given samples to the normal equations
+    if len(sampleIndices) == 0:
+      return
+    rotations = self.rotations[sampleIndices]
+    translations = self.translations[sampleIndices]
+    self.sumOfRotations += sign * rotations.sum(axis=0)
+    self.sumOfTranslations += sign * translations.sum(axis=0)
+    self.sumOfRotatedTranslations += sign * np.einsum('nji,nj->i', rotations, translations)
+    self.numberOfInliers += int(sign) * len(sampleIndices)
+
+  def updateSolution(self):
+    """Folds the new samples into the normal equations and solves them.
+    Returns False if there are not enough samples or the tool was not rotated enough.
+    """
+    self.accumulate(np.arange(self.numberOfAccumulatedSamples, self.numberOfSamples))
+    self.numberOfAccumulatedSamples = self.numberOfSamples
+    if self.numberOfInliers < 10:
+      return False
+    # A^T A = [[n I, -sum(R^T)], [-sum(R), n I]], A^T b = [-sum(R^T p), sum(p)]
+    normalMatrix = np.eye(6) * self.numberOfInliers
+    normalMatrix[0:3, 3:6] = -self.sumOfRotations.T
+    normalMatrix[3:6, 0:3] = -self.sumOfRotations
+    normalVector = np.concatenate([-self.sumOfRotatedTranslations, self.sumOfTranslations])
+    # the normal matrix is singular if all rotations are equal, sum(R)/n is a rotation then
+    meanRotationSingularValues = np.linalg.svd(self.sumOfRotations / self.numberOfInliers, compute_uv=False)
+    if meanRotationSingularValues[-1] > math.cos(math.radians(self.minimumRotationDeg)):
+      return False
+    solution = np.linalg.solve(normalMatrix, normalVector)
+    self.tipInTool = solution[0:3]
+    self.pivotInTracker = solution[3:6]
+    residuals = self.computeResiduals(np.nonzero(self.inliers[:self.numberOfSamples])[0])
+    self.rmsErrorMm = float(np.sqrt(np.mean(np.square(residuals))))
+    return True
+
+  def computeResiduals(self, sampleIndices):
+    # Distance between the tip position computed from each sample and the pivot point
+    tipsInTracker = np.einsum('nij,j->ni', self.rotations[sampleIndices], self.tipInTool) + self.translations[sampleIndices]
+    return np.linalg.norm(tipsInTracker - self.pivotInTracker, axis=1)
+
+  def rejectOutliers(self, maximumNumberOfIterations=3):
+    """Removes samples with large residuals from the normal equations (without re-accumulating the others)
+    and updates the solution. Returns the number of rejected samples.
+    """
+    if not self.updateSolution():
+      return 0
+    numberOfRejectedSamples = 0
+    for iteration in range(maximumNumberOfIterations):
+      inlierIndices = np.nonzero(self.inliers[:self.numberOfSamples])[0]
+      residuals = self.computeResiduals(inlierIndices)
+      threshold = min(self.maximumInlierErrorMm, self.inlierMedianFactor * np.median(residuals))
+      outlierIndices = inlierIndices[residuals > threshold]
+      if len(outlierIndices) == 0:
+        break
+      self.accumulate(outlierIndices, -1.0)
+      self.inliers[outlierIndices] = False
+      numberOfRejectedSamples += len(outlierIndices)
+      if not self.updateSolution():
+        break
+    return numberOfRejectedSamples
+
+  def getResult(self):
+    return {'samples': self.numberOfSamples, 'inliers': self.numberOfInliers, 'rmsErrorMm': self.rmsErrorMm,
+      'tipInTool': self.tipInTool.tolist(), 'pivotInTracker': self.pivotInTracker.tolist()}
+
+  def applyToTransformNode(self, toolTipToToolTransformNode):
+    # Only the tip position is determined by pivoting, the orientation of the tip frame is kept
+    toolTipToToolMatrix = vtk.vtkMatrix4x4()
+    toolTipToToolTransformNode.GetMatrixTransformToParent(toolTipToToolMatrix)
+    for row in range(3):
+      toolTipToToolMatrix.SetElement(row, 3, self.tipInTool[row])
+    toolTipToToolTransformNode.SetMatrixTransformToParent(toolTipToToolMatrix)
+
+#
+# TrackingRecorder
+#
+
+class TrackingRecorder:
+  """Records the matrices of tracked transform nodes into a fixed-capacity ring buffer.
+  All samples are stored in preallocated NumPy arrays, once the buffer is full the oldest samples are overwritten.
+  TransformModifiedEvent is also invoked when a parent transform changes, so a sample is only stored if the
+  node's own matrix differs from its previous sample.
+  """
+  def __init__(self, maximumMemoryMB=256):
+    self.transformNodes = []
+    self.observerTags = []
+    self.currentlyRecording = False
+    self.matrix = vtk.vtkMatrix4x4()
+    self.sampleMatrix = np.zeros((4, 4))
+    self.lastMatrices = np.zeros((0, 4, 4))
+    self.hasLastMatrix = np.zeros(0, dtype=bool)
+    self.setMaximumMemoryMB(maximumMemoryMB)
+
+  def setMaximumMemoryMB(self, maximumMemoryMB):
+    # timestamp (float64) + node index (int16) + 4x4 matrix (float64)
+    bytesPerSample = 8 + 2 + 16 * 8
+    self.capacity = max(1, int(maximumMemoryMB * 1024 * 1024) // bytesPerSample)
+    self.timestamps = np.zeros(self.capacity)
+    self.nodeIndices = np.zeros(self.capacity, dtype=np.int16)
+    self.matrices = np.zeros((self.capacity, 4, 4))
+    self.clear()
+
+  def clear(self):
+    self.numberOfSamples = 0
+    self.writeIndex = 0
+
+  def setTransformNodes(self, transformNodes):
+    if self.currentlyRecording:
+      logging.error('TrackingRecorder: cannot change recorded nodes while recording')
+      return
+    self.transformNodes = [transformNode for transformNode in transformNodes if transformNode]
+
+  def startRecording(self):
+    if self.currentlyRecording:
+      return
+    self.lastMatrices = np.zeros((len(self.transformNodes), 4, 4))
+    self.hasLastMatrix = np.zeros(len(self.transformNodes), dtype=bool)
+    for nodeIndex, transformNode in enumerate(self.transformNodes):
+      callback = lambda caller, event, nodeIndex=nodeIndex: self.onTransformModified(nodeIndex)
+      self.observerTags.append([transformNode, transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, callback)])
+    self.currentlyRecording = True
+    logging.info('TrackingRecorder: recording started')
+
+  def stopRecording(self):
+    for nodeTagPair in self.observerTags:
+      nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+    self.observerTags = []
+    self.currentlyRecording = False
+    logging.info('TrackingRecorder: recording stopped, %d samples' % self.numberOfSamples)
+
+  def onTransformModified(self, nodeIndex):
+    # no logging - it slows Slicer down a *lot*
+    self.transformNodes[nodeIndex].GetMatrixTransformToParent(self.matrix)
+    sampleMatrix = self.sampleMatrix
+    for row in range(4):
+      for column in range(4):
+        sampleMatrix[row, column] = self.matrix.GetElement(row, column)
+    if self.hasLastMatrix[nodeIndex] and np.array_equal(sampleMatrix, self.lastMatrices[nodeIndex]):
+      return # a parent moved, not this node
+    self.lastMatrices[nodeIndex] = sampleMatrix
+    self.hasLastMatrix[nodeIndex] = True
+    sampleIndex = self.writeIndex
+    self.timestamps[sampleIndex] = time.time()
+    self.nodeIndices[sampleIndex] = nodeIndex
+    self.matrices[sampleIndex] = sampleMatrix
+    self.writeIndex = (sampleIndex + 1) % self.capacity
+    if self.numberOfSamples < self.capacity:
+      self.numberOfSamples += 1
+
+  def getSamples(self):
+    """Returns (timestamps, node indices, matrices) of the recorded samples in chronological order.
+    """
+    if self.numberOfSamples < self.capacity:
+      order = np.arange(self.numberOfSamples)
+    else:
+      order = np.roll(np.arange(self.capacity), -self.writeIndex)
+    return self.timestamps[order], self.nodeIndices[order], self.matrices[order]
+
+  def getNodeNames(self):
+    return [transformNode.GetName() for transformNode in self.transformNodes]
+
+  def save(self, fileName):
+    timestamps, nodeIndices, matrices = self.getSamples()
+    np.savez_compressed(fileName, timestamps=timestamps, nodeIndices=nodeIndices, matrices=matrices, nodeNames=np.array(self.getNodeNames()))
+    logging.info('TrackingRecorder: %d samples saved to %s' % (len(timestamps), fileName))
+
+#
+# TrackingReplayer
+#
+
+class TrackingReplayer:
+  """Writes recorded tracking data (see TrackingRecorder) back into the transform nodes,
+  either with the original timing or as fast as possible, and measures the time spent per stage.
+  """
+  def __init__(self, viewpointLogic=None, threeDView=None, nodeRegistry=None):
+    self.viewpointLogic = viewpointLogic
+    self.threeDView = threeDView
+    self.nodeRegistry = nodeRegistry if nodeRegistry else NodeRegistry()
+    self.renderEnabled = False
+    self.timestamps = np.zeros(0)
+    self.nodeIndices = np.zeros(0, dtype=np.int16)
+    self.matrices = np.zeros((0, 4, 4))
+    self.transformNodes = []
+    self.matrix = vtk.vtkMatrix4x4()
+    self.nextSampleIndex = 0
+    self.replayStartTimeSec = 0.0
+    self.currentlyReplaying = False
+    self.replayTimer = qt.QTimer()
+    self.replayTimer.setSingleShot(True)
+    self.replayTimer.connect('timeout()', self.onReplayTimerTimeout)
+    self.resetStatistics()
+
+  def load(self, fileName):
+    recording = np.load(fileName)
+    self.setSamples(recording['timestamps'], recording['nodeIndices'], recording['matrices'], [str(nodeName) for nodeName in recording['nodeNames']])
+    logging.info('TrackingReplayer: %d samples loaded from %s' % (len(self.timestamps), fileName))
+
+  def setSamples(self, timestamps, nodeIndices, matrices, nodeNames):
+    self.timestamps = timestamps
+    self.nodeIndices = nodeIndices
+    self.matrices = matrices
+    # Replay into the same nodes as the live stream, create them if there is no tracker connected
+    self.transformNodes = []
+    for nodeName in nodeNames:
+      transformNode = self.nodeRegistry.getNode(nodeName)
+      if not transformNode:
+        transformNode = slicer.vtkMRMLLinearTransformNode()
+        transformNode.SetName(nodeName)
+        slicer.mrmlScene.AddNode(transformNode)
+      self.transformNodes.append(transformNode)
+
+  def resetStatistics(self):
+    self.stageTimesSec = {'transform': 0.0, 'camera': 0.0, 'render': 0.0}
+    self.numberOfReplayedSamples = 0
+    self.replayDurationSec = 0.0
+
+  def getStatistics(self):
+    """Returns the number of replayed samples, the overall rate and the throughput (samples/s) of each stage.
+    The transform stage includes all observers that react synchronously, such as calculateDistance.
+    """
+    statistics = {'samples': self.numberOfReplayedSamples, 'durationSec': self.replayDurationSec}
+    statistics['samplesPerSec'] = self.numberOfReplayedSamples / self.replayDurationSec if self.replayDurationSec > 0 else 0.0
+    for stageName, stageTimeSec in self.stageTimesSec.items():
+      statistics[stageName + 'PerSec'] = self.numberOfReplayedSamples / stageTimeSec if stageTimeSec > 0 else 0.0
+    return statistics
+
+  def replaySample(self, sampleIndex):
+    # no logging - it slows Slicer down a *lot*
+    startTimeSec = time.time()
+    self.matrix.DeepCopy(self.matrices[sampleIndex].ravel())
+    self.transformNodes[self.nodeIndices[sampleIndex]].SetMatrixTransformToParent(self.matrix)
+    transformTimeSec = time.time()
+    if self.viewpointLogic:
+      self.viewpointLogic.flushViewpointCameraUpdate()
+    cameraTimeSec = time.time()
+    if self.renderEnabled and self.threeDView:
+      self.threeDView.forceRender()
+    renderTimeSec = time.time()
+    self.stageTimesSec['transform'] += transformTimeSec - startTimeSec
+    self.stageTimesSec['camera'] += cameraTimeSec - transformTimeSec
+    self.stageTimesSec['render'] += renderTimeSec - cameraTimeSec
+    self.numberOfReplayedSamples += 1
+
+  def replayAsFastAsPossible(self):
+    self.resetStatistics()
+    startTimeSec = time.time()
+    for sampleIndex in range(len(self.timestamps)):
+      self.replaySample(sampleIndex)
+    self.replayDurationSec = time.time() - startTimeSec
+    logging.info('TrackingReplayer: ' + str(self.getStatistics()))
+    return self.getStatistics()
+
+  def startRealTimeReplay(self):
+    if len(self.timestamps) == 0:
+      logging.warning('TrackingReplayer: nothing to replay')
+      return
+    self.resetStatistics()
+    self.nextSampleIndex = 0
+    self.replayStartTimeSec = time.time()
+    self.currentlyReplaying = True
+    self.replayTimer.start(0)
+
+  def stopRealTimeReplay(self):
+    self.replayTimer.stop()
+    self.currentlyReplaying = False
+    self.replayDurationSec = time.time() - self.replayStartTimeSec
+    logging.info('TrackingReplayer: ' + str(self.getStatistics()))
+
+  def onReplayTimerTimeout(self):
+    # Replay all samples that are due, then wait until the next one
+    elapsedSec = time.time() - self.replayStartTimeSec
+    firstTimestampSec = self.timestamps[0]
+    while self.nextSampleIndex < len(self.timestamps) and self.timestamps[self.nextSampleIndex] - firstTimestampSec <= elapsedSec:
+      self.replaySample(self.nextSampleIndex)
+      self.nextSampleIndex += 1
+    if self.nextSampleIndex >= len(self.timestamps):
+      self.stopRealTimeReplay()
+      return
+    delaySec = self.timestamps[self.nextSampleIndex] - firstTimestampSec - (time.time() - self.replayStartTimeSec)
+    self.replayTimer.start(max(0, int(delaySec * 1000)))
+
+#
+# NavigationBenchmark
+#
+
+class NavigationBenchmark:
+  """Drives synthetic NeedleToTracker updates through a configured PercutaneousNavigationLogic and
+  measures the time spent per update in each stage of the navigation pipeline.
+  """
+  stageNames = ['calculateCallback', 'drawLineBetweenPoints', 'updateViewpointCamera', 'render']
+
+  def __init__(self, navigationLogic, needleToTrackerTransformNode):
+    self.navigationLogic = navigationLogic
+    self.viewpointLogic = navigationLogic.viewpointLogic
+    self.needleToTrackerTransformNode = needleToTrackerTransformNode
+    self.matrix = vtk.vtkMatrix4x4()
+    self.stageTimesSec = None
+    self.originalMethods = {}
+
+  def instrument(self, instance, methodName, stageName):
+    # Replace the bound method on this instance by a timed wrapper, observers registered afterwards call the wrapper
+    method = getattr(instance, methodName)
+    self.originalMethods[(id(instance), methodName)] = instance.__dict__.get(methodName)
+    def timedMethod(*args, **kwargs):
+      startTimeSec = time.time()
+      result = method(*args, **kwargs)
+      self.stageTimesSec[stageName][-1] += time.time() - startTimeSec
+      return result
+    setattr(instance, methodName, timedMethod)
+
+  def uninstrument(self, instance, methodName):
+    # Restore what was there before, e.g. the callback profiler wrapper
+    originalMethod = self.originalMethods.pop((id(instance), methodName))
+    if originalMethod is None:
+      delattr(instance, methodName)
+    else:
+      setattr(instance, methodName, originalMethod)
+
+  def setNeedlePose(self, timeSec):
+    angleRad = 2 * math.pi * timeSec / 5.0
+    transform = vtk.vtkTransform()
+    transform.Translate(20.0 * math.cos(angleRad), 100.0 + 20.0 * math.sin(angleRad), 0.0)
+    transform.RotateY(15.0 * math.sin(angleRad))
+    self.needleToTrackerTransformNode.SetMatrixTransformToParent(transform.GetMatrix())
+
+  def run(self, updateRatesHz=(20, 40, 80, 160), numberOfUpdates=200, render=True):
+    """Returns {rate: {stage: {p50, p95, p99, max}}}, all times in milliseconds.
+    """
+    # calculateCallback is connected on addCalculateDistanceObserver, so reconnect it to the instrumented version
+    self.navigationLogic.removeCalculateDistanceObserver()
+    self.instrument(self.navigationLogic, 'calculateCallback', 'calculateCallback')
+    self.instrument(self.navigationLogic, 'drawLineBetweenPoints', 'drawLineBetweenPoints')
+    self.instrument(self.viewpointLogic, 'updateViewpointCamera', 'updateViewpointCamera')
+    self.navigationLogic.addCalculateDistanceObserver()
+    threeDView = self.navigationLogic.threeDView
+
+    results = {}
+    try:
+      for updateRateHz in updateRatesHz:
+        self.stageTimesSec = dict([(stageName, []) for stageName in self.stageNames])
+        intervalSec = 1.0 / updateRateHz
+        startTimeSec = time.time()
+        for updateIndex in range(numberOfUpdates):
+          for stageName in self.stageNames:
+            self.stageTimesSec[stageName].append(0.0)
+          self.setNeedlePose(updateIndex * intervalSec)
+          # let scheduled camera updates run, as in the live event loop
+          slicer.app.processEvents()
+          if render:
+            renderStartTimeSec = time.time()
+            threeDView.forceRender()
+            self.stageTimesSec['render'][-1] = time.time() - renderStartTimeSec
+          remainingSec = startTimeSec + (updateIndex + 1) * intervalSec - time.time()
+          if remainingSec > 0:
+            time.sleep(remainingSec)
+        results[str(updateRateHz)] = self.summarize()
+    finally:
+      self.navigationLogic.removeCalculateDistanceObserver()
+      self.uninstrument(self.navigationLogic, 'calculateCallback')
+      self.uninstrument(self.navigationLogic, 'drawLineBetweenPoints')
+      self.uninstrument(self.viewpointLogic, 'updateViewpointCamera')
+      self.navigationLogic.addCalculateDistanceObserver()
+    return results
+
+  def summarize(self):
+    summary = {}
+    for stageName in self.stageNames:
+      stageTimesMs = 1000.0 * np.array(self.stageTimesSec[stageName])
+      summary[stageName] = {
+        'p50': float(np.percentile(stageTimesMs, 50)),
+        'p95': float(np.percentile(stageTimesMs, 95)),
+        'p99': float(np.percentile(stageTimesMs, 99)),
+        'max': float(stageTimesMs.max())}
+    return summary
+
+  def save(self, results, fileName):
+    with open(fileName, 'w') as benchmarkFile:
+      json.dump({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'unit': 'ms', 'updateRatesHz': results}, benchmarkFile, indent=2, sort_keys=True)
+    logging.info('Benchmark results written to ' + fileName)
 
 
 class PercutaneousNavigationTest(ScriptedLoadableModuleTest):
@@ -613,4 +3910,246 @@ class PercutaneousNavigationTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_PercutaneousNavigation1()
+    self.test_StaticTransformCache()
+    self.setUp()
+    self.test_TrackingRecorder()
+    self.setUp()
+    self.test_PairedPointRegistration()
+    self.setUp()
+    self.test_SurfaceRegistration()
+    self.setUp()
+    self.test_PivotCalibration()
+    self.setUp()
+    self.test_ToolRegistry()
+    self.setUp()
+    self.test_PercutaneousNavigationBenchmark()
+
+  def test_StaticTransformCache(self):
+    """Moving a tracker transform keeps the precomposed static runs below it, changing a static transform does not."""
+    needleToTracker = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(needleToTracker)
+    needleTipToNeedle = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(needleTipToNeedle)
+    needleTipToNeedle.SetAndObserveTransformNodeID(needleToTracker.GetID())
+    calibration = vtk.vtkMatrix4x4()
+    calibration.SetElement(0, 3, 10.0)
+    needleTipToNeedle.SetMatrixTransformToParent(calibration)
+
+    staticTransformCache = StaticTransformCache()
+    staticTransformCache.setStaticTransformNodes([needleTipToNeedle])
+    tipToWorld = vtk.vtkMatrix4x4()
+    staticTransformCache.getMatrixTransformToWorld(needleTipToNeedle, tipToWorld)
+    self.assertIn(needleTipToNeedle.GetID(), staticTransformCache.staticRuns)
+
+    pose = vtk.vtkMatrix4x4()
+    pose.SetElement(1, 3, 5.0)
+    needleToTracker.SetMatrixTransformToParent(pose)
+    self.assertIn(needleTipToNeedle.GetID(), staticTransformCache.staticRuns)
+    staticTransformCache.getMatrixTransformToWorld(needleTipToNeedle, tipToWorld)
+    self.assertAlmostEqual(tipToWorld.GetElement(0, 3), 10.0)
+    self.assertAlmostEqual(tipToWorld.GetElement(1, 3), 5.0)
+
+    calibration.SetElement(0, 3, 20.0)
+    needleTipToNeedle.SetMatrixTransformToParent(calibration)
+    self.assertNotIn(needleTipToNeedle.GetID(), staticTransformCache.staticRuns)
+    staticTransformCache.getMatrixTransformToWorld(needleTipToNeedle, tipToWorld)
+    self.assertAlmostEqual(tipToWorld.GetElement(0, 3), 20.0)
+    staticTransformCache.setStaticTransformNodes([])
+
+  def test_TrackingRecorder(self):
+    """Once the ring buffer is full the oldest samples are overwritten, and samples are returned in chronological order."""
+    needleToTracker = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(needleToTracker)
+    trackingRecorder = TrackingRecorder()
+    # room for 5 samples of 146 bytes
+    trackingRecorder.setMaximumMemoryMB(5.5 * 146 / (1024.0 * 1024.0))
+    self.assertEqual(trackingRecorder.capacity, 5)
+    trackingRecorder.setTransformNodes([needleToTracker])
+    trackingRecorder.startRecording()
+    matrix = vtk.vtkMatrix4x4()
+    for sampleIndex in range(8):
+      matrix.SetElement(0, 3, sampleIndex)
+      needleToTracker.SetMatrixTransformToParent(matrix)
+    # an unchanged matrix is not a new sample
+    needleToTracker.SetMatrixTransformToParent(matrix)
+    trackingRecorder.stopRecording()
+
+    timestamps, nodeIndices, matrices = trackingRecorder.getSamples()
+    self.assertEqual(len(timestamps), 5)
+    self.assertEqual(trackingRecorder.writeIndex, 3)
+    self.assertEqual(matrices[:, 0, 3].tolist(), [3.0, 4.0, 5.0, 6.0, 7.0])
+    self.assertEqual(nodeIndices.tolist(), [0] * 5)
+    self.assertTrue(np.all(np.diff(timestamps) >= 0))
+
+  def rotationMatrix(self, angleXDeg, angleYDeg, angleZDeg):
+    transform = vtk.vtkTransform()
+    transform.RotateX(angleXDeg)
+    transform.RotateY(angleYDeg)
+    transform.RotateZ(angleZDeg)
+    matrix = transform.GetMatrix()
+    return np.array([[matrix.GetElement(row, column) for column in range(3)] for row in range(3)])
+
+  def test_PairedPointRegistration(self):
+    """The rigid transform is recovered from exact point pairs, and the expected TRE grows away from the fiducials."""
+    fiducialPositions = np.array([[0.0, 0.0, 0.0], [100.0, 0.0, 0.0], [0.0, 80.0, 0.0], [0.0, 0.0, 60.0], [50.0, 50.0, 50.0]])
+    rotation = self.rotationMatrix(10.0, -20.0, 30.0)
+    translation = np.array([5.0, -12.0, 40.0])
+    estimatedRotation, estimatedTranslation = computeRigidTransform(fiducialPositions, fiducialPositions.dot(rotation.T) + translation)
+    self.assertTrue(np.allclose(estimatedRotation, rotation))
+    self.assertTrue(np.allclose(estimatedTranslation, translation))
+
+    registration = PairedPointRegistration()
+    registration.fiducialPositions = fiducialPositions
+    registration.registeredFiducials = np.arange(len(fiducialPositions))
+    centroid = fiducialPositions.mean(axis=0)
+    targetRegistrationErrors = registration.computeTargetRegistrationError([centroid, centroid + [0.0, 0.0, 200.0]], fiducialLocalizationError=1.0)
+    # at the centroid TRE = FLE / sqrt(N)
+    self.assertAlmostEqual(targetRegistrationErrors[0], 1.0 / math.sqrt(len(fiducialPositions)))
+    self.assertGreater(targetRegistrationErrors[1], targetRegistrationErrors[0])
+
+  def test_SurfaceRegistration(self):
+    """ICP on a bumpy ellipsoid converges from a degree and a millimeter off to the true PatientToReference."""
+    from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(40)
+    sphere.SetPhiResolution(40)
+    sphere.SetRadius(1.0)
+    sphere.Update()
+    surfacePolyData = sphere.GetOutput()
+    # bumps like on a bone, on a smooth surface the samples slide along it and ICP converges very slowly
+    unitPoints = vtk_to_numpy(surfacePolyData.GetPoints().GetData()).astype(float)
+    bumps = 1.0 + 0.15 * np.sin(4.0 * unitPoints[:, 0]) * np.cos(3.0 * unitPoints[:, 1]) + 0.1 * np.sin(5.0 * unitPoints[:, 2])
+    surfacePoints = unitPoints * [40.0, 25.0, 15.0] * bumps[:, np.newaxis]
+    surfacePolyData.GetPoints().SetData(numpy_to_vtk(surfacePoints, deep=True))
+    surfaceModelNode = slicer.vtkMRMLModelNode()
+    surfaceModelNode.SetAndObservePolyData(surfacePolyData)
+    slicer.mrmlScene.AddNode(surfaceModelNode)
+
+    surfaceRegistration = SurfaceRegistration()
+    self.assertTrue(surfaceRegistration.setSurfaceModel(surfaceModelNode))
+    surfaceRegistration.rmsChangeToleranceMm = 0.0
+    surfaceRegistration.maximumNumberOfIterations = 150
+    patientToReference = np.eye(4)
+    patientToReference[0:3, 0:3] = self.rotationMatrix(1.0, -1.0, 1.0)
+    patientToReference[0:3, 3] = [1.0, -1.0, 1.0]
+    samplesInReference = surfacePoints.dot(patientToReference[0:3, 0:3].T) + patientToReference[0:3, 3]
+
+    # run the iterations synchronously, the background thread and the poll timer are not needed for the result
+    surfaceRegistration.runIterations(samplesInReference, np.eye(4))
+    results = []
+    while not surfaceRegistration.resultQueue.empty():
+      results.append(surfaceRegistration.resultQueue.get())
+    self.assertEqual(results[-1][0], 'done')
+    self.assertTrue(np.allclose(results[-1][1], patientToReference, atol=0.05))
+    self.assertLess(results[-2][2], results[0][2])
+
+  def test_PivotCalibration(self):
+    """Pivoting around a fixed point gives the tip offset and the pivot point, outliers are rejected."""
+    tipInTool = np.array([0.0, 0.0, -150.0])
+    pivotInTracker = np.array([10.0, 20.0, 30.0])
+    toolToTracker = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(toolToTracker)
+    pivotCalibration = PivotCalibration(initialCapacity=16)
+    pivotCalibration.start(toolToTracker)
+    randomState = np.random.RandomState(0)
+    matrix = vtk.vtkMatrix4x4()
+    numberOfSamples = 200
+    numberOfOutliers = 5
+    for sampleIndex in range(numberOfSamples):
+      rotation = self.rotationMatrix(*randomState.uniform(-30.0, 30.0, 3))
+      translation = pivotInTracker - rotation.dot(tipInTool)
+      if sampleIndex < numberOfOutliers:
+        translation += [20.0, 0.0, 0.0] # the tip slipped from the pivot point
+      for row in range(3):
+        for column in range(3):
+          matrix.SetElement(row, column, rotation[row, column])
+        matrix.SetElement(row, 3, translation[row])
+      toolToTracker.SetMatrixTransformToParent(matrix)
+    pivotCalibration.stop()
+
+    self.assertEqual(pivotCalibration.numberOfSamples, numberOfSamples)
+    self.assertEqual(pivotCalibration.rejectOutliers(), numberOfOutliers)
+    result = pivotCalibration.getResult()
+    self.assertEqual(result['inliers'], numberOfSamples - numberOfOutliers)
+    self.assertTrue(np.allclose(result['tipInTool'], tipInTool))
+    self.assertTrue(np.allclose(result['pivotInTracker'], pivotInTracker))
+    self.assertLess(result['rmsErrorMm'], 1e-6)
+
+  def test_ToolRegistry(self):
+    """Nearest target distance, depth along the tool direction and off-axis distance of each tool."""
+    toolRegistry = ToolRegistry(PoseCache(lambda transformNode, matrix: transformNode.GetMatrixTransformToWorld(matrix)))
+    matrix = vtk.vtkMatrix4x4()
+    toolTransformNodes = {}
+    # the tips are at (3, 0, 0) and (0, 1, 0), half of the offset comes from the tip calibration
+    for toolName, tipPosition in [('Needle', [3.0, 0.0, 0.0]), ('Pointer', [0.0, 1.0, 0.0])]:
+      toolToTracker = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(toolToTracker)
+      for row in range(3):
+        matrix.SetElement(row, 3, tipPosition[row] / 2.0)
+      toolToTracker.SetMatrixTransformToParent(matrix)
+      toolTipToTool = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(toolTipToTool)
+      toolTipToTool.SetMatrixTransformToParent(matrix)
+      toolTipToTool.SetAndObserveTransformNodeID(toolToTracker.GetID())
+      toolTransformNodes[toolName] = (toolToTracker, toolTipToTool)
+    # the needle points along -x, the pointer has no direction
+    toolRegistry.setTool('Needle', *toolTransformNodes['Needle'])
+    toolRegistry.setTool('Pointer', *toolTransformNodes['Pointer'], directionInTip=None)
+
+    targetPositions = np.array([[0.0, 4.0, 0.0], [100.0, 100.0, 100.0]])
+    self.assertTrue(toolRegistry.update(targetPositions))
+    self.assertFalse(toolRegistry.update(targetPositions))
+    (needleName, needleTarget, needleDistance, needleDepth, needleLateral), (pointerName, pointerTarget, pointerDistance, pointerDepth, pointerLateral) = toolRegistry.getNearestTargets()
+    self.assertEqual((needleName, needleTarget), ('Needle', 0))
+    self.assertAlmostEqual(needleDistance, 5.0)
+    self.assertAlmostEqual(needleDepth, 3.0)
+    self.assertAlmostEqual(needleLateral, 4.0)
+    self.assertEqual((pointerName, pointerTarget), ('Pointer', 0))
+    self.assertAlmostEqual(pointerDistance, 3.0)
+    self.assertTrue(math.isnan(pointerDepth) and math.isnan(pointerLateral))
+
+    # a new calibration is picked up even if no tracker transform moved
+    matrix.SetElement(0, 3, 0.0)
+    matrix.SetElement(1, 3, 0.0)
+    matrix.SetElement(2, 3, 0.0)
+    toolTransformNodes['Needle'][1].SetMatrixTransformToParent(matrix)
+    self.assertTrue(toolRegistry.update(targetPositions))
+    self.assertAlmostEqual(toolRegistry.getNearestTargets()[0][2], math.sqrt(1.5 ** 2 + 4.0 ** 2))
+
+  def test_PercutaneousNavigationBenchmark(self, updateRatesHz=(20, 40, 80, 160), numberOfUpdates=200, outputFileName=None):
+    """Measures the latency of each navigation stage for synthetic needle updates and
+    writes p50/p95/p99/max per update rate to a JSON file.
+    """
+    self.delayDisplay("Starting the benchmark")
+
+    # Synthetic scene: needle tracked by NeedleToTracker, tip calibration, one target
+    needleToTracker = slicer.vtkMRMLLinearTransformNode()
+    needleToTracker.SetName('NeedleToTracker')
+    slicer.mrmlScene.AddNode(needleToTracker)
+    needleTipToNeedle = slicer.vtkMRMLLinearTransformNode()
+    needleTipToNeedle.SetName('NeedleTipToNeedle')
+    slicer.mrmlScene.AddNode(needleTipToNeedle)
+    needleTipToNeedle.SetAndObserveTransformNodeID(needleToTracker.GetID())
+    needleModel = slicer.modules.createmodels.logic().CreateNeedle(80, 1.0, 2.5, 0)
+    needleModel.SetAndObserveTransformNodeID(needleTipToNeedle.GetID())
+
+    logic = PercutaneousNavigationLogic()
+    logic.targetFiducial.SetNthFiducialPosition(0, 0, 100, -50)
+    logic.setOutPutDistanceLabel(qt.QLabel())
+    logic.SetMembers(needleTipToNeedle, needleToTracker)
+    logic.addCalculateDistanceObserver()
+    logic.SetNeedleViewpoint(needleModel, needleToTracker)
+
+    benchmark = NavigationBenchmark(logic, needleToTracker)
+    results = benchmark.run(updateRatesHz, numberOfUpdates)
+    logic.StopViewpoint()
+    logic.removeCalculateDistanceObserver()
+
+    if not outputFileName:
+      outputFileName = os.path.join(slicer.app.temporaryPath, 'PercutaneousNavigationBenchmark.json')
+    benchmark.save(results, outputFileName)
+
+    self.assertEqual(len(results), len(updateRatesHz))
+    for updateRateHz in results:
+      self.assertEqual(sorted(results[updateRateHz].keys()), sorted(NavigationBenchmark.stageNames))
+    self.delayDisplay('Benchmark passed, results written to ' + outputFileName)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Simulates the PLUS server defined in PlusConfig-NeuroestimulacionRaicesSacras_Ascension3DGm.xml
+without any tracking hardware.
+
+The ReferenceToTracker, TrackerToReference, NeedleToTracker and PointerToTracker transforms
+are streamed as OpenIGTLink TRANSFORM messages (port 18944 by default) following scripted
+motion paths. Connect to it from Slicer with OpenIGTLinkIF exactly as to the real PLUS server.
+
+Example:
+  python PlusServerSimulator.py --rate 200 --path insertion
+"""
+
+import argparse
+import math
+import select
+import socket
+import struct
+import time
+
+IGTL_HEADER_FORMAT = '>H12s20sQQQ'
+IGTL_TRANSFORM_BODY_FORMAT = '>12f'
+IGTL_VERSION = 1
+
+TRANSFORM_NAMES = ['ReferenceToTracker', 'TrackerToReference', 'NeedleToTracker', 'PointerToTracker']
+
+#
+# OpenIGTLink encoding
+#
+
+CRC64_POLYNOMIAL = 0x42F0E1EBA9EA3693 # ECMA-182, as used by OpenIGTLink
+CRC64_TABLE = []
+for byte in range(256):
+  crc = byte << 56
+  for bit in range(8):
+    if crc & (1 << 63):
+      crc = ((crc << 1) ^ CRC64_POLYNOMIAL) & 0xFFFFFFFFFFFFFFFF
+    else:
+      crc = (crc << 1) & 0xFFFFFFFFFFFFFFFF
+  CRC64_TABLE.append(crc)
+
+def crc64(data):
+  crc = 0
+  for byte in bytearray(data):
+    crc = CRC64_TABLE[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & 0xFFFFFFFFFFFFFFFF)
+  return crc
+
+def igtlTimestamp(timeSec):
+  seconds = int(timeSec)
+  fraction = int((timeSec - seconds) * (1 << 32)) & 0xFFFFFFFF
+  return (seconds << 32) | fraction
+
+def encodeTransformMessage(deviceName, matrix, timeSec):
+  """matrix is a 3x4 row-major list of lists (rotation and translation)."""
+  # OpenIGTLink stores the rotation column by column, followed by the translation
+  body = struct.pack(IGTL_TRANSFORM_BODY_FORMAT,
+    matrix[0][0], matrix[1][0], matrix[2][0],
+    matrix[0][1], matrix[1][1], matrix[2][1],
+    matrix[0][2], matrix[1][2], matrix[2][2],
+    matrix[0][3], matrix[1][3], matrix[2][3])
+  header = struct.pack(IGTL_HEADER_FORMAT, IGTL_VERSION, b'TRANSFORM', deviceName.encode('ascii'), igtlTimestamp(timeSec), len(body), crc64(body))
+  return header + body
+
+#
+# Motion paths
+#
+
+def rotationZ(angleRad):
+  c = math.cos(angleRad)
+  s = math.sin(angleRad)
+  return [[c, -s, 0], [s, c, 0], [0, 0, 1]]
+
+def rotationY(angleRad):
+  c = math.cos(angleRad)
+  s = math.sin(angleRad)
+  return [[c, 0, s], [0, 1, 0], [-s, 0, c]]
+
+def multiplyRotations(a, b):
+  return [[sum(a[row][k] * b[k][column] for k in range(3)) for column in range(3)] for row in range(3)]
+
+def rigidMatrix(rotation, translation):
+  return [rotation[row] + [translation[row]] for row in range(3)]
+
+def invertRigidMatrix(matrix):
+  rotationT = [[matrix[column][row] for column in range(3)] for row in range(3)]
+  translation = [-sum(rotationT[row][k] * matrix[k][3] for k in range(3)) for row in range(3)]
+  return rigidMatrix(rotationT, translation)
+
+def referenceToTracker(path, timeSec):
+  # Reference sensor fixed on the patient, small breathing motion
+  breathingMm = 0.0 if path == 'static' else 1.5 * math.sin(2 * math.pi * timeSec / 4.0)
+  return rigidMatrix(rotationZ(0.0), [0.0, 150.0 + breathingMm, -50.0])
+
+def needleToTracker(path, timeSec):
+  if path == 'static':
+    return rigidMatrix(rotationY(0.3), [20.0, 100.0, 0.0])
+  if path == 'insertion':
+    # slow advance along the needle axis (-X in needle coordinates), 60 mm back and forth every 20 s
+    depthMm = 30.0 * (1 - math.cos(2 * math.pi * timeSec / 20.0))
+    rotation = rotationY(0.3)
+    return rigidMatrix(rotation, [20.0 - depthMm * rotation[0][0], 100.0 - depthMm * rotation[1][0], 0.0 - depthMm * rotation[2][0]])
+  # circle: needle pivots around an entry point
+  angleRad = 2 * math.pi * timeSec / 5.0
+  rotation = multiplyRotations(rotationZ(0.3 * math.sin(angleRad)), rotationY(0.3 + 0.2 * math.cos(angleRad)))
+  return rigidMatrix(rotation, [20.0, 100.0, 0.0])
+
+def pointerToTracker(path, timeSec):
+  if path == 'static':
+    return rigidMatrix(rotationZ(0.0), [-40.0, 120.0, 30.0])
+  # pointer sweeps over the surface
+  angleRad = 2 * math.pi * timeSec / 3.0
+  return rigidMatrix(rotationZ(0.5 * math.sin(angleRad)), [-40.0 + 30.0 * math.cos(angleRad), 120.0 + 30.0 * math.sin(angleRad), 30.0])
+
+def computeTransforms(path, timeSec):
+  reference = referenceToTracker(path, timeSec)
+  return {
+    'ReferenceToTracker': reference,
+    'TrackerToReference': invertRigidMatrix(reference),
+    'NeedleToTracker': needleToTracker(path, timeSec),
+    'PointerToTracker': pointerToTracker(path, timeSec)}
+
+#
+# Server
+#
+
+def run(port, rateHz, path, durationSec):
+  serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  serverSocket.bind(('', port))
+  serverSocket.listen(5)
+  serverSocket.setblocking(False)
+  print('Simulated PLUS server listening on port %d, %.0f Hz, path: %s' % (port, rateHz, path))
+
+  clients = []
+  intervalSec = 1.0 / rateHz
+  startTimeSec = time.time()
+  nextFrameTimeSec = startTimeSec
+  numberOfFrames = 0
+  lastReportTimeSec = startTimeSec
+  try:
+    while durationSec <= 0 or time.time() - startTimeSec < durationSec:
+      # Accept new clients and wait until the next frame is due
+      timeoutSec = max(0.0, nextFrameTimeSec - time.time())
+      readable, _, _ = select.select([serverSocket] + clients, [], [], timeoutSec)
+      for readableSocket in readable:
+        if readableSocket is serverSocket:
+          clientSocket, address = serverSocket.accept()
+          clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+          clients.append(clientSocket)
+          print('Client connected: %s:%d' % address)
+        else:
+          # Incoming messages (e.g. GET_ or STT_ requests) are ignored, only detect disconnection
+          try:
+            data = readableSocket.recv(4096)
+          except socket.error:
+            data = b''
+          if not data:
+            clients.remove(readableSocket)
+            readableSocket.close()
+            print('Client disconnected')
+      currentTimeSec = time.time()
+      if currentTimeSec < nextFrameTimeSec:
+        continue
+      # Skip frames instead of bursting if we fell behind
+      nextFrameTimeSec = max(nextFrameTimeSec + intervalSec, currentTimeSec)
+
+      transforms = computeTransforms(path, currentTimeSec - startTimeSec)
+      frame = b''.join([encodeTransformMessage(name, transforms[name], currentTimeSec) for name in TRANSFORM_NAMES])
+      for clientSocket in list(clients):
+        try:
+          clientSocket.sendall(frame)
+        except socket.error:
+          clients.remove(clientSocket)
+          clientSocket.close()
+          print('Client disconnected')
+      numberOfFrames += 1
+
+      if currentTimeSec - lastReportTimeSec >= 5.0:
+        print('%.1f frames/s sent to %d client(s)' % (numberOfFrames / (currentTimeSec - lastReportTimeSec), len(clients)))
+        numberOfFrames = 0
+        lastReportTimeSec = currentTimeSec
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for clientSocket in clients:
+      clientSocket.close()
+    serverSocket.close()
+
+def main():
+  parser = argparse.ArgumentParser(description='Simulate the PLUS OpenIGTLink tracker stream used by PercutaneousNavigation.')
+  parser.add_argument('--port', type=int, default=18944, help='OpenIGTLink server port (default: 18944, as in the PLUS config)')
+  parser.add_argument('--rate', type=float, default=40.0, help='frames per second, each frame contains all transforms (default: 40)')
+  parser.add_argument('--path', choices=['static', 'circle', 'insertion'], default='circle', help='scripted motion of the tools (default: circle)')
+  parser.add_argument('--duration', type=float, default=0.0, help='stop after this many seconds, 0 runs until interrupted')
+  args = parser.parse_args()
+  run(args.port, args.rate, args.path, args.duration)
+
+if __name__ == '__main__':
+  main()
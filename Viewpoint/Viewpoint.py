@@ -1,5 +1,9 @@
 from __main__ import vtk, qt, ctk, slicer
+import bisect
+import csv
 import logging
+import sys
+import time
 
 #
 # Viewpoint
@@ -51,6 +55,10 @@ class ViewpointWidget:
     self.cameraParallelScaleMinDeg     = 0.001  # maximum magnification
     self.cameraParallelScaleMaxDeg     = 1000.0 # minimum magnification
     
+    self.sliderUpdateRateDefaultHz     = 60
+    self.cameraUpdateRateMinHz         = 0    # 0 = no rate limit, update on every transform event
+    self.cameraUpdateRateMaxHz         = 200
+    
     self.sliderSingleStepValue = 1
     self.sliderPageStepValue   = 10
     
@@ -302,6 +310,18 @@ class ViewpointWidget:
     self.cameraParallelProjectionCheckbox.setToolTip("If checked, render with parallel projection (box-shaped view). Otherwise render with perspective projection (cone-shaped view).")
     self.cameraControlFormLayout.addRow(self.cameraParallelProjectionLabel,self.cameraParallelProjectionCheckbox)
     
+    # Maximum camera update rate
+    self.cameraUpdateRateLabel = qt.QLabel()
+    self.cameraUpdateRateLabel.setText("Max update rate (Hz): ")
+    self.cameraUpdateRateSlider = slicer.qMRMLSliderWidget()
+    self.cameraUpdateRateSlider.minimum = self.cameraUpdateRateMinHz
+    self.cameraUpdateRateSlider.maximum = self.cameraUpdateRateMaxHz
+    self.cameraUpdateRateSlider.value = self.sliderUpdateRateDefaultHz
+    self.cameraUpdateRateSlider.singleStep = self.sliderSingleStepValue
+    self.cameraUpdateRateSlider.pageStep = self.sliderPageStepValue
+    self.cameraUpdateRateSlider.setToolTip("Transform updates arriving faster than this rate are merged into a single camera update. Set to 0 to update on every transform event.")
+    self.cameraControlFormLayout.addRow(self.cameraUpdateRateLabel,self.cameraUpdateRateSlider)
+    
     # "Toggle Tool Point of View" button
     self.enableViewpointButton = qt.QPushButton()
     self.enableViewpointButton.setToolTip("The camera will continuously update its position so that it follows the tool.")
@@ -316,6 +336,7 @@ class ViewpointWidget:
     self.cameraXPosSlider.connect('valueChanged(double)', self.logic.SetCameraXPosMm)
     self.cameraYPosSlider.connect('valueChanged(double)', self.logic.SetCameraYPosMm)
     self.cameraZPosSlider.connect('valueChanged(double)', self.logic.SetCameraZPosMm)
+    self.cameraUpdateRateSlider.connect('valueChanged(double)', self.logic.SetMaximumCameraUpdateRateHz)
     self.upDirectionAnteriorRadioButton.connect('clicked()', self.changeUpToAnterior)
     self.upDirectionPosteriorRadioButton.connect('clicked()', self.changeUpToPosterior)
     self.upDirectionLeftRadioButton.connect('clicked()', self.changeUpToLeft)
@@ -412,14 +433,18 @@ class ViewpointWidget:
 #
 
 class ViewpointLogic:
-  def __init__(self):
+  def __init__(self, callbackProfiler=None):
+    # Observer callbacks are instrumented before any observer is added, see CallbackProfiler
+    self.callbackProfiler = callbackProfiler if callbackProfiler else CallbackProfiler()
+    self.callbackProfiler.instrumentMethods(self, ['onTransformModified', 'onTransformNodeReferenceModified', 'onCameraUpdateTimerTimeout', 'onClippingModelModified', 'onClippingModelTransformModified'])
+
     self.transformNode = None
     self.cameraNode = None
     self.modelPOVOnNode = None
     self.modelPOVOffNode = None
     
     self.currentlyInViewpoint = False
-    self.transformNodeObserverTags = []
+    self.transformNodeObserverTags = {} # node ID: [node, observer tags], at most one subscription per node
     
     self.cameraXPosMm =  0.0
     self.cameraYPosMm =  0.0
@@ -439,26 +464,233 @@ class ViewpointLogic:
     
     self.cameraViewAngleDeg  =  30.0
     self.cameraParallelScale = 1.0
+    
+    # Camera updates are coalesced: transform events only mark the camera as dirty, and a
+    # single-shot timer performs at most one update per interval (latest pose wins).
+    self.maximumCameraUpdateRateHz = 60.0 # 0 = update synchronously on every transform event
+    self.cameraUpdatePending = False
+    self.lastCameraUpdateTimeSec = 0.0
+    self.cameraUpdateTimer = qt.QTimer()
+    self.cameraUpdateTimer.setSingleShot(True)
+    self.cameraUpdateTimer.connect('timeout()', self.onCameraUpdateTimerTimeout)
+    
+    # Preallocated buffers for the linear fast path of updateViewpointCamera
+    self.toolCameraToRASMatrix = vtk.vtkMatrix4x4()
+    # Optional function(transformNode, matrix) replacing GetMatrixTransformToWorld, e.g. to read a pose cache shared by several cameras
+    self.matrixTransformToWorldFunction = None
+    self.cameraOriginInRASMm = [0.0,0.0,0.0]
+    self.focalPointInRASMm = [0.0,0.0,0.0]
+    self.upDirectionInRAS = [0.0,0.0,0.0]
+    
+    # Clipping range: ResetClippingRange() computes the bounds of every visible prop in the scene on each update.
+    # Instead, the bounding box corners of the registered models can be cached in the coordinate system of their
+    # nearest dynamic (tracker) transform, recomputed only when a model or a static transform below that changes,
+    # and the near and far planes derived from them, see setClippingModelNodes()
+    self.cachedClippingRangeEnabled = False
+    self.clippingModels = {} # node ID: [model node, observer tags, bounding box corners, None if outdated, dynamic ancestor, static chain state]
+    self.clippingDynamicTransformNodeIDs = set()
+    self.clippingRangeMarginMm = 5.0
+    self.nearToFarClippingRatio = 0.001 # keeps the depth buffer precision, as vtkRenderer does
+    self.modelToRASMatrix = vtk.vtkMatrix4x4()
+    self.clippingMatrixToParent = vtk.vtkMatrix4x4()
+    self.dynamicAncestorToRASMatrix = vtk.vtkMatrix4x4()
+    self.modelBoundsCorner = [0.0,0.0,0.0,1.0]
+    self.clippingRange = [0.0,0.0]
+    
+    # Per-frame cost statistics, see getCameraUpdateStatistics()
+    self.resetCameraUpdateStatistics()
 
   def addObservers(self): # mostly copied from PositionErrorMapping.py in PLUS
     logging.debug("Adding observers...")
     transformModifiedEvent = 15000
+    # Changing the parent of a node in the chain (e.g. rebuilding the transform tree) modifies its transform reference
+    referenceEvents = [slicer.vtkMRMLNode.ReferenceAddedEvent, slicer.vtkMRMLNode.ReferenceModifiedEvent, slicer.vtkMRMLNode.ReferenceRemovedEvent]
+    chainNodeIDs = []
     transformNode = self.transformNode
     while transformNode:
-      logging.debug("Add observer to {0}".format(transformNode.GetName()))
-      self.transformNodeObserverTags.append([transformNode, transformNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
+      nodeID = transformNode.GetID()
+      chainNodeIDs.append(nodeID)
+      if nodeID not in self.transformNodeObserverTags:
+        logging.debug("Add observer to {0}".format(transformNode.GetName()))
+        tags = [transformNode.AddObserver(transformModifiedEvent, self.onTransformModified)]
+        for referenceEvent in referenceEvents:
+          tags.append(transformNode.AddObserver(referenceEvent, self.onTransformNodeReferenceModified))
+        self.transformNodeObserverTags[nodeID] = [transformNode, tags]
       transformNode = transformNode.GetParentTransformNode()
+    # Nodes that are no longer in the chain
+    for nodeID in list(self.transformNodeObserverTags.keys()):
+      if nodeID not in chainNodeIDs:
+        self.removeNodeObservers(nodeID)
     logging.debug("Done adding observers")
 
+  def removeNodeObservers(self, nodeID):
+    logging.debug("Remove observers from {0}".format(nodeID))
+    node, tags = self.transformNodeObserverTags.pop(nodeID)
+    for tag in tags:
+      node.RemoveObserver(tag)
+
   def removeObservers(self):
     logging.debug("Removing observers...")
-    for nodeTagPair in self.transformNodeObserverTags:
-      nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+    for nodeID in list(self.transformNodeObserverTags.keys()):
+      self.removeNodeObservers(nodeID)
     logging.debug("Done removing observers")
+
+  def getNumberOfObservedTransformNodes(self):
+    return len(self.transformNodeObserverTags)
+
+  def onTransformNodeReferenceModified(self, observer, eventid):
+    # The transform chain was re-parented, follow the new ancestors
+    if (self.currentlyInViewpoint == True):
+      self.addObservers()
     
   def setTransformNode(self, transformNode):
     self.transformNode = transformNode
     
+  def setMatrixTransformToWorldFunction(self, matrixTransformToWorldFunction):
+    self.matrixTransformToWorldFunction = matrixTransformToWorldFunction
+    
+  def setCachedClippingRangeEnabled(self, enabled):
+    self.cachedClippingRangeEnabled = enabled
+    
+  def setClippingModelNodes(self, modelNodes, dynamicTransformNodes=()):
+    # The near and far clipping planes enclose these models, e.g. the anatomy and the tools.
+    # dynamicTransformNodes change on every frame (e.g. ReferenceToTracker, NeedleToTracker), the corners of each
+    # model are cached below its nearest dynamic ancestor, so that moving it does not require recomputing them
+    self.removeClippingModelObservers()
+    self.clippingDynamicTransformNodeIDs = set([transformNode.GetID() for transformNode in dynamicTransformNodes if transformNode])
+    transformModifiedEvent = slicer.vtkMRMLTransformableNode.TransformModifiedEvent
+    # MeshModifiedEvent replaced PolyDataModifiedEvent in newer Slicer versions
+    meshModifiedEvent = getattr(slicer.vtkMRMLModelNode, 'MeshModifiedEvent', None)
+    if meshModifiedEvent is None:
+      meshModifiedEvent = slicer.vtkMRMLModelNode.PolyDataModifiedEvent
+    for modelNode in modelNodes:
+      if not modelNode or modelNode.GetID() in self.clippingModels:
+        continue
+      tags = [modelNode.AddObserver(transformModifiedEvent, self.onClippingModelTransformModified), modelNode.AddObserver(meshModifiedEvent, self.onClippingModelModified)]
+      self.clippingModels[modelNode.GetID()] = [modelNode, tags, None, None, None]
+    
+  def removeClippingModelObservers(self):
+    for modelNode, tags, corners, dynamicAncestor, staticChainState in self.clippingModels.values():
+      for tag in tags:
+        modelNode.RemoveObserver(tag)
+    self.clippingModels = {}
+    
+  def getStaticChainState(self, modelNode):
+    # Own transform modification time and parent of every transform between the model and its dynamic ancestor.
+    # None for a non-linear chain, its RAS aligned bounds are recomputed on every transform change.
+    parentTransformNode = modelNode.GetParentTransformNode()
+    if parentTransformNode and not parentTransformNode.IsTransformToWorldLinear():
+      return None
+    state = [modelNode.GetTransformNodeID()]
+    transformNode = parentTransformNode
+    while transformNode and transformNode.GetID() not in self.clippingDynamicTransformNodeIDs:
+      state.append(transformNode.GetTransformToParent().GetMTime())
+      state.append(transformNode.GetTransformNodeID())
+      transformNode = transformNode.GetParentTransformNode()
+    return state
+    
+  def onClippingModelModified(self, observer, eventid):
+    # no logging - it slows Slicer down a *lot*
+    clippingModel = self.clippingModels.get(observer.GetID())
+    if clippingModel:
+      clippingModel[2] = None
+    
+  def onClippingModelTransformModified(self, observer, eventid):
+    # no logging - it slows Slicer down a *lot*
+    # TransformModifiedEvent is also invoked when a dynamic ancestor moves, that does not change the cached corners
+    clippingModel = self.clippingModels.get(observer.GetID())
+    if clippingModel and clippingModel[2] is not None:
+      if clippingModel[4] is None or self.getStaticChainState(observer) != clippingModel[4]:
+        clippingModel[2] = None
+    
+  def updateModelBoundsCorners(self, clippingModel):
+    # The 8 corners of the local bounding box, transformed to the dynamic ancestor (RAS if there is none):
+    # a tighter box than the RAS aligned bounds
+    modelNode = clippingModel[0]
+    clippingModel[2] = []
+    clippingModel[3] = None
+    clippingModel[4] = self.getStaticChainState(modelNode)
+    polyData = modelNode.GetPolyData()
+    if not polyData or polyData.GetNumberOfPoints() == 0:
+      return
+    bounds = polyData.GetBounds()
+    self.modelToRASMatrix.Identity()
+    if clippingModel[4] is None:
+      # non-linear chain, use the RAS aligned bounds computed by the node
+      bounds = [0.0]*6
+      modelNode.GetRASBounds(bounds)
+    else:
+      transformNode = modelNode.GetParentTransformNode()
+      while transformNode and transformNode.GetID() not in self.clippingDynamicTransformNodeIDs:
+        transformNode.GetMatrixTransformToParent(self.clippingMatrixToParent)
+        vtk.vtkMatrix4x4.Multiply4x4(self.clippingMatrixToParent, self.modelToRASMatrix, self.modelToRASMatrix)
+        transformNode = transformNode.GetParentTransformNode()
+      clippingModel[3] = transformNode
+    corners = clippingModel[2]
+    corner = self.modelBoundsCorner
+    for xIndex in (0,1):
+      for yIndex in (2,3):
+        for zIndex in (4,5):
+          corner[0] = bounds[xIndex]
+          corner[1] = bounds[yIndex]
+          corner[2] = bounds[zIndex]
+          corners.extend(self.modelToRASMatrix.MultiplyPoint(corner)[0:3])
+    
+  def computeClippingRange(self, cameraOriginInRASMm, focalPointInRASMm):
+    # no logging - it slows Slicer down a *lot*
+    # Near and far planes from the depth of the cached corners along the viewing direction.
+    # Returns None if no visible model is in front of the camera.
+    directionX = focalPointInRASMm[0] - cameraOriginInRASMm[0]
+    directionY = focalPointInRASMm[1] - cameraOriginInRASMm[1]
+    directionZ = focalPointInRASMm[2] - cameraOriginInRASMm[2]
+    directionLength = (directionX*directionX + directionY*directionY + directionZ*directionZ) ** 0.5
+    if (directionLength == 0):
+      return None
+    directionX /= directionLength
+    directionY /= directionLength
+    directionZ /= directionLength
+    offset = directionX*cameraOriginInRASMm[0] + directionY*cameraOriginInRASMm[1] + directionZ*cameraOriginInRASMm[2]
+    minimumDepthMm = None
+    maximumDepthMm = None
+    for clippingModel in self.clippingModels.values():
+      modelNode = clippingModel[0]
+      displayNode = modelNode.GetDisplayNode()
+      if not displayNode or not displayNode.GetVisibility():
+        continue
+      if clippingModel[2] is None:
+        self.updateModelBoundsCorners(clippingModel)
+      corners = clippingModel[2]
+      dynamicAncestor = clippingModel[3]
+      if dynamicAncestor:
+        # Depth of a corner c is d . (R c + t) - offset = (R^T d) . c + (d . t - offset), so the viewing direction
+        # is transformed into the coordinate system of the corners once instead of transforming every corner
+        if self.matrixTransformToWorldFunction:
+          self.matrixTransformToWorldFunction(dynamicAncestor, self.dynamicAncestorToRASMatrix)
+        else:
+          dynamicAncestor.GetMatrixTransformToWorld(self.dynamicAncestorToRASMatrix)
+        m = self.dynamicAncestorToRASMatrix
+        cornerDirectionX = m.GetElement(0,0)*directionX + m.GetElement(1,0)*directionY + m.GetElement(2,0)*directionZ
+        cornerDirectionY = m.GetElement(0,1)*directionX + m.GetElement(1,1)*directionY + m.GetElement(2,1)*directionZ
+        cornerDirectionZ = m.GetElement(0,2)*directionX + m.GetElement(1,2)*directionY + m.GetElement(2,2)*directionZ
+        cornerOffset = offset - (m.GetElement(0,3)*directionX + m.GetElement(1,3)*directionY + m.GetElement(2,3)*directionZ)
+      else:
+        cornerDirectionX = directionX
+        cornerDirectionY = directionY
+        cornerDirectionZ = directionZ
+        cornerOffset = offset
+      for cornerIndex in range(0, len(corners), 3):
+        depthMm = cornerDirectionX*corners[cornerIndex] + cornerDirectionY*corners[cornerIndex+1] + cornerDirectionZ*corners[cornerIndex+2] - cornerOffset
+        if (minimumDepthMm is None or depthMm < minimumDepthMm):
+          minimumDepthMm = depthMm
+        if (maximumDepthMm is None or depthMm > maximumDepthMm):
+          maximumDepthMm = depthMm
+    if (maximumDepthMm is None or maximumDepthMm <= 0):
+      return None
+    farMm = maximumDepthMm + self.clippingRangeMarginMm
+    self.clippingRange[0] = max(minimumDepthMm - self.clippingRangeMarginMm, farMm * self.nearToFarClippingRatio)
+    self.clippingRange[1] = farMm
+    return self.clippingRange
+    
   def setCameraNode(self, cameraNode):
     self.cameraNode = cameraNode
     
@@ -514,12 +746,45 @@ class ViewpointLogic:
       modelPOVOffDisplayNode = self.modelPOVOffNode.GetDisplayNode()
       modelPOVOffDisplayNode.SetVisibility(True)
     self.currentlyInViewpoint = False
+    self.cameraUpdateTimer.stop()
+    self.cameraUpdatePending = False
     self.removeObservers();
 
   def onTransformModified(self, observer, eventid):
     # no logging - it slows Slicer down a *lot*
+    if (self.maximumCameraUpdateRateHz <= 0):
+      self.updateViewpointCamera()
+      return
+    self.scheduleViewpointCameraUpdate()
+    
+  def scheduleViewpointCameraUpdate(self):
+    # no logging - it slows Slicer down a *lot*
+    self.cameraUpdatePending = True
+    if (self.cameraUpdateTimer.isActive()):
+      return # an update is already scheduled, it will use the latest transforms
+    minimumIntervalSec = 1.0 / self.maximumCameraUpdateRateHz
+    elapsedSec = time.time() - self.lastCameraUpdateTimeSec
+    delayMs = max(0, int((minimumIntervalSec - elapsedSec) * 1000))
+    self.cameraUpdateTimer.start(delayMs)
+    
+  def onCameraUpdateTimerTimeout(self):
+    # no logging - it slows Slicer down a *lot*
+    if (not self.cameraUpdatePending or not self.currentlyInViewpoint):
+      return
+    self.cameraUpdatePending = False
+    self.lastCameraUpdateTimeSec = time.time()
     self.updateViewpointCamera()
     
+  def flushViewpointCameraUpdate(self):
+    # no logging - it slows Slicer down a *lot*
+    # Perform a scheduled camera update right away (e.g. when replaying tracking data faster than realtime)
+    self.cameraUpdateTimer.stop()
+    self.onCameraUpdateTimerTimeout()
+    
+  def SetMaximumCameraUpdateRateHz(self,rateHz):
+    logging.debug("SetMaximumCameraUpdateRateHz")
+    self.maximumCameraUpdateRateHz = rateHz
+    
   def SetCameraParallelProjection(self,newParallelProjectionState):
     logging.debug("SetCameraParallelProjection")
     self.cameraParallelProjection = newParallelProjectionState
@@ -562,14 +827,28 @@ class ViewpointLogic:
 
   def updateViewpointCamera(self):
     # no logging - it slows Slicer down a *lot*
+    startTimeSec = time.time()
     
     # Need to set camera attributes according to the concatenated transform
-    toolCameraToRASTransform = vtk.vtkGeneralTransform()
-    self.transformNode.GetTransformToWorld(toolCameraToRASTransform)
-    
-    cameraOriginInRASMm = self.computeCameraOriginInRASMm(toolCameraToRASTransform)
-    focalPointInRASMm = self.computeCameraFocalPointInRASMm(toolCameraToRASTransform)
-    upDirectionInRAS = self.computeCameraUpDirectionInRAS(toolCameraToRASTransform,cameraOriginInRASMm,focalPointInRASMm)
+    if (self.transformNode.IsTransformToWorldLinear()):
+      if (self.matrixTransformToWorldFunction):
+        self.matrixTransformToWorldFunction(self.transformNode, self.toolCameraToRASMatrix)
+      else:
+        self.transformNode.GetMatrixTransformToWorld(self.toolCameraToRASMatrix)
+      self.computeCameraPoseFromMatrix(self.toolCameraToRASMatrix)
+      cameraOriginInRASMm = self.cameraOriginInRASMm
+      focalPointInRASMm = self.focalPointInRASMm
+      upDirectionInRAS = self.upDirectionInRAS
+      if (self.forcedUpDirection == True):
+        upDirectionInRAS = self.computeCameraUpDirectionInRAS(None,cameraOriginInRASMm,focalPointInRASMm)
+    else:
+      # non-linear chain, fall back to the general transform
+      toolCameraToRASTransform = vtk.vtkGeneralTransform()
+      self.transformNode.GetTransformToWorld(toolCameraToRASTransform)
+      self.generalTransformAllocationCount += 1
+      cameraOriginInRASMm = self.computeCameraOriginInRASMm(toolCameraToRASTransform)
+      focalPointInRASMm = self.computeCameraFocalPointInRASMm(toolCameraToRASTransform)
+      upDirectionInRAS = self.computeCameraUpDirectionInRAS(toolCameraToRASTransform,cameraOriginInRASMm,focalPointInRASMm)
     
     self.setCameraParameters(cameraOriginInRASMm,focalPointInRASMm,upDirectionInRAS)
     
@@ -580,6 +859,50 @@ class ViewpointLogic:
     if (self.modelPOVOnNode):
       modelPOVOnDisplayNode = self.modelPOVOnNode.GetDisplayNode()
       modelPOVOnDisplayNode.SetVisibility(True)
+    
+    elapsedSec = time.time() - startTimeSec
+    self.cameraUpdateCount += 1
+    self.cameraUpdateTotalTimeSec += elapsedSec
+    if (elapsedSec > self.cameraUpdateMaxTimeSec):
+      self.cameraUpdateMaxTimeSec = elapsedSec
+    
+  def computeCameraPoseFromMatrix(self, toolCameraToRASMatrix):
+    # Fast path for linear transforms: origin, focal point and up direction are read directly
+    # from the matrix columns into the preallocated buffers (no VTK objects are created)
+    m = toolCameraToRASMatrix
+    x = self.cameraXPosMm
+    y = self.cameraYPosMm
+    z = self.cameraZPosMm
+    origin = self.cameraOriginInRASMm
+    focal = self.focalPointInRASMm
+    up = self.upDirectionInRAS
+    for row in range(3):
+      m0 = m.GetElement(row,0)
+      m1 = m.GetElement(row,1)
+      m2 = m.GetElement(row,2)
+      origin[row] = m0*x + m1*y + m2*z + m.GetElement(row,3)
+      # camera looks along -z, see computeCameraFocalPointInRASMm
+      focal[row] = origin[row] - 200*m2
+      up[row] = m1 # standard up direction in OpenGL is [0,1,0]
+    if (self.forcedTarget == True):
+      focal[0] = self.targetModelMiddleInRASMm[0]
+      focal[1] = self.targetModelMiddleInRASMm[1]
+      focal[2] = self.targetModelMiddleInRASMm[2]
+    
+  def resetCameraUpdateStatistics(self):
+    self.cameraUpdateCount = 0
+    self.generalTransformAllocationCount = 0
+    self.cameraUpdateTotalTimeSec = 0.0
+    self.cameraUpdateMaxTimeSec = 0.0
+    
+  def getCameraUpdateStatistics(self):
+    meanTimeMs = 0.0
+    if (self.cameraUpdateCount > 0):
+      meanTimeMs = 1000.0 * self.cameraUpdateTotalTimeSec / self.cameraUpdateCount
+    return {"updateCount": self.cameraUpdateCount,
+            "generalTransformAllocationCount": self.generalTransformAllocationCount,
+            "meanTimeMs": meanTimeMs,
+            "maxTimeMs": 1000.0 * self.cameraUpdateMaxTimeSec}
         
   def computeCameraOriginInRASMm(self, toolCameraToRASTransform):
     # Need to get camera origin and axes from camera coordinates into Slicer RAS coordinates
@@ -600,7 +923,7 @@ class ViewpointLogic:
     return focalPointInRASMm
     
   def computeCameraProjectionDirectionInRAS(self, cameraOriginInRASMm, focalPointInRASMm):
-    math = vtk.vtkMath()
+    math = vtk.vtkMath # static methods only, no instance needed
     directionFromOriginToFocalPointRAS = [0,0,0] # placeholder values
     math.Subtract(focalPointInRASMm,cameraOriginInRASMm,directionFromOriginToFocalPointRAS)
     math.Normalize(directionFromOriginToFocalPointRAS)
@@ -615,7 +938,7 @@ class ViewpointLogic:
   def computeCameraUpDirectionInRAS(self, toolCameraToRASTransform, cameraOriginInRASMm, focalPointInRASMm):
     upDirectionInRAS = [0,0,0] # placeholder values
     if (self.forcedUpDirection == True):
-      math = vtk.vtkMath()
+      math = vtk.vtkMath # static methods only, no instance needed
       # cross product of forwardDirectionInRAS vector with upInRAS vector is the rightDirectionInRAS vector
       upInRAS = self.upInRAS
       forwardDirectionInRAS = self.computeCameraProjectionDirectionInRAS(cameraOriginInRASMm, focalPointInRASMm)
@@ -655,4 +978,94 @@ class ViewpointLogic:
     camera.SetPosition(cameraOriginInRASMm)
     camera.SetFocalPoint(focalPointInRASMm)
     camera.SetViewUp(upDirectionInRAS)
+    if (self.cachedClippingRangeEnabled and self.clippingModels):
+      clippingRange = self.computeClippingRange(cameraOriginInRASMm,focalPointInRASMm)
+      if clippingRange:
+        camera.SetClippingRange(clippingRange)
+        return
     self.cameraNode.ResetClippingRange() # without this line, some objects do not appear in the 3D view
+
+#
+# CallbackProfiler
+#
+
+# Highest resolution clock available (time.perf_counter does not exist in Python 2)
+profilerClock = getattr(time, 'perf_counter', time.time)
+
+class CallbackProfiler:
+  """Records call counts and execution time histograms of observer callbacks.
+  Callbacks are wrapped once, before the observers are added. While the profiler is disabled
+  the wrapper only checks a flag, so it can stay in place in the OR without slowing Slicer down.
+  """
+  # Upper edges of the histogram bins in milliseconds, the last bin collects everything above
+  histogramBinEdgesMs = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0]
+
+  def __init__(self):
+    self.enabled = False
+    self.reset()
+
+  def reset(self):
+    self.statistics = {} # callback name: [count, total sec, max sec, histogram counts]
+
+  def setEnabled(self, enabled):
+    self.enabled = enabled
+
+  def instrument(self, name, callback):
+    profiler = self
+    def instrumentedCallback(*args):
+      if not profiler.enabled:
+        return callback(*args)
+      startTimeSec = profilerClock()
+      try:
+        return callback(*args)
+      finally:
+        profiler.addCall(name, profilerClock() - startTimeSec)
+    return instrumentedCallback
+
+  def instrumentMethods(self, instance, methodNames):
+    """Replaces the given bound methods of instance by instrumented ones, named <class>.<method>.
+    Must be called before the methods are registered as observers.
+    """
+    className = instance.__class__.__name__
+    for methodName in methodNames:
+      setattr(instance, methodName, self.instrument(className + '.' + methodName, getattr(instance, methodName)))
+
+  def addCall(self, name, durationSec):
+    # no logging - it slows Slicer down a *lot*
+    statistics = self.statistics.get(name)
+    if statistics is None:
+      statistics = [0, 0.0, 0.0, [0] * (len(self.histogramBinEdgesMs) + 1)]
+      self.statistics[name] = statistics
+    statistics[0] += 1
+    statistics[1] += durationSec
+    if durationSec > statistics[2]:
+      statistics[2] = durationSec
+    statistics[3][bisect.bisect_left(self.histogramBinEdgesMs, durationSec * 1000.0)] += 1
+
+  def getStatistics(self):
+    """Returns a list of dictionaries, one per callback, the most expensive callback (total time) first.
+    """
+    statisticsList = []
+    for name, (count, totalSec, maxSec, histogram) in self.statistics.items():
+      statisticsList.append({'name': name, 'count': count, 'totalMs': totalSec * 1000.0,
+        'meanMs': totalSec * 1000.0 / count, 'maxMs': maxSec * 1000.0, 'histogram': list(histogram)})
+    statisticsList.sort(key=lambda statistics: statistics['totalMs'], reverse=True)
+    return statisticsList
+
+  def getHistogramBinNames(self):
+    binNames = ['<=%gms' % edgeMs for edgeMs in self.histogramBinEdgesMs]
+    binNames.append('>%gms' % self.histogramBinEdgesMs[-1])
+    return binNames
+
+  def exportToCsv(self, fileName):
+    # the csv module writes its own line endings, otherwise every row is followed by a blank line on Windows
+    if sys.version_info[0] >= 3:
+      csvFile = open(fileName, 'w', newline='')
+    else:
+      csvFile = open(fileName, 'wb')
+    with csvFile:
+      writer = csv.writer(csvFile)
+      writer.writerow(['callback', 'count', 'totalMs', 'meanMs', 'maxMs'] + self.getHistogramBinNames())
+      for statistics in self.getStatistics():
+        writer.writerow([statistics['name'], statistics['count'], '%.3f' % statistics['totalMs'], '%.4f' % statistics['meanMs'], '%.4f' % statistics['maxMs']] + statistics['histogram'])
+    logging.info('Callback profile written to %s' % fileName)